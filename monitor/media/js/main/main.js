@@ -1,72 +1,197 @@
 
-var interfaces, interfaces_q;
-var ethernet, ethernet_q;
-var capture, capture_q;
-var stats, stats_q;
+var interfaces;
+var ethernet;
+var capture;
+var stats, stats_q, stats_data;
+
+// Latest snapshot, kept up to date from /stats/stream/.
+var snapshot = null;
+
+// Whether updates are being streamed.
+var streaming = false;
+
+// Time window (ms) of the history chart.
+var HISTORY_WINDOW = 600000;
+
+// Width (px) of each ethernet gauge.
+var GAUGE_WIDTH = 150;
+
+// Delay (ms) before reconnecting after a stream error.
+var RETRY_DELAY = 5000;
 
 function loadTable() {
     interfaces = new google.visualization.Table(document.getElementById('stats_table_div'));
-    interfaces_q = new google.visualization.Query('http://127.0.0.1:8000/stats/interface/');
-    interfaces_q.send(handleInterfaces);    
-
     ethernet = new google.visualization.Gauge(document.getElementById('ethernet_div'));
-    ethernet_q = new google.visualization.Query('http://127.0.0.1:8000/stats/ethernet/');
-    ethernet_q.send(handleEthernet); 
-
     capture = new google.visualization.Gauge(document.getElementById('capture_div'));
-    capture_q = new google.visualization.Query('http://127.0.0.1:8000/stats/capture/');
-    capture_q.send(handleCapture);   
 
+    // The history is loaded once, then extended from the stream.
     stats = new google.visualization.LineChart(document.getElementById('stats_div'));
-    stats_q = new google.visualization.Query('http://127.0.0.1:8000/stats/interface/');
-    stats_q.send(handleStats);   
+    stats_q = new google.visualization.Query('http://127.0.0.1:8000/stats/history/');
+    stats_q.send(handleStats);
 }
 
-function handleInterfaces(response) {
+function handleStats(response) {
     if (response.isError()) {
         alert('Error in query: ' + response.getMessage() + ' ' + response.getDetailedMessage());
         return;
     }
 
-    interfaces.draw(response.getDataTable(), {width: '800px'});
+    stats_data = response.getDataTable();
+    drawStats();
+    if (!streaming) {
+        streaming = true;
+        streamUpdates(null);
+    }
 }
 
-function handleEthernet(response) {
-    if (response.isError()) {
-        alert('Error in query: ' + response.getMessage() + ' ' + response.getDetailedMessage());
-        return;
+function streamUpdates(version) {
+    var url = 'http://127.0.0.1:8000/stats/stream/';
+    if (version !== null) {
+        url += '?version=' + version;
     }
 
-    var options = {width: 600, height: 150, max: 10, redFrom: 9, redTo: 10,
-		   yellowFrom:4, yellowTo: 9, minorTicks: 1};
-    ethernet.draw(response.getDataTable(), options);
+    $.ajax({url: url, dataType: 'json', cache: false,
+        success: function(update) {
+            if (update === null) {
+                setTimeout(function() { streamUpdates(version); }, RETRY_DELAY);
+                return;
+            }
+
+            if (update.version !== version) {
+                var ids_version = snapshot && snapshot.ids_version;
+                applyUpdate(update);
+                drawAll();
+
+                // The history has a column per interface, so reload it
+                // when interfaces come or go.
+                if (ids_version && snapshot.ids_version !== ids_version) {
+                    stats_q.send(handleStats);
+                }
+            }
+            streamUpdates(snapshot.version);
+        },
+        error: function() {
+            setTimeout(function() { streamUpdates(version); }, RETRY_DELAY);
+        }});
 }
 
-function handleCapture(response) {
-    if (response.isError()) {
-        alert('Error in query: ' + response.getMessage() + ' ' + response.getDetailedMessage());
+function applyUpdate(update) {
+    if (update.base === null || snapshot === null) {
+        snapshot = update;
         return;
     }
 
+    var maps = ['interfaces', 'ethernet', 'rates', 'targets', 'sampled'];
+    for (var i = 0; i < maps.length; i++) {
+        var name = maps[i];
+        snapshot[name] = snapshot[name] || {};
+        $.extend(snapshot[name], update[name]);
+        $.each((update.removed || {})[name] || [], function(j, key) {
+            delete snapshot[name][key];
+        });
+    }
+
+    snapshot.version = update.version;
+    snapshot.timestamp = update.timestamp;
+    snapshot.interval = update.interval;
+    snapshot.capture = update.capture;
+    if (update.ids !== undefined) {
+        snapshot.ids = update.ids;
+    }
+    snapshot.ids_version = update.ids_version;
+}
+
+// Return the ids of the interfaces to show, in order.
+function interfaceIds() {
+    return snapshot.ids || Object.keys(snapshot.interfaces).sort();
+}
+
+// Return the label of an interface, e.g. Eth3 or das1:Eth3.
+function interfaceLabel(id) {
+    var i = id.lastIndexOf(':');
+    return id.substring(0, i + 1) + 'Eth' + id.substring(i + 1);
+}
+
+function drawAll() {
+    drawInterfaces();
+    drawEthernet();
+    drawCapture();
+    appendStats();
+}
+
+function drawInterfaces() {
+    var data = new google.visualization.DataTable();
+    data.addColumn('string', 'Interface');
+    var labels = ['byteCount', 'bytesDropped', 'packetCount', 'packetsDropped', 'errorCount'];
+    for (var i = 0; i < labels.length; i++) {
+        data.addColumn('number', labels[i]);
+    }
+
+    var ids = interfaceIds();
+    for (var i = 0; i < ids.length; i++) {
+        var row = [ids[i], 0, 0, 0, 0, 0];
+        var values = snapshot.interfaces[ids[i]];
+        if (values) {
+            row = [ids[i]];
+            for (var j = 1; j < values.length; j++) {
+                row.push(Number(values[j]));
+            }
+        }
+        data.addRow(row);
+    }
+
+    interfaces.draw(data, {width: '800px'});
+}
+
+function drawEthernet() {
+    var data = new google.visualization.DataTable();
+    data.addColumn('string', 'Label');
+    data.addColumn('number', 'Value');
+    var ids = interfaceIds();
+    for (var i = 0; i < ids.length; i++) {
+        data.addRow([interfaceLabel(ids[i]), snapshot.ethernet[ids[i]] || 0]);
+    }
+
+    var options = {width: GAUGE_WIDTH * Math.max(ids.length, 1), height: 150, max: 10, redFrom: 9, redTo: 10,
+		   yellowFrom:4, yellowTo: 9, minorTicks: 1};
+    ethernet.draw(data, options);
+}
+
+function drawCapture() {
+    var data = new google.visualization.DataTable();
+    data.addColumn('string', 'Label');
+    data.addColumn('number', 'Value');
+    data.addRow(['Capture', snapshot.capture]);
+
     var options = {width: 150, height: 150, max: 20, redFrom: 19, redTo: 20,
 		   yellowFrom:16, yellowTo: 19, minorTicks: 1};
-    capture.draw(response.getDataTable(), options);
+    capture.draw(data, options);
 }
 
-function handleStats(response) {
-    if (response.isError()) {
-        alert('Error in query: ' + response.getMessage() + ' ' + response.getDetailedMessage());
-        return;
+function appendStats() {
+    var now = new Date(snapshot.timestamp * 1000);
+    var row = [now];
+    for (var c = 1; c < stats_data.getNumberOfColumns(); c++) {
+        row.push(snapshot.ethernet[stats_data.getColumnId(c)] || 0);
+    }
+    stats_data.addRow(row);
+
+    // Drop points that have left the window.
+    var oldest = now.getTime() - HISTORY_WINDOW;
+    while (stats_data.getNumberOfRows() > 0 &&
+           stats_data.getValue(0, 0).getTime() < oldest) {
+        stats_data.removeRow(0);
     }
 
-    stats.draw(response.getDataTable(), {width: 800, height: 300, legend: 'bottom', pointSize: 4, 
-					 hAxis: {title: 'Interface' } });
+    drawStats();
+}
+
+function drawStats() {
+    stats.draw(stats_data, {width: 800, height: 300, legend: 'bottom', pointSize: 0,
+			    hAxis: {title: 'Time' }, vAxis: {title: 'Gbps'} });
 }
 
 
 $(document).ready(function() {
     google.setOnLoadCallback(loadTable);
-    var refreshId = setInterval(function() {
-	    loadTable();
-    }, 5000);
 });
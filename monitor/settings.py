@@ -37,6 +37,11 @@ LANGUAGE_CODE = 'en-us'
 
 SITE_ID = 1
 
+# Directory in which worker processes share the latest StatsServer
+# snapshot. It must be writable only by the user the monitor runs as, and
+# is created if it does not exist. None for one in the temporary directory.
+STATS_CACHE_DIR = None
+
 # If you set this to False, Django will make some optimizations so as not
 # to load the internationalization machinery.
 USE_I18N = True
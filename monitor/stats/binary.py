@@ -0,0 +1,60 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Encoding of the StatsServer's binary transport: the MessagePack format,
+#   with counters and rates in packed arrays. The codec is the server's own
+#   server/StatsBinary.py, imported from the server directory, so that the
+#   two ends cannot drift apart.
+#
+#   snapshot_struct() turns a snapshot received over the binary transport
+#   into the struct that snapshot() returns over XML RPC, with counters as
+#   integers rather than strings.
+#------------------------------------------------------------------------------
+
+import os
+import sys
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Directory of the StatsServer's modules.
+SERVER_DIR = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+    'server'))
+
+if SERVER_DIR not in sys.path:
+    sys.path.append(SERVER_DIR)
+
+from StatsBinary import BINARY_CONTENT_TYPE, pack, unpack
+
+
+def snapshot_struct(value):
+    '''Convert a snapshot from the binary transport to the struct returned
+    over XML RPC, with counters as tuples of integers.
+
+    :param value: the decoded binary snapshot.'''
+    ids = value['ids']
+    width = value['width']
+    counters = value['interfaces']
+    rates = value['rates']
+    ethernet = value['ethernet']
+
+    interfaces = dict()
+    interface_rates = dict()
+    interface_ethernet = dict()
+    for i, id_ in enumerate(ids):
+        interfaces[id_] = counters[i*width:(i + 1)*width]
+
+        # Interfaces without rates yet have NaN ones.
+        row = rates[i*(width - 1):(i + 1)*(width - 1)]
+        if row and row[0] == row[0]:
+            interface_rates[id_] = row
+            interface_ethernet[id_] = ethernet[i]
+
+    snapshot = dict(value)
+    del snapshot['width']
+    snapshot['interfaces'] = interfaces
+    snapshot['rates'] = interface_rates
+    snapshot['ethernet'] = interface_ethernet
+    return snapshot
@@ -0,0 +1,524 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Caches shared by the stats views. The StatsServer only produces new data
+#   once per polling interval, so the latest snapshot is fetched at most once
+#   per interval however many dashboards are open, and each data table is
+#   rendered once per snapshot version. Dashboards streaming updates share a
+#   single long-poll to the StatsServer through a SnapshotFeed.
+#
+#   When the monitor runs in several worker processes, a FileSnapshotCache
+#   shares the latest snapshot between them through a file. A lock on a
+#   second file lets only one worker fetch it per polling interval, and only
+#   one wait on the StatsServer for the next, so the load on the StatsServer
+#   does not grow with the number of workers.
+#
+#   The files are kept in a directory that only the monitor's user may
+#   write to, created with permissions 0700 if it does not exist. They are
+#   created exclusively with permissions 0600 and never opened through a
+#   symbolic link, so another local user can neither read the snapshots nor
+#   plant a file or link for the monitor to write through.
+#------------------------------------------------------------------------------
+
+import errno
+import os
+import stat
+import struct
+import threading
+import time
+
+from stats.binary import pack, unpack
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Time to live (s) for a snapshot that does not give its polling interval.
+DEFAULT_TTL = 1.0
+
+# Time to live (s) after a failed fetch, so a dead server is not hammered.
+FAILURE_TTL = 1.0
+
+# Once a snapshot's interval has passed without a new version appearing,
+# the server is polled again after this fraction of the interval.
+RECHECK_FRACTION = 0.1
+
+# Time (s) between checks of a FileSnapshotCache for a lock to be released
+# or a new snapshot to be stored by another worker.
+POLL_INTERVAL = 0.02
+
+# Flag refusing to open a file through a symbolic link, where supported.
+_O_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)
+
+# Header of a FileSnapshotCache file: when the snapshot expires, and a
+# random token identifying it. The encoded snapshot follows, or nothing if
+# the server was unavailable.
+_file_header = struct.Struct('<dQ')
+
+
+def snapshot_expiry(snapshot, previous, now):
+    '''Return until when to cache a fetched snapshot.
+
+    A snapshot is cached until one polling interval after the server sampled
+    it, when the next one is due, so it is never served more than one
+    interval old however late in the interval it was fetched.
+
+    :param snapshot: the snapshot struct fetched, or None.
+    :param previous: the snapshot cached before it, or None.
+    :param now: the current time.'''
+    if snapshot is None:
+        return now + FAILURE_TTL
+
+    interval = snapshot.get('interval') or DEFAULT_TTL
+    if previous is not None and \
+       previous.get('version') == snapshot.get('version'):
+        # The update is late; check again soon rather than on every
+        # request.
+        return now + interval*RECHECK_FRACTION
+
+    sampled = snapshot.get('timestamp')
+    if not sampled:
+        return now + interval
+
+    # Clamped, so that the clocks of hosts that disagree can neither extend
+    # a snapshot's life beyond an interval nor make it negative.
+    return now + min(max(sampled + interval - now, 0), interval)
+
+
+def make_private_directory(path):
+    '''Create a directory that only the current user may write to, or check
+    that an existing one is.
+
+    :param path: path of the directory.
+    :raises OSError: if the path is a symbolic link or not a directory, or
+        the directory is owned by or writable by another user.'''
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+       st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise OSError(errno.EACCES, 'Not a private directory', path)
+
+
+def open_private(path, flags):
+    '''Open a file only the current user may access, creating it with
+    permissions 0600 if it does not exist.
+
+    :param path: path of the file.
+    :param flags: flags of os.open(), besides those creating the file.
+    :returns: the file descriptor.
+    :raises OSError: if the path is a symbolic link, or a file owned by
+        another user.'''
+    try:
+        return os.open(path, flags | os.O_CREAT | os.O_EXCL, 0600)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    fd = os.open(path, flags | _O_NOFOLLOW)
+    if os.fstat(fd).st_uid != os.getuid():
+        os.close(fd)
+        raise OSError(errno.EACCES, 'Owned by another user', path)
+    return fd
+
+
+class SnapshotCache(object):
+    '''Cache the latest StatsServer snapshot until the next poll is due.
+
+    Only one thread fetches at a time. Threads arriving during a fetch wait
+    for its result rather than issuing their own.'''
+
+
+    def __init__(self, fetch, timeout=2.0):
+        '''Constructor.
+
+        :param fetch: callable returning a snapshot struct, or None when the
+            server is unavailable.
+        :param timeout: longest time (s) to wait for another thread's fetch
+            before using the cached snapshot.'''
+        self._fetch = fetch
+        self._timeout = timeout
+        self._cond = threading.Condition()
+        self._snapshot = None
+        self._expires = 0
+        self._fetching = False
+
+        # Number of fetches made, and of requests answered without one.
+        self.fetches = 0
+        self.hits = 0
+
+    def get(self):
+        '''Return the current snapshot, fetching it if it has expired.'''
+        with self._cond:
+            if time.time() < self._expires:
+                self.hits += 1
+                return self._snapshot
+
+            if self._fetching:
+                # Wait for the fetch in progress instead of stampeding.
+                deadline = time.time() + self._timeout
+                while self._fetching and time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+                self.hits += 1
+                return self._snapshot
+
+            self._fetching = True
+            previous = self._snapshot
+
+        snapshot = None
+        try:
+            snapshot = self._fetch()
+        finally:
+            with self._cond:
+                self._store(snapshot, previous)
+                self._fetching = False
+                self.fetches += 1
+                self._cond.notify_all()
+
+        return snapshot
+
+    def clear(self):
+        '''Discard the cached snapshot.'''
+        with self._cond:
+            self._snapshot = None
+            self._expires = 0
+
+    def _store(self, snapshot, previous):
+        '''Cache a fetched snapshot until its next update is due.'''
+        self._snapshot = snapshot
+        self._expires = snapshot_expiry(snapshot, previous, time.time())
+
+
+class FileSnapshotCache(object):
+    '''Cache the latest StatsServer snapshot in a file shared by worker
+    processes, until the next poll is due.
+
+    The worker that finds the snapshot expired takes a lock and fetches it,
+    while the others wait for it to be stored. The file is replaced whole by
+    a rename, so it is read without locking, and a snapshot is decoded once
+    per process.'''
+
+
+    def __init__(self, fetch, directory, timeout=2.0, wait=None):
+        '''Constructor.
+
+        :param fetch: callable returning a snapshot struct, or None when the
+            server is unavailable.
+        :param directory: directory of the files shared by the workers,
+            created if it does not exist.
+        :param timeout: longest time (s) to wait for another worker's fetch
+            before using the cached snapshot.
+        :param wait: callable waiting on the server for a new snapshot, as
+            taken by SnapshotFeed, or None.
+        :raises OSError: if the directory is not private to the current
+            user (see make_private_directory()).'''
+        make_private_directory(directory)
+        self.directory = directory
+        self.path = os.path.join(directory, 'snapshot')
+        self._fetch = fetch
+        self._wait = wait
+        self._timeout = timeout
+
+        # The snapshot last read, as (token, snapshot).
+        self._read_cache = (None, None)
+
+        # Number of fetches this process made, and of requests it answered
+        # without one.
+        self.fetches = 0
+        self.hits = 0
+
+    def get(self):
+        '''Return the current snapshot, fetching it if it has expired.'''
+        expires, snapshot = self._read()
+        if time.time() < expires:
+            self.hits += 1
+            return snapshot
+
+        lock = self._lock('.lock', self._timeout)
+        if lock is None:
+            # Another worker is still fetching; use what it has cached.
+            self.hits += 1
+            return self._read()[1]
+
+        try:
+            expires, previous = self._read()
+            if time.time() < expires:
+                # Fetched by another worker while this one waited.
+                self.hits += 1
+                return previous
+
+            snapshot = None
+            try:
+                snapshot = self._fetch()
+            finally:
+                self.fetches += 1
+                self._store(snapshot, snapshot_expiry(snapshot, previous,
+                                                      time.time()))
+        finally:
+            os.close(lock)
+
+        return snapshot
+
+    def wait(self, version, timeout):
+        '''Wait for a snapshot whose version differs from a given one.
+
+        Only one worker at a time waits on the server. The others wait for
+        it to store the snapshot it receives.
+
+        :param version: the snapshot version already held.
+        :param timeout: longest time (s) to wait.
+        :returns: the new snapshot, the current one on timeout, or None if
+            the server is unavailable.'''
+        deadline = time.time() + timeout
+        while True:
+            expires, snapshot = self._read()
+            current = -1
+            if snapshot is not None:
+                current = snapshot.get('version')
+                if current != version:
+                    return snapshot
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return snapshot
+
+            lock = self._lock('.wait.lock', 0)
+            if lock is None:
+                time.sleep(min(POLL_INTERVAL, remaining))
+                continue
+
+            try:
+                if self._read()[1] is not snapshot:
+                    # Stored by another worker meanwhile.
+                    continue
+
+                latest = self._wait(current, remaining)
+                self.fetches += 1
+                if latest is not None and latest.get('version') != current:
+                    self._store(latest, snapshot_expiry(latest, None,
+                                                        time.time()))
+                return latest
+            finally:
+                os.close(lock)
+
+    def clear(self):
+        '''Discard the cached snapshot.'''
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._read_cache = (None, None)
+
+    def _read(self):
+        '''Return the cached snapshot.
+
+        :returns: the pair (expiry time, snapshot), with an expiry time of
+            zero if nothing is cached.'''
+        try:
+            fd = os.open(self.path, os.O_RDONLY | _O_NOFOLLOW)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0, None
+        f = os.fdopen(fd, 'rb')
+
+        try:
+            header = f.read(_file_header.size)
+            if len(header) < _file_header.size:
+                return 0, None
+            expires, token = _file_header.unpack(header)
+
+            cached_token, snapshot = self._read_cache
+            if token != cached_token:
+                data = f.read()
+                snapshot = None
+                if data:
+                    snapshot = unpack(data)
+                self._read_cache = (token, snapshot)
+        finally:
+            f.close()
+
+        return expires, snapshot
+
+    def _store(self, snapshot, expires):
+        '''Replace the cached snapshot.
+
+        :param snapshot: the snapshot struct, or None if the server was
+            unavailable.
+        :param expires: time until which it is cached.'''
+        data = ''
+        if snapshot is not None:
+            data = pack(snapshot)
+        # Forked workers share the random module's state, but not the
+        # system's randomness.
+        token = struct.unpack('<Q', os.urandom(8))[0]
+
+        temp = '%s.%d.%d' % (self.path, os.getpid(), token)
+        with os.fdopen(open_private(temp, os.O_WRONLY), 'wb') as f:
+            f.write(_file_header.pack(expires, token))
+            f.write(data)
+        os.rename(temp, self.path)
+
+    def _lock(self, suffix, timeout):
+        '''Take the exclusive lock on a lock file next to the cache file.
+
+        :param suffix: suffix of the lock file's name.
+        :param timeout: longest time (s) to wait for the lock.
+        :returns: the file descriptor holding the lock, to be closed to
+            release it, or None if it was not taken within the timeout.'''
+        fd = open_private(self.path + suffix, os.O_RDWR)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                os.close(fd)
+                return None
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+
+class SnapshotFeed(object):
+    '''Deliver each new StatsServer snapshot to any number of waiting
+    requests.
+
+    Only one thread at a time waits on the StatsServer for a new snapshot.
+    Threads arriving meanwhile wait for its result, so each snapshot is
+    fetched once however many requests are waiting for it.'''
+
+
+    def __init__(self, wait):
+        '''Constructor.
+
+        :param wait: callable taking a snapshot version and a timeout (s),
+            and returning the first snapshot struct with a different
+            version, the current snapshot on timeout, or None when the
+            server is unavailable.'''
+        self._wait = wait
+        self._cond = threading.Condition()
+        self._snapshot = None
+        self._previous = None
+        self._waiting = False
+
+        # Number of snapshots fetched.
+        self.fetches = 0
+
+    def next(self, version, timeout):
+        '''Return the first snapshot whose version differs from a given one.
+
+        :param version: version of the caller's latest snapshot, or None.
+        :param timeout: longest time (s) to wait.
+        :returns: a (snapshot, previous) pair, where previous is the
+            snapshot published before it, or (None, None) if no snapshot is
+            available. On timeout the snapshot has the given version.'''
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                snapshot = self._snapshot
+                remaining = deadline - time.time()
+                if snapshot is not None and \
+                   snapshot.get('version') != version or remaining <= 0:
+                    return snapshot, self._previous
+
+                if self._waiting:
+                    self._cond.wait(remaining)
+                    continue
+
+                self._waiting = True
+                # Snapshot versions start from zero.
+                current = -1
+                if snapshot is not None:
+                    current = snapshot.get('version')
+                self._cond.release()
+                try:
+                    self._fetch(current, remaining)
+                finally:
+                    self._cond.acquire()
+                    self._waiting = False
+                    self._cond.notify_all()
+
+    def _fetch(self, current, timeout):
+        '''Wait on the server for a snapshot newer than the current one.'''
+        start = time.time()
+        snapshot = None
+        try:
+            snapshot = self._wait(current, timeout)
+        finally:
+            with self._cond:
+                self.fetches += 1
+                if snapshot is not None and \
+                   snapshot.get('version') != current:
+                    self._previous = self._snapshot
+                    self._snapshot = snapshot
+
+        # A server that is unavailable, or answers without waiting, is asked
+        # again after a pause rather than in a tight loop.
+        pause = FAILURE_TTL
+        if snapshot is not None:
+            if snapshot.get('version') != current:
+                return
+            pause = (snapshot.get('interval') or DEFAULT_TTL)*RECHECK_FRACTION
+
+        pause = min(pause - (time.time() - start), timeout)
+        if pause > 0:
+            time.sleep(pause)
+
+
+class TableCache(object):
+    '''Cache rendered data tables by resource name and snapshot version.
+
+    Tables for older versions are evicted as soon as a newer version is
+    rendered.'''
+
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._tables = dict()
+
+    def get(self, name, snapshot, render):
+        '''Return the table for a resource, rendering it if needed.
+
+        :param name: the resource name.
+        :param snapshot: the snapshot struct, or None.
+        :param render: callable rendering the table from the snapshot.'''
+        # The timestamp tells apart versions from before a server restart.
+        version = None
+        if snapshot is not None:
+            version = (snapshot.get('version'), snapshot.get('timestamp'))
+
+        with self._lock:
+            if version == self._version and self._tables.has_key(name):
+                return self._tables[name]
+
+        table = render(snapshot)
+
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._tables = dict()
+            self._tables[name] = table
+
+        return table
+
+    def clear(self):
+        '''Discard all rendered tables.'''
+        with self._lock:
+            self._version = None
+            self._tables = dict()
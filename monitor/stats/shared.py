@@ -0,0 +1,228 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Reads the snapshots a StatsServer on the same host publishes to shared
+#   memory (see server/StatsShared.py), so the stats views get them without
+#   an RPC.
+#
+#   The file's header holds a sequence number that is odd while the
+#   StatsServer writes a snapshot, and even once it is complete. A reader
+#   decodes the snapshot in place from its mapping of the file, then reads
+#   the sequence again: if it has changed, the snapshot was overwritten as
+#   it was read, and is read again. The decoded snapshot is kept until the
+#   sequence changes, so reading an unchanged snapshot costs one stat() of
+#   the file and one read of the sequence.
+#
+#   A file that does not exist or holds no snapshot reads as None, and the
+#   views ask the StatsServer over RPC instead. So does one whose sequence
+#   has not advanced for several polling intervals, because the StatsServer
+#   has stopped. That is judged on the reader's own monotonic clock, from
+#   when it last saw the sequence change, rather than from the time in the
+#   header, which the clocks of the two processes may not agree on once the
+#   system clock is set. A reader that has just started trusts the snapshot
+#   it finds until it has gone unchanged that long.
+#
+#   A file that is a symbolic link, is owned by another user or that another
+#   user may write to is not mapped, so that no other user can feed the
+#   views snapshots; the views ask the StatsServer over RPC instead.
+#------------------------------------------------------------------------------
+
+import mmap
+import os
+import struct
+import time
+
+# stats.binary puts the server's modules on the path.
+from stats.binary import snapshot_struct, unpack
+from StatsSchedule import monotonic
+from StatsShared import (HEADER_SIZE, LAYOUT_VERSION, LENGTH_OFFSET, MAGIC,
+                         SEQUENCE_OFFSET, is_private)
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Attempts at a consistent read before giving up.
+READ_ATTEMPTS = 100
+
+# A snapshot is stale once its sequence has not changed for this many
+# polling intervals, and no sooner than STALE_MIN (s).
+STALE_INTERVALS = 3
+STALE_MIN = 10.0
+
+# Time (s) between checks for a new snapshot while waiting for one.
+WAIT_INTERVAL = 0.02
+
+# Flag refusing to open a file through a symbolic link, where supported.
+_O_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)
+
+_sequence = struct.Struct('<Q')
+_layout = struct.Struct('<4sI')
+_fields = struct.Struct('<Qdd')
+
+
+class SharedReader(object):
+    '''Read the latest snapshot from a StatsServer's shared memory file.
+
+    Reads are safe from several threads.'''
+
+
+    def __init__(self, path):
+        '''Constructor.
+
+        :param path: path of the StatsServer's shared memory file.'''
+        self.path = path
+
+        # The file mapped, and the decoded snapshot with its sequence and
+        # header fields. Each is replaced in one assignment.
+        self._mapped = None
+        self._latest = None
+
+        # The sequence last seen, and when (on the monotonic clock) it was
+        # first seen.
+        self._seen = (None, 0.0)
+
+        # Number of snapshots decoded, and of reads that were retried as
+        # the snapshot changed underneath them.
+        self.reads = 0
+        self.retries = 0
+
+    def read(self):
+        '''Return the latest snapshot.
+
+        :returns: the snapshot struct, as returned by the snapshot() RPC
+            with counters as tuples of integers, or None if there is none
+            or it is stale.'''
+        mapped = self._map()
+        if mapped is None:
+            return None
+
+        for attempt in xrange(READ_ATTEMPTS):
+            latest = self._read(mapped)
+            if latest is not None:
+                break
+            self.retries += 1
+
+            # Let the writer finish, and pick up the file if it has grown.
+            time.sleep(0)
+            data = mapped[0]
+            length = _fields.unpack_from(data, LENGTH_OFFSET)[0]
+            mapped = self._map(remap=HEADER_SIZE + length > len(data))
+            if mapped is None:
+                return None
+        else:
+            return None
+
+        snapshot, sequence, timestamp, interval = latest
+        now = monotonic()
+        seen, since = self._seen
+        if sequence != seen:
+            self._seen = (sequence, now)
+        elif now - since > max(interval*STALE_INTERVALS, STALE_MIN):
+            return None
+
+        return snapshot
+
+    def wait(self, version, timeout):
+        '''Wait for a snapshot whose version differs from a given one.
+
+        :param version: the version already held.
+        :param timeout: longest time (s) to wait.
+        :returns: the new snapshot, the same one if none was published
+            within the timeout, or None if there is none.'''
+        deadline = time.time() + timeout
+        while True:
+            snapshot = self.read()
+            if snapshot is None or snapshot['version'] != version:
+                return snapshot
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return snapshot
+            time.sleep(min(WAIT_INTERVAL, remaining))
+
+    def _read(self, mapped):
+        '''Read the snapshot once.
+
+        :returns: the tuple (snapshot, sequence, timestamp, interval), with
+            a snapshot of None if there is none, or None if it was being
+            written or changed while it was read.'''
+        data, inode = mapped
+        sequence = _sequence.unpack_from(data, SEQUENCE_OFFSET)[0]
+        if sequence & 1:
+            return None
+
+        latest = self._latest
+        if latest is not None and latest[1] == sequence:
+            return latest
+        if sequence == 0:
+            # Nothing has been published yet.
+            return (None, 0, 0.0, 0.0)
+
+        length, timestamp, interval = _fields.unpack_from(data,
+                                                          LENGTH_OFFSET)
+        if HEADER_SIZE + length > len(data):
+            return None
+
+        try:
+            snapshot = snapshot_struct(unpack(buffer(data, HEADER_SIZE,
+                                                     length)))
+        except (ValueError, TypeError, KeyError, IndexError):
+            # Overwritten as it was decoded; the sequence tells.
+            snapshot = None
+
+        if _sequence.unpack_from(data, SEQUENCE_OFFSET)[0] != sequence:
+            return None
+
+        # A snapshot that could not be decoded is kept as None, and not
+        # decoded again.
+        latest = (snapshot, sequence, timestamp, interval)
+        self._latest = latest
+        self.reads += 1
+        return latest
+
+    def _map(self, remap=False):
+        '''Return the file's mapping, mapping it if it is new or has been
+        replaced.
+
+        :param remap: whether to map the file again in any case, to see all
+            of a file that has grown.
+        :returns: the pair (mapping, inode), or None if there is no file or
+            it is not private to the current user.'''
+        mapped = self._mapped
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            self._mapped = None
+            return None
+
+        if mapped is not None and mapped[1] == inode and not remap:
+            return mapped
+
+        try:
+            fd = os.open(self.path, os.O_RDONLY | _O_NOFOLLOW)
+            try:
+                if not is_private(os.fstat(fd)):
+                    self._mapped = None
+                    return None
+                data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+        except (IOError, OSError, ValueError, mmap.error):
+            self._mapped = None
+            return None
+
+        if len(data) < HEADER_SIZE or \
+            _layout.unpack_from(data, 0) != (MAGIC, LAYOUT_VERSION):
+            data.close()
+            self._mapped = None
+            return None
+
+        if mapped is None or mapped[1] != inode:
+            # A new file, whose sequence numbers are unrelated.
+            self._latest = None
+            self._seen = (None, 0.0)
+
+        mapped = (data, inode)
+        self._mapped = mapped
+        return mapped
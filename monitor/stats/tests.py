@@ -1,12 +1,930 @@
 """
-This file demonstrates two different styles of tests (one doctest and one
-unittest). These will both pass when you run "manage.py test".
-
-Replace these with more appropriate tests for your application.
+Tests of the stats application: the views, the snapshot and table caches,
+the StatsServer clients and codecs, the gviz table rendering and the
+shared memory reader. Run them with "manage.py test stats".
 """
 
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import xmlrpclib
+from datetime import datetime
+from unittest import skipIf
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+
 from django.test import TestCase
 
+from stats import shared, views
+from stats.binary import pack, snapshot_struct, unpack
+from stats.cache import (FileSnapshotCache, SnapshotCache, SnapshotFeed,
+                         TableCache, snapshot_expiry)
+from stats.client import ClientPool
+from stats.gviz import TableFormat
+from stats.shared import HEADER_SIZE, READ_ATTEMPTS, SharedReader
+# stats.binary puts the server's modules on the path.
+from StatsBinary import BINARY_PATH, Packed
+
+try:
+    import gviz_api
+except ImportError:
+    gviz_api = None
+
+
+class FakeProxy(object):
+    '''Stands in for the StatsServer ServerProxy.'''
+
+    def __init__(self, snapshot):
+        self.snapshot_ = snapshot
+        self.calls = 0
+
+    def snapshot(self):
+        self.calls += 1
+        return self.snapshot_
+
+    def wait(self, version, timeout):
+        self.calls += 1
+        return self.snapshot_
+
+    def history(self, ids, start, end, buckets):
+        self.calls += 1
+        fields = ['byte_count', 'byte_rate']
+        interfaces = dict((id_, [[1358000000.0 + t, 1, [0, 0], [0, 0],
+                                  [0, 125000000 * (t + int(id_))]]
+                                 for t in range(3)]) for id_ in ids)
+        del interfaces['3'][0]
+        return {'fields': fields, 'interfaces': interfaces}
+
+
+SNAPSHOT = {
+    'version': 7,
+    'timestamp': 1358000000.0,
+    'interfaces': dict((str(i), [str(i), str(10000000000 + i), '1', '2',
+                                 '3', '4']) for i in range(4)),
+    'ethernet': {'0': 1.5, '1': 2.5, '2': 0.0, '3': 9.5},
+    'targets': {'': 13.5},
+    'capture': 13.5,
+    'ids': ['0', '1', '2', '3'],
+    'ids_version': 1,
+    'sampled': {'': 1358000000.0},
+    }
+
+
+class StatsViewsTest(TestCase):
+
+    def setUp(self):
+        self.proxy = FakeProxy(SNAPSHOT)
+        self.get_proxy = views.get_proxy
+        views.get_proxy = lambda: self.proxy
+        self.shared = views.SHARED
+        views.SHARED = SharedReader('/nonexistent/statsserver')
+        self.root = tempfile.mkdtemp()
+        self.snapshots = views.SNAPSHOTS
+        views.SNAPSHOTS = FileSnapshotCache(views.get_snapshot, self.root,
+                                            views.SOCKET_TIMEOUT)
+        views.TABLES.clear()
+
+        self.get_stream_proxy = views.get_stream_proxy
+        self.feed = views.FEED
+        self.stream_timeout = views.STREAM_TIMEOUT
+        views.get_stream_proxy = lambda: self.proxy
+        views.FEED = SnapshotFeed(views.wait_snapshot)
+        views.UPDATES.clear()
+        views.STREAM_TIMEOUT = 0.2
+
+    def tearDown(self):
+        views.get_proxy = self.get_proxy
+        views.SHARED = self.shared
+        views.SNAPSHOTS = self.snapshots
+        shutil.rmtree(self.root)
+        views.get_stream_proxy = self.get_stream_proxy
+        views.FEED = self.feed
+        views.STREAM_TIMEOUT = self.stream_timeout
+
+    def get(self, resource):
+        '''Fetch a resource and return its table as a list of row values.'''
+        response = self.client.get('/stats/%s/' % resource,
+                                   {'tqx': 'reqId:3'})
+        self.assertEqual(response.status_code, 200)
+
+        content = response.content
+        body = json.loads(content[content.index('(') + 1:content.rindex(')')])
+        self.assertEqual(body['reqId'], '3')
+        return [[c and c['v'] for c in row['c']]
+                for row in body['table']['rows']]
+
+    def test_interface(self):
+        rows = self.get('interface')
+        self.assertEqual(self.proxy.calls, 1)
+        self.assertEqual(rows[3], ['3', 10000000003, 1, 2, 3, 4])
+
+    def test_ethernet(self):
+        rows = self.get('ethernet')
+        self.assertEqual(self.proxy.calls, 1)
+        self.assertEqual(rows, [['Eth0', 1.5], ['Eth1', 2.5], ['Eth2', 0],
+                                ['Eth3', 9.5]])
+
+    def test_capture(self):
+        rows = self.get('capture')
+        self.assertEqual(self.proxy.calls, 1)
+        self.assertEqual(rows, [['Capture', 13.5]])
+
+    def test_history(self):
+        rows = self.get('history')
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0][1:], [0, 1, 2, None])
+        self.assertEqual(rows[2][1:], [2, 3, 4, 5])
+        self.assertTrue(rows[0][0].startswith('Date('))
+
+    def test_server_unavailable(self):
+        views.get_proxy = lambda: None
+        self.assertEqual(self.get('capture'), [['Capture', 0]])
+        self.assertEqual(self.get('ethernet'), [])
+        self.assertEqual(self.get('interface'), [])
+        self.assertEqual(self.get('history'), [])
+
+    def test_discovered_interfaces(self):
+        ids = [str(i) for i in range(12)] + ['das1:0']
+        self.proxy.snapshot_ = dict(SNAPSHOT, ids=ids, ids_version=2)
+
+        rows = self.get('ethernet')
+        self.assertEqual([r[0] for r in rows],
+                         ['Eth%d' % i for i in range(12)] + ['das1:Eth0'])
+        self.assertEqual(rows[11], ['Eth11', 0])
+
+        # Interfaces listed but not yet reported are shown as zeros.
+        rows = self.get('interface')
+        self.assertEqual(len(rows), 13)
+        self.assertEqual(rows[3], ['3', 10000000003, 1, 2, 3, 4])
+        self.assertEqual(rows[10], ['10', 0, 0, 0, 0, 0])
+
+    def test_snapshot_ids(self):
+        self.assertEqual(views.snapshot_ids(None), [])
+        self.assertEqual(views.snapshot_ids(SNAPSHOT), ['0', '1', '2', '3'])
+
+        # Without a list, the reported interfaces are ordered by number.
+        snapshot = dict(SNAPSHOT, interfaces={'10': [], '2': [], 'a:1': []})
+        del snapshot['ids']
+        self.assertEqual(views.snapshot_ids(snapshot), ['2', '10', 'a:1'])
+
+    def test_pool(self):
+        response = self.client.get('/stats/pool/')
+        self.assertEqual(sorted(json.loads(response.content).keys()),
+                         ['hits', 'idle', 'misses', 'shared_reads',
+                          'shared_retries', 'snapshot_fetches',
+                          'snapshot_hits', 'stream_fetches', 'transport'])
+
+    def stream(self, version=None):
+        data = {}
+        if version is not None:
+            data['version'] = version
+        response = self.client.get('/stats/stream/', data)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_stream_full_snapshot(self):
+        update = self.stream()
+        self.assertEqual(update['base'], None)
+        self.assertEqual(update['version'], 7)
+        self.assertEqual(update['ethernet'], SNAPSHOT['ethernet'])
+
+        # A dashboard with an unknown version gets the whole snapshot.
+        self.assertEqual(self.stream(3)['base'], None)
+
+    def test_stream_delta(self):
+        self.stream()
+        snapshot = dict(SNAPSHOT, version=8, capture=14.0,
+                        ethernet=dict(SNAPSHOT['ethernet'], **{'0': 2.0}),
+                        interfaces=dict(SNAPSHOT['interfaces']),
+                        sampled={'': 1358000000.25})
+        del snapshot['interfaces']['3']
+        self.proxy.snapshot_ = snapshot
+
+        update = self.stream(7)
+        self.assertEqual(update['base'], 7)
+        self.assertEqual(update['version'], 8)
+        self.assertEqual(update['capture'], 14.0)
+        self.assertEqual(update['ethernet'], {'0': 2.0})
+        self.assertEqual(update['sampled'], {'': 1358000000.25})
+        self.assertEqual(update['interfaces'], {})
+        self.assertEqual(update['removed'], {'interfaces': ['3']})
+        self.assertFalse(update.has_key('ids'))
+
+    def test_stream_ids_changed(self):
+        self.stream()
+        self.proxy.snapshot_ = dict(SNAPSHOT, version=8, ids=['0', '1'],
+                                    ids_version=2)
+
+        update = self.stream(7)
+        self.assertEqual(update['ids'], ['0', '1'])
+        self.assertEqual(update['ids_version'], 2)
+
+    def test_stream_timeout(self):
+        self.stream()
+        self.assertEqual(self.stream(7), {'version': 7, 'base': 7})
+
+    def test_stream_server_unavailable(self):
+        views.get_stream_proxy = lambda: None
+        self.assertEqual(self.stream(), None)
+
+    def test_views_share_snapshot(self):
+        # Cached until an interval after it was sampled.
+        self.proxy.snapshot_ = dict(SNAPSHOT, timestamp=time.time())
+        for i in range(10):
+            self.get('interface')
+            self.get('ethernet')
+            self.get('capture')
+        self.assertEqual(self.proxy.calls, 1)
+
+
+    def test_shared_memory(self):
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, 'shared')
+            write_shared(path, dict(BINARY_SNAPSHOT, targets={'': 1.5},
+                                    sampled={}, interval=5), 2)
+            views.SHARED = SharedReader(path)
+            self.assertEqual(self.get('ethernet'),
+                             [['Eth0', 1.5], ['Eth1', 0]])
+            self.assertEqual(self.stream(6)['version'], 7)
+        finally:
+            shutil.rmtree(root)
+
+        # The snapshot and the stream were read without a call.
+        self.assertEqual(self.proxy.calls, 0)
+
+
+class SnapshotCacheTest(TestCase):
+
+    def setUp(self):
+        self.version = 0
+        self.fetches = 0
+        self.cache = self.make_cache(self.fetch)
+
+    def make_cache(self, fetch):
+        return SnapshotCache(fetch)
+
+    def fetch(self):
+        self.fetches += 1
+        return {'version': self.version, 'interval': 0.05}
+
+    def test_cached_until_interval(self):
+        self.assertEqual(self.cache.get()['version'], 0)
+        self.version = 1
+        self.assertEqual(self.cache.get()['version'], 0)
+        self.assertEqual(self.fetches, 1)
+
+        time.sleep(0.06)
+        self.assertEqual(self.cache.get()['version'], 1)
+        self.assertEqual(self.fetches, 2)
+
+    def test_late_update_rechecked_soon(self):
+        self.cache.get()
+        time.sleep(0.06)
+        self.cache.get()
+        self.assertEqual(self.fetches, 2)
+
+        # The unchanged version is only trusted for a fraction of the
+        # interval.
+        self.version = 1
+        time.sleep(0.01)
+        self.assertEqual(self.cache.get()['version'], 1)
+
+    def test_expires_an_interval_after_sampling(self):
+        # Fetched most of an interval after the server sampled it, the
+        # snapshot is only cached until the next one is due.
+        sampled = time.time() - 0.04
+        cache = self.make_cache(lambda: {'version': self.version,
+                                         'interval': 0.05,
+                                         'timestamp': sampled})
+        cache.get()
+        self.version = 1
+        time.sleep(0.02)
+        self.assertEqual(cache.get()['version'], 1)
+        self.assertEqual(cache.fetches, 2)
+
+    def test_expiry(self):
+        now = 1000.0
+        snapshot = {'version': 1, 'interval': 5, 'timestamp': now - 4}
+        self.assertEqual(snapshot_expiry(snapshot, None, now), now + 1)
+
+        # Clocks that disagree cannot take it beyond an interval.
+        snapshot['timestamp'] = now + 60
+        self.assertEqual(snapshot_expiry(snapshot, None, now), now + 5)
+
+        # A late update is checked again soon.
+        snapshot['timestamp'] = now - 60
+        self.assertEqual(snapshot_expiry(snapshot, None, now), now)
+        self.assertEqual(snapshot_expiry(snapshot, snapshot, now), now + 0.5)
+        self.assertEqual(snapshot_expiry(None, None, now), now + 1)
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        def slow_fetch():
+            started.set()
+            release.wait()
+            return self.fetch()
+        self.cache = self.make_cache(slow_fetch)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                       self.cache.get())) for i in range(10)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        time.sleep(0.05)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(results, [{'version': 0, 'interval': 0.05}] * 10)
+
+    def test_failure_cached(self):
+        cache = self.make_cache(lambda: None)
+        self.assertEqual(cache.get(), None)
+        self.assertEqual(cache.get(), None)
+        self.assertEqual(cache.fetches, 1)
+
+
+def fork_workers(n, work):
+    '''Run a function in n child processes, and wait for them.
+
+    :returns: the number of processes in which it failed.'''
+    pids = []
+    for i in range(n):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                work()
+                status = 0
+            finally:
+                os._exit(status)
+        pids.append(pid)
+
+    failures = 0
+    for pid in pids:
+        if os.waitpid(pid, 0)[1] != 0:
+            failures += 1
+    return failures
+
+
+class FileSnapshotCacheTest(SnapshotCacheTest):
+    '''Runs the SnapshotCache tests against a FileSnapshotCache, as several
+    worker processes would share it.'''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'snapshot')
+        SnapshotCacheTest.setUp(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_cache(self, fetch):
+        return FileSnapshotCache(fetch, self.root)
+
+    def test_private_files(self):
+        self.cache.get()
+        self.cache._lock('.lock', 0)
+        for name in ('snapshot', 'snapshot.lock'):
+            mode = os.stat(os.path.join(self.root, name)).st_mode
+            self.assertEqual(mode & 0777, 0600)
+
+    def test_refuses_links(self):
+        target = os.path.join(self.root, 'target')
+        with open(target, 'w') as f:
+            f.write('x')
+        os.symlink(target, self.path + '.lock')
+        self.assertRaises(OSError, self.cache.get)
+        os.symlink(target, self.path)
+        self.assertRaises(OSError, self.cache.get)
+        with open(target) as f:
+            self.assertEqual(f.read(), 'x')
+
+    def test_refuses_shared_directory(self):
+        shared = os.path.join(self.root, 'shared')
+        os.mkdir(shared)
+        os.chmod(shared, 0777)
+        self.assertRaises(OSError, FileSnapshotCache, self.fetch, shared)
+        link = os.path.join(self.root, 'link')
+        os.symlink(self.root, link)
+        self.assertRaises(OSError, FileSnapshotCache, self.fetch, link)
+
+        directory = os.path.join(self.root, 'new')
+        FileSnapshotCache(self.fetch, directory)
+        self.assertEqual(os.stat(directory).st_mode & 0777, 0700)
+
+    def test_shared_between_workers(self):
+        self.cache.get()
+        other = self.make_cache(self.fetch)
+        self.assertEqual(other.get(), {'version': 0, 'interval': 0.05})
+        self.assertEqual((other.fetches, other.hits), (0, 1))
+
+        other.clear()
+        self.assertEqual(self.fetches, 1)
+        self.cache.get()
+        self.assertEqual(self.fetches, 2)
+
+    def test_one_fetch_for_many_processes(self):
+        log = os.path.join(self.root, 'fetches')
+        def fetch():
+            with open(log, 'a') as f:
+                f.write('x')
+            time.sleep(0.1)
+            return {'version': 1, 'interval': 5}
+
+        def work():
+            cache = self.make_cache(fetch)
+            for i in range(10):
+                cache.get()
+
+        self.assertEqual(fork_workers(8, work), 0)
+        with open(log) as f:
+            self.assertEqual(f.read(), 'x')
+
+    def test_one_wait_for_many_processes(self):
+        log = os.path.join(self.root, 'waits')
+        def wait(version, timeout):
+            with open(log, 'a') as f:
+                f.write('x')
+            time.sleep(0.2)
+            return {'version': version + 1, 'interval': 5}
+
+        def work():
+            cache = FileSnapshotCache(None, self.root, wait=wait)
+            assert cache.wait(None, 2)['version'] == 0
+
+        self.assertEqual(fork_workers(8, work), 0)
+        with open(log) as f:
+            self.assertEqual(f.read(), 'x')
+
+        # The snapshot received is cached for other requests.
+        cache = self.make_cache(self.fetch)
+        self.assertEqual(cache.get()['version'], 0)
+        self.assertEqual(cache.fetches, 0)
+
+
+class SnapshotFeedTest(TestCase):
+
+    def setUp(self):
+        self.version = 0
+        self.interval = 0.05
+        self.calls = []
+        self.release = threading.Event()
+
+    def wait(self, version, timeout):
+        self.calls.append(version)
+        self.release.wait(timeout)
+        return {'version': self.version, 'interval': self.interval}
+
+    def test_one_wait_for_many_requests(self):
+        feed = SnapshotFeed(self.wait)
+        self.release.set()
+        self.assertEqual(feed.next(None, 1)[0]['version'], 0)
+        self.release.clear()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                       feed.next(0, 1))) for i in range(10)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        self.version = 1
+        self.release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.calls, [-1, 0])
+        for snapshot, previous in results:
+            self.assertEqual(snapshot['version'], 1)
+            self.assertEqual(previous['version'], 0)
+
+    def test_timeout(self):
+        feed = SnapshotFeed(self.wait)
+        self.interval = 1.0
+        self.release.set()
+        feed.next(None, 1)
+
+        start = time.time()
+        snapshot, previous = feed.next(0, 0.2)
+        self.assertEqual(snapshot['version'], 0)
+        self.assertTrue(time.time() - start < 1)
+
+        # The server answered at once, so it was asked again only after a
+        # fraction of its interval.
+        self.assertTrue(len(self.calls) <= 4)
+
+    def test_server_unavailable(self):
+        feed = SnapshotFeed(lambda version, timeout: None)
+        self.assertEqual(feed.next(None, 0.1), (None, None))
+
+
+class TableCacheTest(TestCase):
+
+    def test_rendered_once_per_version(self):
+        cache = TableCache()
+        renders = []
+        def render(snapshot):
+            renders.append(snapshot)
+            return 'table %s' % snapshot['version']
+
+        v1 = {'version': 1, 'timestamp': 10.0}
+        v2 = {'version': 2, 'timestamp': 11.0}
+        self.assertEqual(cache.get('a', v1, render), 'table 1')
+        self.assertEqual(cache.get('a', v1, render), 'table 1')
+        self.assertEqual(cache.get('b', v1, render), 'table 1')
+        self.assertEqual(cache.get('a', v2, render), 'table 2')
+        self.assertEqual(len(renders), 3)
+
+
+class TableFormatTest(TestCase):
+
+    COLUMNS = [('time', 'datetime', 'Time'), ('label', 'string', 'Label'),
+               ('value', 'number', 'Value')]
+
+    ROWS = [
+        (datetime(2013, 1, 2, 3, 4, 5), 'Eth1', 10000000000),
+        (datetime(2013, 1, 2, 3, 4, 6, 250000), 'Eth0', 2.5),
+        (datetime(2013, 1, 2, 3, 4, 7), 'Eth"2\\', None),
+        (datetime(2013, 1, 2, 3, 4, 8), 3, 0),
+        ]
+
+    def gviz_json(self, rows, order_by=()):
+        ids = [c[0] for c in self.COLUMNS]
+        table = gviz_api.DataTable(dict((i, (t, l))
+                                        for i, t, l in self.COLUMNS))
+        table.LoadData([dict(zip(ids, row)) for row in rows])
+        return table.ToJSon(columns_order=ids, order_by=order_by)
+
+    def test_render(self):
+        body = json.loads(TableFormat(self.COLUMNS).render(self.ROWS))
+        self.assertEqual([c['id'] for c in body['cols']],
+                         ['time', 'label', 'value'])
+        self.assertEqual(body['rows'][0]['c'],
+                         [{'v': 'Date(2013,0,2,3,4,5)'}, {'v': 'Eth1'},
+                          {'v': 10000000000}])
+        self.assertEqual(body['rows'][1]['c'][0],
+                         {'v': 'Date(2013,0,2,3,4,6,250)'})
+        self.assertEqual(body['rows'][2]['c'][1:], [{'v': 'Eth"2\\'}, None])
+        self.assertEqual(body['rows'][3]['c'][1], {'v': '3'})
+
+    def test_order_by(self):
+        table_format = TableFormat(self.COLUMNS, order_by='label')
+        body = json.loads(table_format.render(self.ROWS[:2]))
+        self.assertEqual([row['c'][1]['v'] for row in body['rows']],
+                         ['Eth0', 'Eth1'])
+
+    def test_empty(self):
+        body = json.loads(TableFormat(self.COLUMNS).render([]))
+        self.assertEqual(body['rows'], [])
+
+    @skipIf(gviz_api is None, 'gviz_api is not installed')
+    def test_matches_gviz_api(self):
+        table_format = TableFormat(self.COLUMNS)
+        self.assertEqual(table_format.render(self.ROWS),
+                         self.gviz_json(self.ROWS))
+
+        table_format = TableFormat(self.COLUMNS, order_by='label')
+        rows = self.ROWS[:2]
+        self.assertEqual(table_format.render(rows),
+                         self.gviz_json(rows, 'label'))
+
+    @skipIf(gviz_api is None, 'gviz_api is not installed')
+    def test_non_finite_matches_gviz_api(self):
+        # NaN and infinities are written as JavaScript, as gviz_api does,
+        # whether the column is all floats, has empty cells, or mixes types.
+        when = datetime(2013, 1, 2, 3, 4, 5)
+        rows = [(when, 'nan', float('nan')), (when, 'inf', float('inf')),
+                (when, '-inf', float('-inf')), (when, 'none', None),
+                (when, 'int', 1)]
+        ids = [c[0] for c in self.COLUMNS]
+
+        for cells in (rows[:3], rows[:4], rows[:3] + rows[4:]):
+            table = gviz_api.DataTable(dict((i, (t, l))
+                                            for i, t, l in self.COLUMNS))
+            table.LoadData([dict(zip(ids, row)) for row in cells])
+            response = views.GVIZ_RESPONSE % (
+                TableFormat(self.COLUMNS).render(cells), json.dumps('3'))
+            self.assertEqual(response,
+                             table.ToJSonResponse(columns_order=ids,
+                                                  req_id=3))
+
+
+class KeepAliveHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+
+class ThreadedServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class ClientPoolTest(TestCase):
+
+    def setUp(self):
+        self.server = ThreadedServer(('localhost', 0), KeepAliveHandler,
+                                     logRequests=False)
+        self.server.register_function(lambda x: x * 2, 'double')
+        self.server.register_function(lambda: 1 / 0, 'fail')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.pool = ClientPool('http://%s:%d/' % self.server.server_address,
+                               2, max_idle=4)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_reuses_connection(self):
+        proxy = self.pool.proxy()
+        for i in range(10):
+            self.assertEqual(proxy.double(i), i * 2)
+
+        self.assertEqual(self.pool.stats(),
+                         {'hits': 9, 'misses': 1, 'idle': 1,
+                          'transport': 'xmlrpc'})
+
+    def test_fault_keeps_connection(self):
+        proxy = self.pool.proxy()
+        self.assertRaises(xmlrpclib.Fault, proxy.fail)
+        self.assertEqual(proxy.double(1), 2)
+        self.assertEqual(self.pool.stats()['hits'], 1)
+
+    def test_concurrent_callers(self):
+        errors = []
+        def caller():
+            proxy = self.pool.proxy()
+            for i in range(20):
+                if proxy.double(i) != i * 2:
+                    errors.append(i)
+
+        threads = [threading.Thread(target=caller) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stats = self.pool.stats()
+        self.assertEqual(errors, [])
+        self.assertEqual(stats['hits'] + stats['misses'], 160)
+        self.assertTrue(stats['hits'] > 0)
+        self.assertTrue(stats['idle'] <= 4)
+
+    def test_unavailable_server(self):
+        self.pool = ClientPool('http://localhost:1/', 2)
+        self.assertRaises(Exception, self.pool.proxy().double, 1)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+
+BINARY_SNAPSHOT = {
+    'version': 7,
+    'ids': ['0', '1'],
+    'ids_version': 1,
+    'width': 3,
+    'interfaces': Packed('Q', [0, 2**64 - 1, 5, 1, 10, 20]),
+    'ethernet': Packed('d', [1.5, 0.0]),
+    'rates': Packed('d', [1.0, 2.0, float('nan'), float('nan')]),
+    'capture': 1.5,
+    }
+
+
+class BinaryHandler(KeepAliveHandler):
+    '''Answers binary requests as the StatsServer does.'''
+
+    def do_POST(self):
+        if self.path != BINARY_PATH:
+            KeepAliveHandler.do_POST(self)
+            return
+
+        method, params = unpack(
+            self.rfile.read(int(self.headers['content-length'])))
+        if method == 'snapshot':
+            response = {'result': BINARY_SNAPSHOT}
+        elif method == 'double':
+            response = {'result': params[0] * 2}
+        else:
+            response = {'fault': [1, 'unknown method %s' % method]}
+
+        body = pack(response)
+        self.send_response(200)
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BinaryClientPoolTest(TestCase):
+
+    def setUp(self):
+        self.server = ThreadedServer(('localhost', 0), BinaryHandler,
+                                     logRequests=False)
+        self.server.register_function(lambda: {'binary': BINARY_PATH},
+                                      'transports')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.pool = ClientPool('http://%s:%d/' % self.server.server_address,
+                               2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_binary_calls(self):
+        proxy = self.pool.proxy()
+        for i in range(5):
+            self.assertEqual(proxy.double(i), i * 2)
+        self.assertRaises(xmlrpclib.Fault, proxy.fail)
+        self.assertEqual(proxy.double(1), 2)
+        self.assertEqual(self.pool.stats(),
+                         {'hits': 6, 'misses': 1, 'idle': 1,
+                          'transport': 'binary'})
+
+    def test_snapshot(self):
+        snapshot = self.pool.proxy().snapshot()
+        self.assertEqual(snapshot['interfaces'],
+                         {'0': (0, 2**64 - 1, 5), '1': (1, 10, 20)})
+        self.assertEqual(snapshot['rates'], {'0': (1.0, 2.0)})
+        self.assertEqual(snapshot['ethernet'], {'0': 1.5})
+        self.assertEqual(snapshot['capture'], 1.5)
+        self.assertFalse(snapshot.has_key('width'))
+
+    def test_xmlrpc_only(self):
+        pool = ClientPool('http://%s:%d/' % self.server.server_address, 2,
+                          binary=False)
+        self.assertEqual(pool.proxy().transports(), {'binary': BINARY_PATH})
+        self.assertEqual(pool.stats()['transport'], 'xmlrpc')
+        pool.close()
+
+
+class ServerCodecTest(TestCase):
+
+    def test_round_trip(self):
+        # A snapshot encoded by the StatsServer decodes here to the struct
+        # it returns over XML RPC.
+        from StatsServer import InterfaceStats, StatsServer
+        server = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                             retention=10)
+        try:
+            for t in range(2):
+                interfaces = dict((str(i), InterfaceStats(
+                    i, byte_count=2**64 - 1 - 1000*(1 - t)*i,
+                    packet_count=t*i)) for i in range(3))
+                server._update_statistics('', interfaces, 1000.0 + t)
+            interfaces = {'3': InterfaceStats(3, byte_count=1)}
+            server._update_statistics('b', interfaces, 1001.5)
+
+            snapshot = server._snapshot
+            expected = snapshot.as_struct()
+            decoded = snapshot_struct(unpack(
+                pack(snapshot.as_binary())))
+        finally:
+            server.quit()
+            server.server_close()
+
+        interfaces = decoded.pop('interfaces')
+        self.assertEqual(dict((k, [str(x) for x in v])
+                              for k, v in interfaces.iteritems()),
+                         expected.pop('interfaces'))
+        self.assertEqual(interfaces['1'][1], 2**64 - 1)
+        self.assertEqual(dict((k, list(v))
+                              for k, v in decoded.pop('rates').iteritems()),
+                         expected.pop('rates'))
+        self.assertEqual(sorted(decoded['ethernet'].keys()), ['0', '1', '2'])
+        self.assertEqual(decoded, expected)
+
+
+def write_shared(path, value, sequence, timestamp=None, interval=5,
+    length=None):
+    '''Write a snapshot to a file as a StatsServer publishes it.'''
+    data = pack(value)
+    if timestamp is None:
+        timestamp = time.time()
+    if length is None:
+        length = len(data)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<4sIQQdd', 'VDSS', 1, sequence, length,
+                            timestamp, interval).ljust(HEADER_SIZE, '\0'))
+        f.write(data)
+
+
+class SharedReaderTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'shared')
+        self.reader = SharedReader(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_absent(self):
+        self.assertEqual(self.reader.read(), None)
+        with open(self.path, 'wb') as f:
+            f.write('not a snapshot')
+        self.assertEqual(self.reader.read(), None)
+
+    def test_read(self):
+        write_shared(self.path, BINARY_SNAPSHOT, 2)
+        snapshot = self.reader.read()
+        self.assertEqual(snapshot['version'], 7)
+        self.assertEqual(snapshot['interfaces']['1'], (1, 10, 20))
+        self.assertEqual(snapshot['rates'], {'0': (1.0, 2.0)})
+
+        # An unchanged snapshot is only decoded once.
+        self.assertTrue(self.reader.read() is snapshot)
+        self.assertEqual(self.reader.reads, 1)
+
+    def test_not_private(self):
+        write_shared(self.path, BINARY_SNAPSHOT, 2)
+        os.chmod(self.path, 0666)
+        self.assertEqual(self.reader.read(), None)
+
+        os.chmod(self.path, 0600)
+        link = os.path.join(self.root, 'link')
+        os.symlink(self.path, link)
+        self.assertEqual(SharedReader(link).read(), None)
+
+        # A file another user owns.
+        getuid = os.getuid
+        os.getuid = lambda: getuid() + 1
+        try:
+            self.assertEqual(self.reader.read(), None)
+        finally:
+            os.getuid = getuid
+        self.assertEqual(self.reader.read()['version'], 7)
+
+    def test_inconsistent(self):
+        # A snapshot being written is retried, then given up on.
+        write_shared(self.path, BINARY_SNAPSHOT, 3)
+        self.assertEqual(self.reader.read(), None)
+        self.assertEqual(self.reader.retries, READ_ATTEMPTS)
+
+        # As is one longer than the file.
+        write_shared(self.path, BINARY_SNAPSHOT, 4, length=1 << 20)
+        self.assertEqual(self.reader.read(), None)
+
+        write_shared(self.path, BINARY_SNAPSHOT, 6)
+        self.assertEqual(self.reader.read()['version'], 7)
+
+    def test_replaced(self):
+        write_shared(self.path, BINARY_SNAPSHOT, 2)
+        self.reader.read()
+
+        # A new file with the same sequence is read afresh.
+        os.unlink(self.path)
+        write_shared(self.path, dict(BINARY_SNAPSHOT, version=9), 2)
+        self.assertEqual(self.reader.read()['version'], 9)
+
+    def test_stale(self):
+        clock = [1000.0]
+        monotonic = shared.monotonic
+        shared.monotonic = lambda: clock[0]
+        try:
+            # The time in the header is the server's, and is not compared
+            # with the reader's clock.
+            write_shared(self.path, BINARY_SNAPSHOT, 2, time.time() - 3600)
+            self.assertEqual(self.reader.read()['version'], 7)
+
+            # The sequence not changing for several intervals is.
+            clock[0] += 14
+            self.assertEqual(self.reader.read()['version'], 7)
+            clock[0] += 2
+            self.assertEqual(self.reader.read(), None)
+
+            write_shared(self.path, BINARY_SNAPSHOT, 4, time.time() + 3600)
+            self.assertEqual(self.reader.read()['version'], 7)
+        finally:
+            shared.monotonic = monotonic
+
+    def test_wait(self):
+        write_shared(self.path, BINARY_SNAPSHOT, 2)
+
+        def publish():
+            time.sleep(0.1)
+            write_shared(self.path + '.new', dict(BINARY_SNAPSHOT,
+                                                  version=4), 4)
+            os.rename(self.path + '.new', self.path)
+
+        thread = threading.Thread(target=publish)
+        thread.start()
+        self.assertEqual(self.reader.wait(7, 5)['version'], 4)
+        thread.join()
+
+        start = time.time()
+        self.assertEqual(self.reader.wait(4, 0.1)['version'], 4)
+        self.assertTrue(time.time() - start >= 0.1)
+
+
 class SimpleTest(TestCase):
     def test_basic_addition(self):
         """
@@ -11,148 +11,403 @@
 #       * interface
 #       * ethernet
 #       * capture
+#       * history
+#       * stream
+#       * pool
 #
 #   Which then call out to the XML RPC server via a ServerProxy to obtain data
-#   from the Data Acquisition System.
+#   from the Data Acquisition System. Each resource makes a single snapshot()
+#   call, so that all of its data comes from the same polling cycle. Calls
+#   go through a pool of persistent connections; the pool resource reports
+#   how often they are reused. Snapshots are cached until the StatsServer's
+#   next poll is due and each table is rendered once per snapshot, so the
+#   cost of serving a dashboard does not grow with the number of viewers.
+#
+#   The interfaces shown are those the StatsServer has discovered, listed in
+#   each snapshot, so the tables and gauges follow the acquisition systems'
+#   ports without configuration.
+#
+#   The stream resource is a long-poll: it answers once the StatsServer
+#   publishes a snapshot newer than the one the dashboard has, with only what
+#   changed. All waiting dashboards share one wait() call to the server.
+#
+#   Worker processes share the cached snapshot through a file (see
+#   stats.cache), so that however many workers serve the monitor, one
+#   fetches each snapshot and one waits on the server for the next.
+#
+#   When the StatsServer runs on the same host and publishes its snapshots
+#   to shared memory (see stats.shared), snapshots are read from there
+#   instead, without a call to the server. Requests fall back to RPC while
+#   no snapshot is published there.
 #------------------------------------------------------------------------------
 
-import gviz_api
+import json
+import os
 import re
 import random
-import socket
+import tempfile
 import time
+from datetime import datetime
 
 from django.conf import settings
 from django.db import connection
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from xml.dom.minidom import Document
-from xmlrpclib import ServerProxy
 from xml.etree.ElementTree import fromstring
 
+from stats.cache import (FileSnapshotCache, SnapshotCache, SnapshotFeed,
+                         TableCache)
+from stats.client import ClientPool
+from stats.gviz import TableFormat
+from stats.shared import SharedReader
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 #------------------------------------------------------------------------------
 # Globals
 #------------------------------------------------------------------------------
 SOCKET_TIMEOUT = 2
-NUM_INTERFACES = 4
+STATS_SERVER_URI = 'http://localhost:9000/'
+
+# File to which a StatsServer on this host publishes its snapshots (-m).
+STATS_SHARED_PATH = '/dev/shm/statsserver'
+
+# Directory in which worker processes share the latest snapshot, by default
+# one per user in the temporary directory.
+SNAPSHOT_CACHE_DIR = getattr(settings, 'STATS_CACHE_DIR', None) or \
+    os.path.join(tempfile.gettempdir(), 'statsmonitor-%d' % os.getuid())
+
+# Time window (s) of the history chart, and the number of points in it.
+HISTORY_WINDOW = 600
+HISTORY_POINTS = 120
+
+# Longest time (s) a stream request waits for a new snapshot.
+STREAM_TIMEOUT = 25
+
+# Connections to the XML RPC server, shared by all requests. Streaming
+# waits on the server for longer than other calls, one at a time.
+POOL = ClientPool(STATS_SERVER_URI, SOCKET_TIMEOUT)
+STREAM_POOL = ClientPool(STATS_SERVER_URI, STREAM_TIMEOUT + SOCKET_TIMEOUT,
+                         max_idle=1)
+
+# Snapshots published to shared memory, read in preference to the pool.
+SHARED = SharedReader(STATS_SHARED_PATH)
 
 def get_proxy():
     # Connect to XML RPC server.
-    proxy = None
+    return POOL.proxy()
+
+
+def get_stream_proxy():
+    return STREAM_POOL.proxy()
+
+
+def get_snapshot():
+    '''Retrieve all statistics from one StatsServer update.
+
+    :returns: the snapshot struct, or None if it could not be retrieved.'''
+    snapshot = SHARED.read()
+    if snapshot is not None:
+        return snapshot
+
     try:
-        proxy = ServerProxy('http://localhost:9000/')
-        socket.setdefaulttimeout(SOCKET_TIMEOUT)
+        return get_proxy().snapshot()
     except Exception, e:
-        print 'Connect timeout: %s'%e
+        print 'Data timeout: %s'%e
 
-    return proxy
+    return None
 
-#------------------------------------------------------------------------------
-# Resources
-#------------------------------------------------------------------------------
-def interface(request):
-    '''Resource for interface data.'''
 
-    proxy = get_proxy()
-
-    # Describe data.
-    description = {
-        'interface': ('string', 'Interface'),
-        'byteCount': ('number', 'byteCount'),
-        'bytesDropped': ('number', 'bytesDropped'),
-        'packetCount': ('number', 'packetCount'),
-        'packetsDropped': ('number', 'packetsDropped'),
-        'errorCount': ('number', 'errorCount'),
-        }
-
-    # Retrieve data
-    data = []
-    labels = [ 'interface', 'byteCount', 'bytesDropped', 'packetCount',
-               'packetsDropped', 'errorCount' ]
+def wait_snapshot(version, timeout):
+    '''Wait for a snapshot whose version differs from a given one.
+
+    :returns: the snapshot struct, or None if it could not be retrieved.'''
+    snapshot = SHARED.wait(version, timeout)
+    if snapshot is not None:
+        return snapshot
+
     try:
-        for i in range(NUM_INTERFACES):
-            data.append(dict(zip(labels,
-                                 [int(x) for x in proxy.interface(str(i))])))
+        return get_stream_proxy().wait(version, timeout)
     except Exception, e:
         print 'Data timeout: %s'%e
-        for i in range(NUM_INTERFACES):
-            data.append(dict(zip(labels, [0 for x in range(len(labels))])))
 
-    # Package data as data table.
-    data_table = gviz_api.DataTable(description)
-    data_table.LoadData(data)
+    return None
 
-    # Convert to json and return.
-    req_id = request.GET['tqx'].split(':')[1]
-    json = data_table.ToJSonResponse(columns_order=labels, req_id=req_id)
-    return HttpResponse(str(json), mimetype='text/plain')
 
+# The latest snapshot, shared by the worker processes through a
+# FileSnapshotCache in SNAPSHOT_CACHE_DIR. FEED, a SnapshotFeed, delivers
+# each new snapshot to the streaming dashboards of a process, and through
+# the FileSnapshotCache only one worker at a time waits on the StatsServer
+# for it. Without file locking or a private directory, each worker process
+# fetches and waits for its own snapshots with a SnapshotCache.
+SNAPSHOTS = None
+if fcntl is not None:
+    try:
+        SNAPSHOTS = FileSnapshotCache(lambda: get_snapshot(),
+            SNAPSHOT_CACHE_DIR, SOCKET_TIMEOUT,
+            lambda version, timeout: wait_snapshot(version, timeout))
+        FEED = SnapshotFeed(SNAPSHOTS.wait)
+    except OSError, e:
+        print 'Snapshots not shared between workers: %s'%e
+if SNAPSHOTS is None:
+    SNAPSHOTS = SnapshotCache(lambda: get_snapshot(), SOCKET_TIMEOUT)
+    FEED = SnapshotFeed(lambda version, timeout: wait_snapshot(version,
+                                                               timeout))
 
-def ethernet(request):
-    '''Resource for ethernet data.'''
+# The data tables, and the streaming updates, rendered from each snapshot
+# and shared by all requests. Only the gviz response wrapper is produced per
+# request.
+TABLES = TableCache()
+UPDATES = TableCache()
+
+# Snapshot entries keyed by interface or target.
+SNAPSHOT_MAPS = ('interfaces', 'ethernet', 'rates', 'targets', 'sampled')
+
+# Google Visualization response with the table JSON and quoted reqId.
+GVIZ_RESPONSE = ('google.visualization.Query.setResponse('
+                 '{"status":"ok","table":%s,"reqId":%s,"version":"0.6"});')
+
+#------------------------------------------------------------------------------
+# Tables
+#------------------------------------------------------------------------------
+
+# Layouts of the tables, compiled once.
+INTERFACE_FORMAT = TableFormat([
+    ('interface', 'string', 'Interface'),
+    ('byteCount', 'number', 'byteCount'),
+    ('bytesDropped', 'number', 'bytesDropped'),
+    ('packetCount', 'number', 'packetCount'),
+    ('packetsDropped', 'number', 'packetsDropped'),
+    ('errorCount', 'number', 'errorCount'),
+    ])
+GAUGE_COLUMNS = [('label', 'string', 'Label'), ('value', 'number', 'Value')]
+ETHERNET_FORMAT = TableFormat(GAUGE_COLUMNS)
+CAPTURE_FORMAT = TableFormat(GAUGE_COLUMNS)
 
-    proxy = get_proxy()
+# History table layouts, by interface ids. Only a few are kept, as the
+# interfaces rarely change.
+HISTORY_FORMATS = dict()
+MAX_HISTORY_FORMATS = 8
 
-    description = {
-        'label': ('string', 'Label'),
-        'value': ('number', 'Value'),
-        }
 
-    data = None
+def _id_key(id_):
+    '''Sort key ordering interface ids by target, then interface number.'''
+    target, _, number = id_.rpartition(':')
     try:
-        data = [
-            {'label': 'Eth0', 'value': proxy.ethernet('0'), },
-            {'label': 'Eth1', 'value': proxy.ethernet('1'), },
-            {'label': 'Eth2', 'value': proxy.ethernet('2'), },
-            {'label': 'Eth3', 'value': proxy.ethernet('3'), },
-            ]
-    except Exception, e:
-        print 'ETHERNET: %s'%e
-        data = [
-            {'label': 'Eth0', 'value': 0, },
-            {'label': 'Eth1', 'value': 0, },
-            {'label': 'Eth2', 'value': 0, },
-            {'label': 'Eth3', 'value': 0, },
-            ]
-
-    # Package data in data table.
-    data_table = gviz_api.DataTable(description)
-    data_table.LoadData(data)
-
-    # Convert to json and return.
+        return target, int(number)
+    except ValueError:
+        return target, number
+
+
+def snapshot_ids(snapshot):
+    '''Return the interface ids of a snapshot, in display order.'''
+    if snapshot is None:
+        return []
+
+    ids = snapshot.get('ids')
+    if ids is None:
+        # The server does not list its interfaces; order those it reports.
+        ids = sorted(snapshot['interfaces'].keys(), key=_id_key)
+
+    return ids
+
+
+def interface_label(id_):
+    '''Return the display label of an interface, e.g. Eth3 or das1:Eth3.'''
+    target, _, number = id_.rpartition(':')
+    if target:
+        return '%s:Eth%s' % (target, number)
+
+    return 'Eth' + number
+
+
+def interface_table(snapshot):
+    '''Render the interface data table as JSON.'''
+
+    interfaces = dict()
+    if snapshot is not None:
+        interfaces = snapshot['interfaces']
+
+    rows = []
+    zeros = [0]*(len(INTERFACE_FORMAT.ids) - 1)
+    for id_ in snapshot_ids(snapshot):
+        values = interfaces.get(id_)
+        if values is None:
+            rows.append([id_] + zeros)
+        else:
+            rows.append([id_] + map(int, values[1:]))
+
+    return INTERFACE_FORMAT.render(rows)
+
+
+def ethernet_table(snapshot):
+    '''Render the ethernet data table as JSON.'''
+
+    rates = dict()
+    if snapshot is not None:
+        rates = snapshot['ethernet']
+
+    return ETHERNET_FORMAT.render([(interface_label(id_), rates.get(id_, 0))
+                                   for id_ in snapshot_ids(snapshot)])
+
+
+def capture_table(snapshot):
+    '''Render the capture data table as JSON.'''
+
+    value = 0
+    if snapshot is not None:
+        value = snapshot['capture']
+
+    return CAPTURE_FORMAT.render([('Capture', value)])
+
+
+def history_table(snapshot):
+    '''Render the interface rate history data table as JSON.'''
+
+    ids = snapshot_ids(snapshot)
+
+    # Retrieve the average rate in each bucket of the window.
+    history = {'fields': [], 'interfaces': {}, }
+    if ids:
+        try:
+            history = get_proxy().history(ids, -HISTORY_WINDOW, 0,
+                                          HISTORY_POINTS)
+        except Exception, e:
+            print 'Data timeout: %s'%e
+
+    rows = dict()
+    if 'byte_rate' in history['fields']:
+        field = history['fields'].index('byte_rate')
+        for column, id_ in enumerate(ids):
+            for row in history['interfaces'].get(id_, []):
+                if not rows.has_key(row[0]):
+                    rows[row[0]] = [datetime.fromtimestamp(row[0])] + \
+                        [None]*len(ids)
+                rows[row[0]][column + 1] = round(
+                    row[4][field]*8/1000000000.0, 2)
+
+    # There is a column for each interface, with the interface id.
+    key = tuple(ids)
+    table_format = HISTORY_FORMATS.get(key)
+    if table_format is None:
+        if len(HISTORY_FORMATS) >= MAX_HISTORY_FORMATS:
+            HISTORY_FORMATS.clear()
+        table_format = TableFormat([('time', 'datetime', 'Time')] +
+            [(id_, 'number', interface_label(id_)) for id_ in ids])
+        HISTORY_FORMATS[key] = table_format
+
+    return table_format.render([rows[t] for t in sorted(rows.keys())])
+
+
+def snapshot_delta(previous, snapshot):
+    '''Return the changes from one snapshot to the next.
+
+    :returns: a dict with the scalar entries of the snapshot, 'base' set to
+        the previous version, the changed or added items of each entry in
+        SNAPSHOT_MAPS, and 'removed' giving the keys no longer present in
+        each of them. The interface ids are only included when they have
+        changed.'''
+    delta = dict((k, v) for k, v in snapshot.iteritems()
+                 if k not in SNAPSHOT_MAPS and k != 'ids')
+    if previous.get('ids_version') != snapshot.get('ids_version'):
+        delta['ids'] = snapshot.get('ids')
+    delta['base'] = previous['version']
+    delta['removed'] = dict()
+
+    for name in SNAPSHOT_MAPS:
+        old = previous.get(name, {})
+        new = snapshot.get(name, {})
+        delta[name] = dict((k, v) for k, v in new.iteritems()
+                           if old.get(k) != v)
+        removed = [k for k in old if not new.has_key(k)]
+        if removed:
+            delta['removed'][name] = removed
+
+    return delta
+
+
+def table_response(request, name, render):
+    '''Respond with a cached data table wrapped for the requesting query.
+
+    :param request: the gviz query request.
+    :param name: the resource name.
+    :param render: callable rendering the table from a snapshot.'''
+    table = TABLES.get(name, SNAPSHOTS.get(), render)
+
     req_id = request.GET['tqx'].split(':')[1]
-    json = data_table.ToJSonResponse(columns_order=('label', 'value'),
-                                     order_by="label", req_id=req_id)
-    return HttpResponse(str(json), mimetype='text/plain')
+    response = GVIZ_RESPONSE % (table, json.dumps(req_id))
+    return HttpResponse(response, mimetype='text/plain')
+
+#------------------------------------------------------------------------------
+# Resources
+#------------------------------------------------------------------------------
+def interface(request):
+    '''Resource for interface data.'''
+
+    return table_response(request, 'interface', interface_table)
+
+
+def ethernet(request):
+    '''Resource for ethernet data.'''
+
+    return table_response(request, 'ethernet', ethernet_table)
 
 
 def capture(request):
     '''Resource for capture data.'''
 
-    proxy = get_proxy()
+    return table_response(request, 'capture', capture_table)
+
+
+def history(request):
+    '''Resource for interface rate history.'''
+
+    return table_response(request, 'history', history_table)
+
+
+def stream(request):
+    '''Resource for snapshot updates, by long-poll.
 
-    description = {
-        'label': ('string', 'Label'),
-        'value': ('number', 'Value'),
-        }
+    The version parameter gives the version of the caller's latest
+    snapshot. The response is sent once a newer one is published: the
+    changes from the caller's version when it is the previous one (see
+    snapshot_delta()), otherwise the whole snapshot with 'base' set to null.
+    After STREAM_TIMEOUT without a new snapshot, the response has only the
+    unchanged version and base, and the caller should ask again.'''
 
-    # Retrieve statistics.
-    data = None
+    version = None
     try:
-        data = [
-            {'label': 'Capture', 'value': proxy.capture(), },
-            ]
-    except Exception, e:
-        data = [
-            {'label': 'Capture', 'value': 0, },
-            ]
+        version = int(request.GET['version'])
+    except (KeyError, ValueError):
+        pass
 
-    # Package as data table.
-    data_table = gviz_api.DataTable(description)
-    data_table.LoadData(data)
+    snapshot, previous = FEED.next(version, STREAM_TIMEOUT)
+    if snapshot is None:
+        body = 'null'
+    elif snapshot['version'] == version:
+        body = json.dumps({'version': version, 'base': version, })
+    elif previous is not None and previous['version'] == version:
+        body = UPDATES.get('delta', snapshot,
+            lambda s: json.dumps(snapshot_delta(previous, s)))
+    else:
+        body = UPDATES.get('full', snapshot,
+            lambda s: json.dumps(dict(s, base=None)))
 
-    # Package as json and return.
-    req_id = request.GET['tqx'].split(':')[1]
-    json = data_table.ToJSonResponse(columns_order=('label', 'value'),
-                                     order_by="label", req_id=req_id)
-    return HttpResponse(str(json), mimetype='text/plain')
+    return HttpResponse(body, mimetype='application/json')
+
+
+def pool(request):
+    '''Resource for XML RPC connection pool, shared memory and cache
+    counters.'''
+
+    stats = POOL.stats()
+    stats['snapshot_fetches'] = SNAPSHOTS.fetches
+    stats['snapshot_hits'] = SNAPSHOTS.hits
+    stats['stream_fetches'] = FEED.fetches
+    stats['shared_reads'] = SHARED.reads
+    stats['shared_retries'] = SHARED.retries
+    return HttpResponse(json.dumps(stats), mimetype='text/plain')
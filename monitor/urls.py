@@ -18,6 +18,9 @@ urlpatterns = patterns('',
     (r'^stats/interface/$', 'stats.views.interface'),
     (r'^stats/ethernet/$', 'stats.views.ethernet'),
     (r'^stats/capture/$', 'stats.views.capture'),
+    (r'^stats/history/$', 'stats.views.history'),
+    (r'^stats/stream/$', 'stats.views.stream'),
+    (r'^stats/pool/$', 'stats.views.pool'),
     (r'^media/(?P<path>.*)$', 'django.views.static.serve',
         {'document_root' : settings.MEDIA_ROOT, 'show_indexes': True })
 )
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Stand-in data acquisition system, for testing and benchmarking the
+#   StatsServer end to end on one machine. It listens on TCP and answers
+#   each get stats command with a response generated by FakeData, like the
+#   real system's XML interface.
+#
+#   Faults can be injected into each response:
+#
+#       latency, jitter: the response is delayed by latency plus a uniformly
+#           random time of up to jitter seconds.
+#       fragment: the response is written in pieces of this many bytes.
+#       rate: the response is written no faster than this many bytes per
+#           second, as over a slow or congested link.
+#       disconnect: the chance that the connection is dropped part way
+#           through a response.
+#
+#   To serve 64 interfaces on the StatsServer's default logger port with
+#   a 100 ms delay and fragmented responses, use:
+#
+#       $ python FakeDas.py -n 64 -L 0.1 -f 1000
+#------------------------------------------------------------------------------
+
+import getopt
+import random
+import socket
+import sys
+import time
+from threading import Lock, Thread
+from SocketServer import BaseRequestHandler, TCPServer, ThreadingMixIn
+
+from StatsSimulation import PROFILES, FakeData
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Tag ending each command.
+COMMAND_END_TAG = '</x3c_cmd>'
+
+# Command name answered with statistics.
+GET_STATS = '<cmdName>get stats</cmdName>'
+
+# Response to any other command.
+ERROR_RESPONSE = ('<cmd_resp><cmd_name>unknown</cmd_name><retVal>1</retVal>'
+                  '<reason>unknown command</reason></cmd_resp>')
+
+# Longest command accepted (bytes).
+MAX_COMMAND = 65536
+
+# Time (s) within which a background server notices close().
+SHUTDOWN_POLL = 0.05
+
+
+class FakeDasHandler(BaseRequestHandler):
+    '''Answer the commands received over one connection.'''
+
+
+    def handle(self):
+        das = self.server
+        das.count('connections')
+
+        data = ''
+        responses = 0
+        while True:
+            try:
+                received = self.request.recv(4096)
+            except socket.error:
+                return
+            if not received:
+                return
+
+            data += received
+            while True:
+                end = data.find(COMMAND_END_TAG)
+                if end < 0:
+                    break
+
+                end += len(COMMAND_END_TAG)
+                command, data = data[:end], data[end:]
+                if das.close_after is not None and \
+                   responses >= das.close_after:
+                    return
+                if not das.answer(self.request, command):
+                    return
+                responses += 1
+
+            if len(data) > MAX_COMMAND:
+                return
+
+
+class FakeDas(ThreadingMixIn, TCPServer):
+    '''A TCP server answering get stats commands with fake data.'''
+
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('localhost', 0), fake=None, latency=0.0,
+        jitter=0.0, fragment=0, rate=0, disconnect=0.0, close_after=None,
+        respond=True, seed=None):
+        '''Constructor.
+
+        :param address: the (<host>, <port>) to listen on.
+        :param fake: the FakeData to generate responses with, shared by all
+            connections.
+        :param latency: time (s) before each response.
+        :param jitter: maximum random time (s) added to the latency.
+        :param fragment: size (bytes) of each write, or 0 to write each
+            response at once.
+        :param rate: maximum bytes per second written, or 0 for no limit.
+        :param disconnect: chance of dropping the connection during each
+            response.
+        :param close_after: number of responses after which each connection
+            is closed, or None.
+        :param respond: whether to respond to commands at all.
+        :param seed: seed for the injected faults, or None.'''
+        TCPServer.__init__(self, address, FakeDasHandler)
+        self.address = self.server_address
+
+        if fake is None:
+            fake = FakeData()
+        self.fake = fake
+        self.latency = latency
+        self.jitter = jitter
+        self.fragment = fragment
+        self.rate = rate
+        self.disconnect = disconnect
+        self.close_after = close_after
+        self.respond = respond
+
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._thread = None
+
+        # Counts of connections, commands, responses and dropped connections.
+        self.connections = 0
+        self.commands = 0
+        self.responses = 0
+        self.disconnects = 0
+
+    def start(self):
+        '''Serve connections in a background thread.'''
+        self._thread = Thread(target=self.serve_forever,
+                              args=(SHUTDOWN_POLL,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        '''Stop serving, and close the listening socket.'''
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def count(self, name):
+        '''Increment one of the counters.'''
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def answer(self, sock, command):
+        '''Answer a command.
+
+        :param sock: the connection the command was received on.
+        :param command: the command.
+        :returns: whether the connection should be kept open.'''
+        self.count('commands')
+        if not self.respond:
+            return True
+
+        with self._lock:
+            if GET_STATS in command:
+                response = str(self.fake)
+            else:
+                response = ERROR_RESPONSE
+
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            cut = None
+            if self._random.random() < self.disconnect:
+                cut = self._random.randint(0, len(response) - 1)
+
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            if cut is not None:
+                self._write(sock, response[:cut])
+                self.count('disconnects')
+                return False
+
+            self._write(sock, response)
+        except socket.error:
+            return False
+
+        self.count('responses')
+        return True
+
+    def _write(self, sock, data):
+        '''Write data in fragments, no faster than the rate limit.'''
+        size = self.fragment or len(data)
+        if self.rate:
+            size = min(size, max(1, self.rate/10))
+
+        start = time.time()
+        for offset in xrange(0, len(data), size):
+            if self.rate:
+                due = start + float(offset)/self.rate
+                if due > time.time():
+                    time.sleep(due - time.time())
+            sock.sendall(data[offset:offset + size])
+
+
+def usage():
+    print '''
+usage: FakeDas -b <bind port>
+               -n <number of interfaces>
+               -P <traffic profile: %s>
+               -i <simulated time between polls(s)>
+               -L <latency(s)>
+               -j <latency jitter(s)>
+               -f <fragment size(bytes)>
+               -s <write rate(bytes/s)>
+               -D <chance of disconnecting during a response>
+               -h   print this message.
+''' % ', '.join(sorted(PROFILES.keys()))
+
+#------------------------------------------------------------------------------
+# Main program
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    BIND_PORT = 6050
+    NUM_INTERFACES = 4
+    PROFILE = 'steady'
+    INTERVAL = 5.0
+    LATENCY = 0.0
+    JITTER = 0.0
+    FRAGMENT = 0
+    RATE = 0
+    DISCONNECT = 0.0
+
+    # Parse command line options.
+    OPTIONS = 'b:n:P:i:L:j:f:s:D:h'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], OPTIONS)
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-b':
+            BIND_PORT = int(a)
+        elif o == '-n':
+            NUM_INTERFACES = int(a)
+        elif o == '-P':
+            if not PROFILES.has_key(a):
+                print 'Unknown traffic profile: %s' % a
+                usage()
+                sys.exit(2)
+            PROFILE = a
+        elif o == '-i':
+            INTERVAL = float(a)
+        elif o == '-L':
+            LATENCY = float(a)
+        elif o == '-j':
+            JITTER = float(a)
+        elif o == '-f':
+            FRAGMENT = int(a)
+        elif o == '-s':
+            RATE = int(a)
+        elif o == '-D':
+            DISCONNECT = float(a)
+        elif o == '-h':
+            usage()
+            sys.exit(2)
+        else:
+            usage()
+            assert False, 'Unhandled option: %s'%str(o)
+
+    das = FakeDas(('', BIND_PORT), FakeData(NUM_INTERFACES, PROFILE, INTERVAL),
+                  LATENCY, JITTER, FRAGMENT, RATE, DISCONNECT)
+    print '** Serving %d interfaces on port %d' % (NUM_INTERFACES, BIND_PORT)
+    try:
+        das.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    print '** %d connections, %d responses, %d disconnects' % (
+        das.connections, das.responses, das.disconnects)
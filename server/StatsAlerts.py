@@ -0,0 +1,534 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Alerting for the StatsServer. An AlertEngine evaluates a list of Rules
+#   each time a target's response has been processed, so that conditions
+#   are noticed without anyone watching the dashboard.
+#
+#   A rule compares a signal with a level. The signals are:
+#
+#       ethernet: an interface's rate (Gbps), as shown on its gauge.
+#       byte_rate, bytes_dropped_rate, packet_rate, packets_dropped_rate,
+#       error_rate: the rate of change (per s) of an interface's counters.
+#       drop_ratio: the fraction of an interface's packets dropped.
+#       target_capture: a target's total rate (Gbps).
+#       capture: the total rate (Gbps) over all targets.
+#
+#   An alert is raised once a signal has been above the rule's level for a
+#   number of consecutive samples, and cleared once it falls to the rule's
+#   clear level, which may be lower so that a signal hovering around the
+#   level does not raise and clear it over and over. While an alert is
+#   active, further samples above the level only update it: notifiers are
+#   told when it is raised and when it is cleared.
+#
+#   Only the interfaces of the target that responded whose rates changed
+#   since its previous response are evaluated, each rule filtering them on
+#   the raw rates. The others give the same signal as before, so only those
+#   with a pending or active alert are sampled again, to count consecutive
+#   samples and update their alerts. The cost of an update is proportional
+#   to the interfaces that changed and those alerting, not to the number
+#   of interfaces.
+#
+#   Notifiers receive each event as a struct. LogNotifier prints it,
+#   FileNotifier appends it to a file as a JSON line and WebhookNotifier
+#   POSTs it as JSON to a URL from a background thread.
+#------------------------------------------------------------------------------
+
+import json
+import urllib2
+from collections import deque
+from itertools import chain, count, izip
+from threading import Lock, Thread
+from Queue import Full, Queue
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Interface signals taken from the rates of its counters, as (index in the
+# rates, scale from units per second).
+RATE_SIGNALS = {
+    'ethernet': (0, 8e-9),
+    'byte_rate': (0, 1.0),
+    'bytes_dropped_rate': (1, 1.0),
+    'packet_rate': (2, 1.0),
+    'packets_dropped_rate': (3, 1.0),
+    'error_rate': (4, 1.0),
+    }
+
+# Scope of each signal: an interface, a target or the total over targets.
+SIGNAL_SCOPES = dict((name, 'interface') for name in RATE_SIGNALS)
+SIGNAL_SCOPES.update({
+    'drop_ratio': 'interface',
+    'target_capture': 'target',
+    'capture': 'total',
+    })
+
+# Subject of alerts on the total over targets.
+TOTAL_SUBJECT = 'total'
+
+# Rules applied when none are configured: the red zones of the dashboard's
+# gauges, and any packet drops or errors.
+DEFAULT_RULES = [
+    {'name': 'ethernet_high', 'signal': 'ethernet', 'above': 9.0,
+     'clear': 8.5},
+    {'name': 'capture_high', 'signal': 'capture', 'above': 19.0,
+     'clear': 18.0},
+    {'name': 'packets_dropped', 'signal': 'packets_dropped_rate',
+     'above': 0.0, 'samples': 2},
+    {'name': 'errors', 'signal': 'error_rate', 'above': 0.0, 'samples': 2},
+    {'name': 'drop_ratio_high', 'signal': 'drop_ratio', 'above': 0.01,
+     'clear': 0.001, 'severity': 'critical'},
+    ]
+
+# Number of events kept for alerts().
+RECENT_EVENTS = 100
+
+# Number of events a WebhookNotifier holds while its URL is slow, beyond
+# which they are dropped.
+WEBHOOK_QUEUE_SIZE = 1000
+
+
+class Rule(object):
+    '''A condition on a signal that raises an alert.'''
+
+
+    def __init__(self, name, signal, above, clear=None, samples=1,
+        severity='warning'):
+        '''Constructor.
+
+        :param name: the rule's name, unique among the rules.
+        :param signal: the name of the signal, one of SIGNAL_SCOPES.
+        :param above: the level the signal must exceed to raise an alert.
+        :param clear: the level at or below which the alert is cleared, by
+            default the same.
+        :param samples: number of consecutive samples the signal must be
+            above the level before the alert is raised.
+        :param severity: a label given to the rule's alerts.'''
+        if not SIGNAL_SCOPES.has_key(signal):
+            raise ValueError('Unknown signal: %s' % signal)
+        if clear is None:
+            clear = above
+        if clear > above:
+            raise ValueError('Rule %s clears above its level' % name)
+
+        self.name = name
+        self.signal = signal
+        self.scope = SIGNAL_SCOPES[signal]
+        self.above = float(above)
+        self.clear = float(clear)
+        self.samples = max(int(samples), 1)
+        self.severity = severity
+
+        # The index and scale of a rate signal, and its level in the units
+        # of the rates.
+        self._index, self._scale = RATE_SIGNALS.get(signal, (None, 8e-9))
+        self._raw = self.above/self._scale
+
+    @classmethod
+    def from_struct(cls, struct):
+        '''Create a rule from a struct with the constructor's arguments.'''
+        try:
+            return cls(struct['name'], struct['signal'], struct['above'],
+                       struct.get('clear'), struct.get('samples', 1),
+                       struct.get('severity', 'warning'))
+        except KeyError, e:
+            raise ValueError('Rule without %s' % e)
+
+    def as_struct(self):
+        '''Return the rule as an XML-RPC struct.'''
+        return {
+            'name': self.name,
+            'signal': self.signal,
+            'above': self.above,
+            'clear': self.clear,
+            'samples': self.samples,
+            'severity': self.severity,
+            }
+
+    def value(self, rates):
+        '''Return the signal of an interface from the rates of its counters,
+        or of a target or the total from a byte rate.'''
+        if self._index is not None:
+            return rates[self._index]*self._scale
+
+        if self.signal == 'drop_ratio':
+            packets = rates[2] + rates[3]
+            if packets <= 0:
+                return 0.0
+            return rates[3]/packets
+
+        return rates*self._scale
+
+    def hot(self, rates, positions=None):
+        '''Return the positions of the interfaces whose signal is above the
+        level, given the rates of each interface's counters or None.
+
+        :param positions: the positions to examine, by default all.'''
+        if positions is None:
+            positions = xrange(len(rates))
+
+        if self._index is not None:
+            i, raw = self._index, self._raw
+            return [k for k in positions
+                    if rates[k] is not None and rates[k][i] > raw]
+
+        # Dropped packets above the ratio of all packets.
+        ratio = self.above
+        return [k for k in positions if rates[k] is not None and
+                rates[k][3] > ratio*(rates[k][2] + rates[k][3])]
+
+
+class Alert(object):
+    '''An active alert: a rule whose signal is above its level for a
+    subject.'''
+
+
+    __slots__ = ('rule', 'subject', 'value', 'peak', 'raised', 'updated',
+                 'samples')
+
+    def __init__(self, rule, subject, value, now):
+        '''Constructor.
+
+        :param rule: the Rule that raised it.
+        :param subject: the interface id or target name it is about.
+        :param value: the signal that raised it.
+        :param now: the time it was raised.'''
+        self.rule = rule
+        self.subject = subject
+        self.value = value
+        self.peak = value
+        self.raised = now
+        self.updated = now
+        self.samples = 1
+
+    def update(self, value, now):
+        '''Record a later sample while the alert is active.'''
+        self.value = value
+        self.peak = max(self.peak, value)
+        self.updated = now
+        self.samples += 1
+
+    def as_struct(self):
+        '''Return the alert as an XML-RPC struct.'''
+        return {
+            'rule': self.rule.name,
+            'signal': self.rule.signal,
+            'severity': self.rule.severity,
+            'subject': self.subject,
+            'value': self.value,
+            'peak': self.peak,
+            'raised': self.raised,
+            'updated': self.updated,
+            'samples': self.samples,
+            }
+
+
+class AlertEngine(object):
+    '''Evaluate rules on each update, and notify alerts raised and cleared.
+
+    Updates are made by the poll thread, while alerts() may be called from
+    request handlers; the engine's state is guarded by a lock.'''
+
+
+    def __init__(self, rules=None, notifiers=()):
+        '''Constructor.
+
+        :param rules: list of Rules, by default those of DEFAULT_RULES.
+        :param notifiers: objects whose notify() method is called with each
+            event.'''
+        if rules is None:
+            rules = [Rule.from_struct(r) for r in DEFAULT_RULES]
+        names = [r.name for r in rules]
+        if len(set(names)) < len(names):
+            raise ValueError('Rule names are not unique')
+
+        self.rules = list(rules)
+        self.notifiers = list(notifiers)
+        self._lock = Lock()
+
+        # Active alerts by rule name and subject, and the number of
+        # consecutive samples above the level of subjects not yet alerting.
+        self._active = dict((r.name, dict()) for r in self.rules)
+        self._pending = dict((r.name, dict()) for r in self.rules)
+
+        self._recent = deque(maxlen=RECENT_EVENTS)
+
+        # The ids of each target's latest response, and their positions.
+        self._positions = dict()
+
+    def update(self, target, ids, rates, target_rate, total_rate, now,
+        changed=None):
+        '''Evaluate the rules on one target's response.
+
+        :param target: the name of the target.
+        :param ids: the ids of the interfaces in the response.
+        :param rates: for each id, the rates of its counters, or None.
+        :param target_rate: the target's total byte rate.
+        :param total_rate: the byte rate over all targets.
+        :param now: the time of the response.
+        :param changed: the positions of the ids whose rates changed since
+            the target's previous response, by default all.
+        :returns: the list of events, as structs.'''
+        events = []
+        with self._lock:
+            for rule in self.rules:
+                if rule.scope == 'interface':
+                    self._update_interfaces(rule, target, ids, rates,
+                                            changed, now, events)
+                elif rule.scope == 'target':
+                    self._sample(rule, target, rule.value(target_rate), now,
+                                 events)
+                else:
+                    self._sample(rule, TOTAL_SUBJECT,
+                                 rule.value(total_rate), now, events)
+
+        self._notify(events)
+        return events
+
+    def forget(self, subjects, now):
+        '''Clear the alerts of interfaces or targets no longer reported.
+
+        :param subjects: the interface ids or target names.
+        :param now: the time they were last reported.
+        :returns: the list of events, as structs.'''
+        events = []
+        with self._lock:
+            for rule in self.rules:
+                active = self._active[rule.name]
+                pending = self._pending[rule.name]
+                for subject in subjects:
+                    pending.pop(subject, None)
+                    alert = active.pop(subject, None)
+                    if alert is not None:
+                        self._event('cleared', alert, now, events)
+
+        self._notify(events)
+        return events
+
+    def active(self):
+        '''Return the active alerts, as structs in the order raised.'''
+        with self._lock:
+            alerts = [a.as_struct() for active in self._active.itervalues()
+                      for a in active.itervalues()]
+
+        alerts.sort(key=lambda a: (a['raised'], a['rule'], a['subject']))
+        return alerts
+
+    def as_struct(self):
+        '''Return the active alerts, recent events and rules as an XML-RPC
+        struct.'''
+        with self._lock:
+            recent = list(self._recent)
+
+        return {
+            'active': self.active(),
+            'recent': recent,
+            'rules': [r.as_struct() for r in self.rules],
+            }
+
+    def _update_interfaces(self, rule, target, ids, rates, changed, now,
+        events):
+        '''Evaluate an interface rule on a response.'''
+        active = self._active[rule.name]
+        pending = self._pending[rule.name]
+
+        hot = set()
+        for k in rule.hot(rates, changed):
+            id_ = ids[k]
+            hot.add(id_)
+            self._above(rule, id_, rule.value(rates[k]), now, events)
+
+        # Subjects that were above the level, and may no longer be or are
+        # unchanged and sampled again.
+        tracked = [s for s in chain(active, pending) if s not in hot]
+        if not tracked:
+            return
+
+        positions = self._target_positions(target, ids)
+        for subject in tracked:
+            k = positions.get(subject)
+            if k is None or rates[k] is None:
+                # Another target's interface, or no new rates.
+                continue
+            self._sample(rule, subject, rule.value(rates[k]), now, events)
+
+    def _target_positions(self, target, ids):
+        '''Return a dict mapping a target's ids to their positions, kept
+        while its responses hold the same ids.'''
+        cached = self._positions.get(target)
+        if cached is None or cached[0] != ids:
+            cached = (list(ids), dict(izip(ids, count())))
+            self._positions[target] = cached
+        return cached[1]
+
+    def _sample(self, rule, subject, value, now, events):
+        '''Evaluate a rule on one sample of a subject.'''
+        if value > rule.above:
+            self._above(rule, subject, value, now, events)
+        else:
+            self._below(rule, subject, value, now, events)
+
+    def _above(self, rule, subject, value, now, events):
+        '''Record a sample above a rule's level.'''
+        alert = self._active[rule.name].get(subject)
+        if alert is not None:
+            alert.update(value, now)
+            return
+
+        pending = self._pending[rule.name]
+        n = pending.get(subject, 0) + 1
+        if n < rule.samples:
+            pending[subject] = n
+            return
+
+        pending.pop(subject, None)
+        alert = Alert(rule, subject, value, now)
+        self._active[rule.name][subject] = alert
+        self._event('raised', alert, now, events)
+
+    def _below(self, rule, subject, value, now, events):
+        '''Record a sample at or below a rule's level.'''
+        self._pending[rule.name].pop(subject, None)
+
+        active = self._active[rule.name]
+        alert = active.get(subject)
+        if alert is None:
+            return
+
+        if value > rule.clear:
+            # Between the two levels, the alert stays active.
+            alert.update(value, now)
+            return
+
+        del active[subject]
+        alert.value = value
+        self._event('cleared', alert, now, events)
+
+    def _event(self, state, alert, now, events):
+        '''Record an alert being raised or cleared.'''
+        event = alert.as_struct()
+        event['state'] = state
+        event['time'] = now
+        events.append(event)
+        self._recent.append(event)
+
+    def _notify(self, events):
+        '''Pass events to the notifiers. A failing notifier does not stop
+        the others, nor polling.'''
+        for event in events:
+            for notifier in self.notifiers:
+                try:
+                    notifier.notify(event)
+                except Exception, e:
+                    print '** Alert notifier failed: %s' % e
+
+
+def format_event(event):
+    '''Return a one line description of an event.'''
+    return '%s %s %s on %s: %g (peak %g)' % (event['state'].upper(),
+        event['severity'], event['rule'], event['subject'] or '-',
+        event['value'], event['peak'])
+
+
+class LogNotifier(object):
+    '''Print events to the console.'''
+
+
+    def notify(self, event):
+        print '** Alert %s' % format_event(event)
+
+
+class FileNotifier(object):
+    '''Append events to a file, one JSON object per line.'''
+
+
+    def __init__(self, path):
+        '''Constructor.
+
+        :param path: path of the file.'''
+        self.path = path
+        self._lock = Lock()
+
+    def notify(self, event):
+        line = json.dumps(event, sort_keys=True) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+class WebhookNotifier(object):
+    '''POST events as JSON to a URL.
+
+    Events are sent by a background thread, so that a slow or unavailable
+    URL does not delay polling. Events beyond the queue's size are
+    dropped, and counted.'''
+
+
+    def __init__(self, url, timeout=2.0, queue_size=WEBHOOK_QUEUE_SIZE):
+        '''Constructor.
+
+        :param url: the URL to POST each event to.
+        :param timeout: socket timeout (s) of each POST.
+        :param queue_size: number of events held while sending.'''
+        self.url = url
+        self.timeout = timeout
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+        self._queue = Queue(queue_size)
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def notify(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        '''Send the events queued, then stop.'''
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                return
+
+            request = urllib2.Request(self.url, json.dumps(event),
+                                      {'Content-Type': 'application/json'})
+            try:
+                urllib2.urlopen(request, timeout=self.timeout).read()
+                self.sent += 1
+            except Exception, e:
+                self.failed += 1
+                print '** Alert webhook %s failed: %s' % (self.url, e)
+
+
+def make_notifier(spec):
+    '''Create a notifier from a command line specification.
+
+    :param spec: 'log', 'file:<path>' or 'webhook:<url>'.'''
+    kind, _, arg = spec.partition(':')
+    if kind == 'log' and not arg:
+        return LogNotifier()
+    if kind == 'file' and arg:
+        return FileNotifier(arg)
+    if kind == 'webhook' and arg:
+        return WebhookNotifier(arg)
+
+    raise ValueError('Invalid notifier: %s' % spec)
+
+
+def load_rules(path):
+    '''Load rules from a file holding a JSON list of rule structs.'''
+    with open(path) as f:
+        structs = json.load(f)
+
+    if not isinstance(structs, list):
+        raise ValueError('%s does not hold a list of rules' % path)
+    return [Rule.from_struct(s) for s in structs]
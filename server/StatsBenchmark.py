@@ -0,0 +1,1218 @@
+#!/usr/bin/env python
+
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Benchmarks for the monitoring pipeline, stage by stage and end to end.
+#   The micro-benchmarks compare the current implementation of a stage
+#   against the original one, using responses generated by FakeData:
+#
+#       read: framing responses read from a socket.
+#       parse: parsing responses.
+#       rates: computing counter rates.
+#       fake: generating fake responses.
+#       gviz: rendering the dashboard's data tables for each request.
+#       binary: marshalling a snapshot for the binary transport rather than
+#           XML RPC, and the size of each.
+#
+#   The others measure the current implementation under load:
+#
+#       poll: a StatsServer update from a response, and a poll of a FakeDas.
+#       rpc: StatsServer RPC latency per method, with concurrent clients.
+#       views: rendering the stats views, with and without cached data.
+#       pipeline: dashboard requests to the stats views, served from a
+#           StatsServer polling a FakeDas, with concurrent clients.
+#
+#   Every measurement is also recorded, and can be written as JSON and
+#   compared against an earlier run to catch regressions.
+#
+#   To run all benchmarks with the default interface counts, use:
+#
+#       $ python StatsBenchmark.py
+#
+#   To save the results as a baseline and later compare against it, use:
+#
+#       $ python StatsBenchmark.py -o baseline.json
+#       $ python StatsBenchmark.py -B baseline.json
+#------------------------------------------------------------------------------
+
+import getopt
+import json
+import os
+import platform
+import random
+import re
+import socket
+import string
+import sys
+import time
+import xmlrpclib
+from itertools import izip
+from threading import Event, Thread
+
+from FakeDas import FakeDas
+from StatsBinary import pack
+from StatsRates import RateEngine, numpy
+from StatsServer import (InterfaceList, InterfaceStats, Poller, Snapshot,
+    StatsServer, StreamReader, Target, ThreadedStatsServer, parse_stats)
+from StatsSimulation import PROFILES, FakeData
+
+try:
+    from xml.etree.cElementTree import fromstring
+except ImportError:
+    from xml.etree.ElementTree import fromstring
+
+try:
+    import gviz_api
+except ImportError:
+    gviz_api = None
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Interface counts to benchmark by default.
+DEFAULT_SIZES = [4, 64, 512, 4096]
+
+# Number of responses read per measurement.
+DEFAULT_REPEAT = 20
+
+# Maximum time (s) given to a single legacy measurement.
+DEFAULT_BUDGET = 10.0
+
+# Client concurrency levels to benchmark by default.
+DEFAULT_CLIENTS = [1, 10, 50, 200]
+
+# Number of slow clients running during RPC benchmarks.
+DEFAULT_SLOW = 1
+
+# Relative change in a measurement reported as a regression by default.
+DEFAULT_TOLERANCE = 0.25
+
+# Directory of the django project.
+MONITOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'monitor')
+
+# RE used by the original recv(1) reader.
+LEGACY_RESPONSE_RE = re.compile('(<cmd_resp>.*</cmd_resp>)')
+
+
+#------------------------------------------------------------------------------
+# Original implementations
+#------------------------------------------------------------------------------
+def legacy_read_frame(s, deadline):
+    '''Read a response one byte at a time, as the original _run() loop did.
+
+    :param s: the socket to read from.
+    :param deadline: time after which to give up.
+    :returns: the response, or None if the deadline passed.'''
+    received_data = []
+    while True:
+        data = s.recv(1)
+        data = data.strip()
+        received_data.append(data)
+        received_string = ''.join(received_data)
+        m = re.match(LEGACY_RESPONSE_RE, received_string)
+        if m:
+            received_response, = m.groups(0)
+            return received_response
+
+        if time.time() > deadline:
+            return None
+
+
+def legacy_parse_stats(s):
+    '''Parse a response by building a full tree, as the original
+    parse_stats() did, but with the same ElementTree implementation as
+    parse_stats(), so that only the parsing strategies are compared.'''
+    root = fromstring(s)
+    interfaces = dict()
+
+    current_interface = None
+    for p in root.findall('param'):
+        if cmp(p.findtext('name'), 'interfaceNumber') == 0:
+            if current_interface is not None:
+                interfaces[current_interface[0]] = current_interface
+
+            current_interface = [0, 0, 0, 0, 0, 0]
+            current_interface[0] = p.findtext('value')
+
+        if current_interface is not None:
+            if cmp(p.findtext('name'), 'byteCount') == 0:
+                current_interface[1] = int(p.findtext('value'))
+
+            elif cmp(p.findtext('name'), 'bytesDropped') == 0:
+                current_interface[2] = int(p.findtext('value'))
+
+            elif cmp(p.findtext('name'), 'packetCount') == 0:
+                current_interface[3] = int(p.findtext('value'))
+
+            elif cmp(p.findtext('name'), 'packetsDropped') == 0:
+                current_interface[4] = int(p.findtext('value'))
+
+            elif cmp(p.findtext('name'), 'errorCount') == 0:
+                current_interface[5] = int(p.findtext('value'))
+
+    interfaces[current_interface[0]] = current_interface
+
+    return interfaces
+
+
+def legacy_update_rates(interfaces, cstatistics, rates, delta_t):
+    '''Compute byte rates one interface at a time, as the original
+    _update_statistics() did.'''
+    for i, V in interfaces.iteritems():
+        try:
+            if not cstatistics.has_key(i):
+                cstatistics[i] = list(V)
+                continue
+
+            rates[i] = 0
+            delta_v = V[1] - cstatistics[i][1]
+            cstatistics[i][1] = V[1]
+            rates[i] = float(delta_v)/delta_t
+        except Exception, e:
+            print 'STATS LOOP:', str(e)
+
+
+def legacy_gviz_response(name, snapshot, n, req_id):
+    '''Render a stats view's response with gviz_api for every request, as
+    the original views did.
+
+    :param name: the table, one of interface, ethernet or capture.
+    :param snapshot: the snapshot struct to render.
+    :param n: the number of interfaces shown.
+    :param req_id: the query's reqId.'''
+    order_by = ()
+    if name == 'interface':
+        labels = ['interface', 'byteCount', 'bytesDropped', 'packetCount',
+                  'packetsDropped', 'errorCount']
+        description = dict((l, ('number', l)) for l in labels)
+        description['interface'] = ('string', 'Interface')
+        data = []
+        for i in range(n):
+            values = [0 for x in range(len(labels))]
+            if snapshot['interfaces'].has_key(str(i)):
+                values = [int(x) for x in snapshot['interfaces'][str(i)]]
+            data.append(dict(zip(labels, values)))
+    else:
+        labels = ('label', 'value')
+        description = {
+            'label': ('string', 'Label'),
+            'value': ('number', 'Value'),
+            }
+        if name == 'ethernet':
+            rates = snapshot['ethernet']
+            data = [{'label': 'Eth%d' % i, 'value': rates.get(str(i), 0)}
+                    for i in range(n)]
+            order_by = 'label'
+        else:
+            data = [{'label': 'Capture', 'value': snapshot['capture']}]
+
+    data_table = gviz_api.DataTable(description)
+    data_table.LoadData(data)
+    return data_table.ToJSonResponse(columns_order=labels, order_by=order_by,
+                                     req_id=req_id)
+
+
+class LegacyFakeData(object):
+    '''Generate fake acquisition system data, as the original FakeData did.'''
+
+
+    # Static fake data tags and templates.
+    FAKE_START_TAG = '''<cmd_resp>'''
+    FAKE_END_TAG = '''</cmd_resp>'''
+    FAKE_HEADER = string.Template('''
+        <cmd_name>get stats</cmd_name>
+        <retVal>0</retVal>
+        <reason>success</reason>
+        <param>
+          <name>interfaceCount</name><type>unsigned</type><value>${num_interfaces}</value>
+        </param>''')
+
+    FAKE_BODY = string.Template('''
+        <param>
+          <name>interfaceType</name><type>keyword</type><value>Ethernet</value>
+        </param>
+        <param>
+          <name>interfaceNumber</name><type>unsigned</type><value>${int_id}</value>
+        </param>
+        <param>
+          <name>byteCount</name><type>unsigned long</type><value>${byte_count}</value>
+        </param>
+        <param>
+          <name>bytesDropped</name><type>unsigned long</type><value>${bytes_dropped}</value>
+        </param>
+        <param>
+          <name>packetCount</name><type>unsigned long</type><value>${packet_count}</value>
+        </param>
+        <param>
+          <name>packetsDropped</name><type>unsigned long</type><value>${packets_dropped}</value>
+        </param>
+        <param>
+          <name>errorCount</name><type>unsigned long</type><value>${error_count}</value>
+        </param>''')
+
+    # List of keys that will be updated.
+    STAT_KEYS = ['byte_count', 'bytes_dropped', 'packet_count',
+        'packets_dropped', 'error_count']
+
+    # Useful constants.
+    BYTE_INCREMENT = 1000000000
+    PACKET_INCREMENT = BYTE_INCREMENT/8000
+
+    def __init__(self, num_interfaces=4):
+        '''Constructor.
+
+        :param num_interfaces: the number of interfaces.'''
+        self.num_interfaces = num_interfaces
+
+        # Initialize interfaces dict.
+        self.interfaces = [{'int_id': x} for x in xrange(self.num_interfaces)]
+
+        # Initialize interfaces statistics.
+        for i in xrange(self.num_interfaces):
+            for k in LegacyFakeData.STAT_KEYS:
+                self.interfaces[i][k] = 0
+
+    def update_interface(self, int_id, byte_count, bytes_dropped, packet_count,
+        packets_dropped, error_count):
+        '''Update the statistics on an interface.
+
+        :param int_id: interface identifier/index.
+        :param byte_count: total byte count so far.
+        :param bytes_dropped: total bytes dropped so far.
+        :param packet_count: total packet count so far.
+        :param packets_dropped: total packets dropped so far.
+        :param error_count: errors seen so far.'''
+        if int_id < 0 or int_id >= self.num_interfaces:
+            raise 'Invalid interface id: %d' % int_id
+
+        # Update the interface statistics.
+        for k in LegacyFakeData.STAT_KEYS:
+            self.interfaces[int_id][k] += locals()[k]
+
+    def __str__(self):
+        '''Returns new statistic XML string for parsing.'''
+        for i in xrange(self.num_interfaces):
+            bc = random.randint(0, LegacyFakeData.BYTE_INCREMENT)
+            bd = random.randint(0, LegacyFakeData.BYTE_INCREMENT)
+            pc = random.randint(0, LegacyFakeData.PACKET_INCREMENT)
+            pd = random.randint(0, LegacyFakeData.PACKET_INCREMENT)
+            ec = random.randint(0, LegacyFakeData.PACKET_INCREMENT)
+            self.update_interface(i, bc, bd, pc, pd, ec)
+
+        xml_body = [LegacyFakeData.FAKE_START_TAG]
+        xml_body.append(LegacyFakeData.FAKE_HEADER.substitute({'num_interfaces':
+                                                         self.num_interfaces}))
+
+        for i in xrange(self.num_interfaces):
+            xml_body.append(LegacyFakeData.FAKE_BODY.substitute(self.interfaces[i]))
+
+        xml_body.append(LegacyFakeData.FAKE_END_TAG)
+
+        return ''.join(xml_body)
+
+
+#------------------------------------------------------------------------------
+# Results
+#------------------------------------------------------------------------------
+def record(config, benchmark, case, metric, value, better='lower'):
+    '''Record a measurement.
+
+    :param config: the benchmark configuration, holding the 'results' list.
+    :param benchmark: name of the benchmark.
+    :param case: dict describing what was measured, e.g. the interface count.
+    :param metric: name of the measurement, including its unit.
+    :param value: the measured value.
+    :param better: 'lower' or 'higher', whichever is an improvement.'''
+    config['results'].append({
+        'benchmark': benchmark,
+        'case': case,
+        'metric': metric,
+        'value': value,
+        'better': better,
+        })
+
+
+def _result_key(result):
+    return (result['benchmark'], json.dumps(result['case'], sort_keys=True),
+            result['metric'])
+
+
+def save_results(config, path):
+    '''Write the recorded measurements, and how they were made, as JSON.'''
+    results = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': dict((k, v) for k, v in config.iteritems()
+                       if k != 'results'),
+        'results': config['results'],
+        }
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+
+def compare_results(config, path, tolerance):
+    '''Compare the recorded measurements against a baseline.
+
+    :param path: the baseline, as written by save_results().
+    :param tolerance: relative change taken as a regression.
+    :returns: the number of regressions.'''
+    with open(path) as f:
+        baseline = dict((_result_key(r), r) for r in json.load(f)['results'])
+
+    print 'compare: against %s (tolerance %.0f%%)' % (path, tolerance*100)
+    print '%-10s %-36s %-24s %12s %12s %8s' % ('benchmark', 'case', 'metric',
+                                                'baseline', 'current',
+                                                'change')
+    regressions = 0
+    for result in config['results']:
+        base = baseline.get(_result_key(result))
+        if base is None or not base['value']:
+            continue
+
+        change = float(result['value'])/base['value'] - 1
+        if result['better'] == 'higher':
+            worse = change < -tolerance
+        else:
+            worse = change > tolerance
+
+        flag = ''
+        if worse:
+            regressions += 1
+            flag = '  REGRESSION'
+
+        case = ','.join('%s=%s' % kv for kv in sorted(result['case'].items()))
+        print '%-10s %-36s %-24s %12.3f %12.3f %+7.0f%%%s' % (
+            result['benchmark'], case, result['metric'], base['value'],
+            result['value'], change*100, flag)
+
+    print '%d regression(s)' % regressions
+    return regressions
+
+
+#------------------------------------------------------------------------------
+# Benchmarks
+#------------------------------------------------------------------------------
+def _writer(s, response, repeat):
+    '''Write a response to a socket repeatedly.'''
+    try:
+        for i in xrange(repeat):
+            s.sendall(response)
+    except socket.error:
+        # The reader gave up early.
+        pass
+
+
+def _time_reads(response, repeat, read):
+    '''Time how long it takes to read a response repeatedly.
+
+    :param response: the response to send.
+    :param repeat: the number of times to send it.
+    :param read: callable taking a socket and returning a response or None.
+    :returns: the mean time per response in seconds, or None if read() gave
+        up before all responses were read.'''
+    reader_sock, writer_sock = socket.socketpair()
+    writer = Thread(target=_writer, args=(writer_sock, response, repeat))
+    writer.start()
+
+    start = time.time()
+    completed = 0
+    try:
+        for i in xrange(repeat):
+            if read(reader_sock) is None:
+                break
+            completed += 1
+    finally:
+        elapsed = time.time() - start
+        reader_sock.close()
+        writer.join()
+        writer_sock.close()
+
+    if completed < repeat:
+        return None
+
+    return elapsed/repeat
+
+
+def bench_read(config):
+    '''Compare the legacy recv(1) loop with StreamReader.
+
+    :param config: dict with the interface counts ('sizes'), the number of
+        responses to read per measurement ('repeat') and the maximum time
+        (s) for the legacy loop per interface count ('budget').'''
+    sizes, repeat, budget = config['sizes'], config['repeat'], config['budget']
+    print 'read: legacy recv(1) loop vs StreamReader'
+    print '%10s %10s %14s %14s %10s' % ('interfaces', 'bytes', 'legacy (ms)',
+                                         'reader (ms)', 'speedup')
+
+    for n in sizes:
+        response = str(FakeData(num_interfaces=n))
+
+        deadline = [None]
+        def legacy(s):
+            return legacy_read_frame(s, deadline[0])
+
+        # The legacy loop is quadratic, so give it a single response and a
+        # bounded amount of time.
+        deadline[0] = time.time() + budget
+        legacy_t = _time_reads(response, 1, legacy)
+
+        readers = {}
+        def framed(s):
+            if s not in readers:
+                readers[s] = StreamReader(s)
+            return readers[s].read_frame()
+
+        reader_t = _time_reads(response, repeat, framed)
+
+        case = {'interfaces': n}
+        record(config, 'read', case, 'reader_ms', reader_t*1000)
+        if legacy_t is None:
+            legacy_s = '>%.0f' % (budget*1000)
+            speedup_s = '>%.0fx' % (budget/reader_t)
+        else:
+            legacy_s = '%.3f' % (legacy_t*1000)
+            speedup_s = '%.0fx' % (legacy_t/reader_t)
+            record(config, 'read', case, 'legacy_ms', legacy_t*1000)
+
+        print '%10d %10d %14s %14.3f %10s' % (n, len(response), legacy_s,
+                                               reader_t*1000, speedup_s)
+
+
+def _time_calls(fn, arg, repeat, budget=None):
+    '''Return the mean time (s) of fn(arg) over repeat calls, or over as
+    many as complete within the budget (s), if given.'''
+    start = time.time()
+    calls = 0
+    while calls < repeat:
+        fn(arg)
+        calls += 1
+        if budget is not None and time.time() - start > budget:
+            break
+
+    return (time.time() - start)/calls
+
+
+def bench_parse(config):
+    '''Compare the legacy tree-based parser with parse_stats(), both on
+    the same ElementTree implementation.
+
+    :param config: dict with the interface counts ('sizes') and the number
+        of responses to parse per measurement ('repeat').'''
+    sizes, repeat = config['sizes'], config['repeat']
+    print 'parse: legacy tree parser vs parse_stats'
+    print '%10s %14s %14s %14s %10s' % ('interfaces', 'legacy (ms)',
+                                         'parser (ms)', 'per intf (us)',
+                                         'speedup')
+
+    for n in sizes:
+        response = str(FakeData(num_interfaces=n))
+        legacy_t = _time_calls(legacy_parse_stats, response, repeat,
+                               config['budget'])
+        parser_t = _time_calls(parse_stats, response, repeat)
+        record(config, 'parse', {'interfaces': n}, 'legacy_ms',
+               legacy_t*1000)
+        record(config, 'parse', {'interfaces': n}, 'parser_ms',
+               parser_t*1000)
+
+        print '%10d %14.3f %14.3f %14.2f %9.1fx' % (n, legacy_t*1000,
+            parser_t*1000, parser_t*1000000/n, legacy_t/parser_t)
+
+
+def bench_rates(config):
+    '''Compare the legacy byte rate loop with RateEngine.
+
+    The legacy loop computes the byte rate only, RateEngine the rates of all
+    five counters, so the time per counter is compared as well.
+
+    :param config: dict with the interface counts ('sizes') and the number
+        of updates per measurement ('repeat').'''
+    sizes, repeat = config['sizes'], config['repeat']
+    engines = [('lists', False)]
+    if numpy is not None:
+        engines.append(('numpy', True))
+
+    print 'rates: legacy byte rate loop vs RateEngine (all counters)'
+    print '%10s %14s' % ('interfaces', 'legacy (ms)') + \
+        ''.join('%14s %10s %12s' % ('%s (ms)' % name, 'speedup',
+                                    'per counter')
+                for name, vectorize in engines)
+
+    for n in sizes:
+        fd = FakeData(num_interfaces=n)
+        samples = [parse_stats(str(fd)) for i in xrange(repeat + 1)]
+
+        cstatistics, rates = dict(), dict()
+        legacy_update_rates(samples[0], cstatistics, rates, 1.0)
+        start = time.time()
+        for interfaces in samples[1:]:
+            legacy_update_rates(interfaces, cstatistics, rates, 1.0)
+        legacy_t = (time.time() - start)/repeat
+
+        record(config, 'rates', {'interfaces': n}, 'legacy_ms',
+               legacy_t*1000)
+        line = '%10d %14.3f' % (n, legacy_t*1000)
+        for name, vectorize in engines:
+            engine = RateEngine(5, vectorize=vectorize)
+            ids = samples[0].keys()
+            batches = [[interfaces[i].counters() for i in ids]
+                       for interfaces in samples]
+            engine.update(ids, batches[0], 0)
+
+            start = time.time()
+            for t, batch in enumerate(batches[1:]):
+                engine.update(ids, batch, t + 1)
+            engine_t = (time.time() - start)/repeat
+            record(config, 'rates', {'interfaces': n}, '%s_ms' % name,
+                   engine_t*1000)
+
+            line += '%14.3f %9.1fx %11.1fx' % (engine_t*1000,
+                legacy_t/engine_t, 5*legacy_t/engine_t)
+
+        print line
+
+
+def bench_fake(config):
+    '''Compare the legacy FakeData with the simulation profiles.
+
+    :param config: dict with the interface counts ('sizes') and the number
+        of responses to generate per measurement ('repeat').'''
+    sizes, repeat = config['sizes'], config['repeat']
+    names = sorted(PROFILES.keys())
+    print 'fake: legacy FakeData vs FakeData profiles (records/s)'
+    print '%10s %12s' % ('interfaces', 'legacy') + \
+        ''.join('%12s' % name for name in names) + '%10s' % 'speedup'
+
+    for n in sizes:
+        legacy_t = _time_calls(str, LegacyFakeData(num_interfaces=n), repeat,
+                               config['budget'])
+        record(config, 'fake', {'interfaces': n}, 'legacy_records_per_s',
+               n/legacy_t, 'higher')
+        line = '%10d %12.0f' % (n, n/legacy_t)
+
+        steady_t = None
+        for name in names:
+            t = _time_calls(str, FakeData(n, name), repeat)
+            if name == 'steady':
+                steady_t = t
+            record(config, 'fake', {'interfaces': n},
+                   '%s_records_per_s' % name, n/t, 'higher')
+            line += '%12.0f' % (n/t)
+
+        print line + '%9.1fx' % (legacy_t/steady_t)
+
+
+def bench_poll(config):
+    '''Measure a StatsServer update, and a complete poll of a FakeDas.
+
+    An update parses a response and computes rates, history and a new
+    snapshot from it. A poll adds generating the response and the round trip
+    over a local TCP connection.
+
+    :param config: dict with the interface counts ('sizes') and the number of
+        updates per measurement ('repeat').'''
+    print 'poll: mean time (ms) per update and per poll'
+    print '%10s %12s %12s' % ('interfaces', 'update', 'poll')
+
+    repeat = config['repeat']
+    for n in config['sizes']:
+        fd = FakeData(n)
+        responses = [str(fd) for i in xrange(repeat)]
+        server = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                             retention=60)
+        try:
+            start = time.time()
+            for i, response in enumerate(responses):
+                server._update_statistics('', parse_stats(response), start + i)
+            update_t = (time.time() - start)/repeat
+        finally:
+            server.server_close()
+
+        das = FakeDas(fake=FakeData(n))
+        das.start()
+        try:
+            polls = []
+            def on_response(target, response, now):
+                parse_stats(response)
+                polls.append(now)
+                if len(polls) > repeat:
+                    poller.stop()
+
+            poller = Poller([Target('', das.address, 0)], on_response)
+            poller.run()
+        finally:
+            das.close()
+
+        # The first poll includes connecting.
+        poll_t = (polls[-1] - polls[0])/repeat
+
+        record(config, 'poll', {'interfaces': n}, 'update_ms', update_t*1000)
+        record(config, 'poll', {'interfaces': n}, 'poll_ms', poll_t*1000)
+        print '%10d %12.3f %12.3f' % (n, update_t*1000, poll_t*1000)
+
+
+def _snapshot_struct(n):
+    '''Return a snapshot struct for n interfaces, as the StatsServer's
+    snapshot() returns.'''
+    fd = FakeData(n)
+    fd.update()
+    rnd = random.Random(0)
+    return {
+        'interfaces': dict((str(s['int_id']),
+                            [str(s['int_id'])] + [str(s[k]) for k in
+                                                  FakeData.STAT_KEYS])
+                           for s in fd.interfaces),
+        'ethernet': dict((str(i), round(rnd.random()*10, 1))
+                         for i in xrange(n)),
+        'capture': round(rnd.random()*10*n, 1),
+        'ids': [str(i) for i in xrange(n)],
+        'ids_version': 1,
+        }
+
+
+def bench_gviz(config):
+    '''Compare rendering a view's response with gviz_api for every request
+    against the compiled table formats, and against wrapping a table
+    rendered once per snapshot, as the views now do.
+
+    :param config: dict with the interface counts ('sizes') and the number of
+        renders per measurement ('repeat').'''
+    views = _import_views()
+    if views is None or gviz_api is None:
+        print 'gviz: django or gviz_api is not installed'
+        return
+
+    print 'gviz: CPU time (us) per request'
+    print '%10s %10s %12s %12s %12s %9s' % ('interfaces', 'table', 'gviz_api',
+                                            'compiled', 'cached', 'speedup')
+
+    repeat = config['repeat']
+    renderers = [('interface', views.interface_table),
+                 ('ethernet', views.ethernet_table),
+                 ('capture', views.capture_table)]
+    for n in config['sizes']:
+        snapshot = _snapshot_struct(n)
+        req_id = json.dumps('0')
+
+        for name, render in renderers:
+            start = time.clock()
+            for i in xrange(repeat):
+                legacy_gviz_response(name, snapshot, n, 0)
+            legacy_t = (time.clock() - start)/repeat
+
+            start = time.clock()
+            for i in xrange(repeat):
+                views.GVIZ_RESPONSE % (render(snapshot), req_id)
+            compiled_t = (time.clock() - start)/repeat
+
+            table = render(snapshot)
+            count = repeat*100
+            start = time.clock()
+            for i in xrange(count):
+                views.GVIZ_RESPONSE % (table, req_id)
+            cached_t = (time.clock() - start)/count
+
+            case = {'interfaces': n, 'table': name}
+            record(config, 'gviz', case, 'gviz_api_us', legacy_t*1e6)
+            record(config, 'gviz', case, 'compiled_us', compiled_t*1e6)
+            record(config, 'gviz', case, 'cached_us', cached_t*1e6)
+            print '%10d %10s %12.1f %12.1f %12.2f %8.1fx' % (n, name,
+                legacy_t*1e6, compiled_t*1e6, cached_t*1e6,
+                legacy_t/compiled_t)
+
+
+def _snapshot(n):
+    '''Return a Snapshot of n interfaces with counters and rates, as the
+    StatsServer publishes after two polls.'''
+    fd = FakeData(n)
+    engine = RateEngine(len(InterfaceStats.FIELDS) - 1)
+    now = time.time()
+    for t in (now - 1, now):
+        stats = parse_stats(str(fd)).values()
+        ids = [str(s.interface) for s in stats]
+        rates = engine.update(ids, [s.counters() for s in stats], t)
+
+    capture = sum(r[0] for r in rates)
+    return Snapshot(1, dict((id_, tuple(s)) for id_, s in izip(ids, stats)),
+                    dict((id_, r[0]) for id_, r in izip(ids, rates)),
+                    {'': capture}, capture, now, 1,
+                    dict((id_, tuple(r)) for id_, r in izip(ids, rates)),
+                    InterfaceList().update('', [s.interface for s in stats]),
+                    {'': now})
+
+
+def _client_binary():
+    '''Import the monitor's client-side binary decoding.
+
+    :returns: the stats.binary module.'''
+    if MONITOR_DIR not in sys.path:
+        sys.path.insert(0, MONITOR_DIR)
+    from stats import binary
+    return binary
+
+
+def bench_binary(config):
+    '''Compare marshalling a snapshot over XML RPC and over the binary
+    transport, from building the server's struct to the client's.
+
+    :param config: dict with the interface counts ('sizes') and the number of
+        snapshots to marshal per measurement ('repeat').'''
+    sizes, repeat = config['sizes'], config['repeat']
+    client = _client_binary()
+
+    def xmlrpc_encode(snapshot):
+        snapshot._struct = None
+        return xmlrpclib.dumps((snapshot.as_struct(),), methodresponse=True)
+
+    def binary_encode(snapshot):
+        snapshot._binary = None
+        return pack({'result': snapshot.as_binary()})
+
+    def xmlrpc_decode(body):
+        return xmlrpclib.loads(body)[0][0]
+
+    def binary_decode(body):
+        return client.snapshot_struct(client.unpack(body)['result'])
+
+    print 'binary: snapshot marshalling, XML RPC vs binary transport'
+    print '%10s %12s %12s %12s %12s %10s %10s %8s' % ('interfaces',
+        'xml enc(ms)', 'bin enc(ms)', 'xml dec(ms)', 'bin dec(ms)',
+        'xml (KB)', 'bin (KB)', 'speedup')
+
+    for n in sizes:
+        snapshot = _snapshot(n)
+        xml_body = xmlrpc_encode(snapshot)
+        binary_body = binary_encode(snapshot)
+
+        xml_enc = _time_calls(xmlrpc_encode, snapshot, repeat)
+        bin_enc = _time_calls(binary_encode, snapshot, repeat)
+        xml_dec = _time_calls(xmlrpc_decode, xml_body, repeat)
+        bin_dec = _time_calls(binary_decode, binary_body, repeat)
+
+        case = {'interfaces': n}
+        record(config, 'binary', case, 'xmlrpc_encode_ms', xml_enc*1000)
+        record(config, 'binary', case, 'binary_encode_ms', bin_enc*1000)
+        record(config, 'binary', case, 'xmlrpc_decode_ms', xml_dec*1000)
+        record(config, 'binary', case, 'binary_decode_ms', bin_dec*1000)
+        record(config, 'binary', case, 'xmlrpc_bytes', len(xml_body))
+        record(config, 'binary', case, 'binary_bytes', len(binary_body))
+
+        print '%10d %12.3f %12.3f %12.3f %12.3f %10.1f %10.1f %7.1fx' % (n,
+            xml_enc*1000, bin_enc*1000, xml_dec*1000, bin_dec*1000,
+            len(xml_body)/1024.0, len(binary_body)/1024.0,
+            (xml_enc + xml_dec)/(bin_enc + bin_dec))
+
+
+def percentile(values, p):
+    '''Return the p-th percentile of a list of values.'''
+    values = sorted(values)
+    if not values:
+        return 0
+
+    return values[min(len(values) - 1, int(len(values)*p/100.0))]
+
+
+def _slow_client(address, stop, duration):
+    '''Send XML-RPC requests one byte at a time until stop is set.
+
+    :param address: the server address.
+    :param stop: threading.Event ending the client.
+    :param duration: time (s) over which each request is trickled.'''
+    body = xmlrpclib.dumps((), 'capture')
+    request = ('POST /RPC2 HTTP/1.0\r\nContent-Type: text/xml\r\n'
+               'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+    delay = duration/len(request)
+
+    while not stop.is_set():
+        s = socket.create_connection(address)
+        try:
+            for c in request:
+                s.sendall(c)
+                time.sleep(delay)
+            while s.recv(4096):
+                pass
+        except socket.error:
+            pass
+        s.close()
+
+
+# Calls made by RPC clients, by method name.
+RPC_CALLS = [
+    ('interface', lambda proxy: proxy.interface('0')),
+    ('ethernet', lambda proxy: proxy.ethernet('0')),
+    ('capture', lambda proxy: proxy.capture()),
+    ]
+
+
+def _rpc_client(address, repeat, latencies):
+    '''Make repeat calls to a StatsServer, recording each latency.
+
+    :param latencies: list to which (method, latency) pairs are added.'''
+    proxy = xmlrpclib.ServerProxy('http://%s:%d/' % address)
+
+    for i in xrange(repeat):
+        method, call = RPC_CALLS[i % len(RPC_CALLS)]
+        start = time.time()
+        call(proxy)
+        latencies.append((method, time.time() - start))
+
+
+def _record_latencies(config, benchmark, case, latencies, elapsed):
+    '''Record the percentiles of (name, latency) pairs, overall and by
+    name, and the throughput.'''
+    names = sorted(set(name for name, latency in latencies))
+    for name in [None] + names:
+        values = [l for n, l in latencies if name is None or n == name]
+        prefix = ''
+        if name is not None:
+            prefix = name + '_'
+        record(config, benchmark, case, prefix + 'p50_ms',
+               percentile(values, 50)*1000)
+        record(config, benchmark, case, prefix + 'p99_ms',
+               percentile(values, 99)*1000)
+
+    record(config, benchmark, case, 'calls_per_s', len(latencies)/elapsed,
+           'higher')
+
+
+def bench_rpc(config):
+    '''Load test the single-threaded and threaded RPC servers.
+
+    Each level of client concurrency runs alongside 'slow' clients that
+    trickle their requests, as a dashboard on a poor link would.
+
+    :param config: dict with the client concurrency levels ('clients'), the
+        number of calls per client ('repeat'), the number of slow clients
+        ('slow') and the time (s) each slow request takes ('budget').'''
+    print 'rpc: latency vs client concurrency (%d slow clients)' % \
+        config['slow']
+    print '%10s %8s %10s %10s %12s' % ('server', 'clients', 'p50 (ms)',
+                                       'p99 (ms)', 'calls/s')
+
+    for server_class in (StatsServer, ThreadedStatsServer):
+        server = server_class(1, ('localhost', 0), ('localhost', 0), fake=True)
+        server.logRequests = False
+        address = server.server_address
+        server.start()
+        serve_thread = Thread(target=server.serve_forever)
+        serve_thread.start()
+
+        # Wait for the first poll so that every call succeeds.
+        while not server._snapshot.counters:
+            time.sleep(0.01)
+
+        stop = Event()
+        slow_threads = [Thread(target=_slow_client,
+                               args=(address, stop, config['budget']/10))
+                        for i in xrange(config['slow'])]
+        for t in slow_threads:
+            t.start()
+
+        try:
+            for n in config['clients']:
+                latencies = []
+                clients = [Thread(target=_rpc_client,
+                                  args=(address, config['repeat'], latencies))
+                           for i in xrange(n)]
+
+                start = time.time()
+                for t in clients:
+                    t.start()
+                for t in clients:
+                    t.join()
+                elapsed = time.time() - start
+
+                name = server_class.__name__[:-len('StatsServer')] or \
+                    'Single'
+                _record_latencies(config, 'rpc',
+                                  {'server': name, 'clients': n},
+                                  latencies, elapsed)
+
+                values = [l for method, l in latencies]
+                print '%10s %8d %10.2f %10.2f %12.0f' % (name, n,
+                    percentile(values, 50)*1000, percentile(values, 99)*1000,
+                    len(values)/elapsed)
+        finally:
+            stop.set()
+            for t in slow_threads:
+                t.join()
+            server.quit()
+            server.shutdown()
+            serve_thread.join()
+            server.join()
+            server.server_close()
+
+
+def _serve(server):
+    '''Serve RPC requests in a background thread.
+
+    :returns: the thread.'''
+    server.logRequests = False
+    thread = Thread(target=server.serve_forever)
+    thread.start()
+    return thread
+
+
+def _import_views():
+    '''Configure the django project and import the stats views.
+
+    :returns: the stats views module, or None if django is not installed.'''
+    if MONITOR_DIR not in sys.path:
+        sys.path.insert(0, MONITOR_DIR)
+    try:
+        from django.core.management import setup_environ
+        import settings
+        setup_environ(settings)
+        from stats import views
+    except ImportError:
+        return None
+
+    return views
+
+
+def _setup_views(address):
+    '''Configure the django project and point the stats views at a
+    StatsServer.
+
+    :param address: the StatsServer address.
+    :returns: the stats views module, or None if django is not installed.'''
+    views = _import_views()
+    if views is None:
+        return None
+
+    from stats.client import ClientPool
+    views.POOL = ClientPool('http://%s:%d/' % address, views.SOCKET_TIMEOUT)
+    views.SNAPSHOTS.clear()
+    views.TABLES.clear()
+    return views
+
+
+# Dashboard resources, requested in turn by view benchmark clients.
+VIEWS = ['interface', 'ethernet', 'capture', 'history']
+
+
+def _view_client(repeat, latencies):
+    '''Request the dashboard resources repeat times, recording each
+    latency.
+
+    :param latencies: list to which (resource, latency) pairs are added.'''
+    from django.test.client import Client
+    client = Client()
+    for i in xrange(repeat):
+        name = VIEWS[i % len(VIEWS)]
+        start = time.time()
+        response = client.get('/stats/%s/' % name, {'tqx': 'reqId:%d' % i})
+        latencies.append((name, time.time() - start))
+        assert response.status_code == 200
+
+
+def bench_views(config):
+    '''Measure rendering of the stats views from a StatsServer.
+
+    Cold requests fetch a snapshot and render the table, warm requests are
+    served from the caches.
+
+    :param config: dict with the interface counts ('sizes') and the number of
+        requests per measurement ('repeat').'''
+    print 'views: mean time (ms) per request, cold and warm'
+    print '%10s %10s %10s %10s' % ('interfaces', 'view', 'cold', 'warm')
+
+    repeat = config['repeat']
+    for n in config['sizes']:
+        fd = FakeData(n)
+        server = ThreadedStatsServer(1, ('localhost', 0), ('localhost', 0),
+                                     retention=60)
+        now = time.time()
+        for t in (now - 1, now):
+            server._update_statistics('', parse_stats(str(fd)), t)
+        thread = _serve(server)
+
+        try:
+            views = _setup_views(server.server_address)
+            if views is None:
+                print 'views: django is not installed'
+                return
+
+            from django.test.client import Client
+            client = Client()
+            for name in VIEWS:
+                path = '/stats/%s/' % name
+                query = {'tqx': 'reqId:0'}
+                times = []
+                for i in xrange(repeat):
+                    views.SNAPSHOTS.clear()
+                    views.TABLES.clear()
+                    start = time.time()
+                    client.get(path, query)
+                    times.append(time.time() - start)
+                cold_t = sum(times)/repeat
+
+                start = time.time()
+                for i in xrange(repeat):
+                    client.get(path, query)
+                warm_t = (time.time() - start)/repeat
+
+                case = {'interfaces': n, 'view': name}
+                record(config, 'views', case, 'cold_ms', cold_t*1000)
+                record(config, 'views', case, 'warm_ms', warm_t*1000)
+                print '%10d %10s %10.3f %10.3f' % (n, name, cold_t*1000,
+                                                   warm_t*1000)
+        finally:
+            server.quit()
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+def bench_pipeline(config):
+    '''Load test the whole pipeline: concurrent dashboard clients request
+    the stats views, served from a StatsServer polling a FakeDas every
+    second.
+
+    :param config: dict with the interface counts ('sizes'), the client
+        concurrency levels ('clients') and the number of requests per client
+        ('repeat').'''
+    print 'pipeline: dashboard request latency vs client concurrency'
+    print '%10s %8s %10s %10s %12s' % ('interfaces', 'clients', 'p50 (ms)',
+                                       'p99 (ms)', 'requests/s')
+
+    for n in config['sizes']:
+        das = FakeDas(fake=FakeData(n))
+        das.start()
+        server = ThreadedStatsServer(1, ('localhost', 0),
+                                  [Target('', das.address, 1)])
+        server.start()
+        thread = _serve(server)
+
+        try:
+            # Wait for rates, which need two polls.
+            while not server._snapshot.counter_rates:
+                time.sleep(0.01)
+
+            if _setup_views(server.server_address) is None:
+                print 'pipeline: django is not installed'
+                return
+
+            for c in config['clients']:
+                latencies = []
+                clients = [Thread(target=_view_client,
+                                  args=(config['repeat'], latencies))
+                           for i in xrange(c)]
+
+                start = time.time()
+                for t in clients:
+                    t.start()
+                for t in clients:
+                    t.join()
+                elapsed = time.time() - start
+
+                case = {'interfaces': n, 'clients': c}
+                _record_latencies(config, 'pipeline', case, latencies,
+                                  elapsed)
+
+                values = [l for name, l in latencies]
+                print '%10d %8d %10.2f %10.2f %12.0f' % (n, c,
+                    percentile(values, 50)*1000, percentile(values, 99)*1000,
+                    len(values)/elapsed)
+        finally:
+            server.quit()
+            server.shutdown()
+            thread.join()
+            server.join()
+            server.server_close()
+            das.close()
+
+
+# Benchmarks by name, in the order they are run.
+BENCHMARKS = [
+    ('read', bench_read),
+    ('parse', bench_parse),
+    ('rates', bench_rates),
+    ('fake', bench_fake),
+    ('gviz', bench_gviz),
+    ('binary', bench_binary),
+    ('poll', bench_poll),
+    ('rpc', bench_rpc),
+    ('views', bench_views),
+    ('pipeline', bench_pipeline),
+    ]
+
+
+def usage():
+    print '''
+usage: StatsBenchmark -b <comma separated benchmark names>
+                      -s <comma separated interface counts>
+                      -c <comma separated client concurrency levels>
+                      -r <responses or calls per measurement>
+                      -t <time budget for legacy implementations(s)>
+                      -S <number of slow RPC clients>
+                      -o <file to write the results to, as JSON>
+                      -B <baseline results file to compare against>
+                      -x <relative change reported as a regression>
+                      -h   print this message.
+'''
+
+#------------------------------------------------------------------------------
+# Main program
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    NAMES = [name for name, fn in BENCHMARKS]
+    CONFIG = {
+        'sizes': DEFAULT_SIZES,
+        'clients': DEFAULT_CLIENTS,
+        'repeat': DEFAULT_REPEAT,
+        'budget': DEFAULT_BUDGET,
+        'slow': DEFAULT_SLOW,
+        'results': [],
+        }
+    OUTPUT = None
+    BASELINE = None
+    TOLERANCE = DEFAULT_TOLERANCE
+
+    # Parse command line options.
+    OPTIONS = 'b:s:c:r:t:S:o:B:x:h'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], OPTIONS)
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-b':
+            NAMES = a.split(',')
+        elif o == '-s':
+            CONFIG['sizes'] = [int(x) for x in a.split(',')]
+        elif o == '-c':
+            CONFIG['clients'] = [int(x) for x in a.split(',')]
+        elif o == '-r':
+            CONFIG['repeat'] = int(a)
+        elif o == '-t':
+            CONFIG['budget'] = float(a)
+        elif o == '-S':
+            CONFIG['slow'] = int(a)
+        elif o == '-o':
+            OUTPUT = a
+        elif o == '-B':
+            BASELINE = a
+        elif o == '-x':
+            TOLERANCE = float(a)
+        elif o == '-h':
+            usage()
+            sys.exit(2)
+        else:
+            usage()
+            assert False, 'Unhandled option: %s'%str(o)
+
+    for name, fn in BENCHMARKS:
+        if name in NAMES:
+            fn(CONFIG)
+            print
+
+    if OUTPUT is not None:
+        save_results(CONFIG, OUTPUT)
+    if BASELINE is not None and compare_results(CONFIG, BASELINE, TOLERANCE):
+        sys.exit(1)
@@ -0,0 +1,227 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Compact binary encoding for the StatsServer's binary transport. Values
+#   are encoded in the MessagePack format: None, booleans, integers, floats,
+#   strings, lists and dicts.
+#
+#   Counters and rates are sent as Packed arrays, MessagePack extension
+#   types holding little-endian unsigned 64-bit integers (PACKED_UINT64) or
+#   doubles (PACKED_FLOAT64). A whole array is converted by a single
+#   struct call on each side, instead of one string per value as with XML
+#   RPC.
+#
+#   A request is the list [method, params], POSTed to BINARY_PATH with the
+#   BINARY_CONTENT_TYPE. The response is {'result': value}, or
+#   {'fault': [code, message]} when the call failed.
+#------------------------------------------------------------------------------
+
+import struct
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Path and content type of binary requests and responses.
+BINARY_PATH = '/binary'
+BINARY_CONTENT_TYPE = 'application/x-msgpack'
+
+# Extension types of packed arrays, and their struct type codes.
+PACKED_UINT64 = 1
+PACKED_FLOAT64 = 2
+PACKED_CODES = {PACKED_UINT64: 'Q', PACKED_FLOAT64: 'd'}
+PACKED_TYPES = {'Q': PACKED_UINT64, 'd': PACKED_FLOAT64}
+
+_pack_double = struct.Struct('>d').pack
+_pack_int64 = struct.Struct('>q').pack
+_pack_uint64 = struct.Struct('>Q').pack
+_pack_uint16 = struct.Struct('>H').pack
+_pack_uint32 = struct.Struct('>I').pack
+
+
+class Packed(object):
+    '''An array of numbers encoded in one piece.'''
+
+
+    __slots__ = ('typecode', 'values')
+
+    def __init__(self, typecode, values):
+        '''Constructor.
+
+        :param typecode: 'Q' for unsigned 64-bit integers, 'd' for doubles.
+        :param values: sequence of numbers.'''
+        self.typecode = typecode
+        self.values = values
+
+    def __eq__(self, other):
+        return isinstance(other, Packed) and \
+            (self.typecode, tuple(self.values)) == \
+            (other.typecode, tuple(other.values))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Packed(%r, %r)' % (self.typecode, self.values)
+
+
+def _header(n, fix, fix_limit, code16, code32):
+    '''Return the header of a string, list or dict of n items.'''
+    if n < fix_limit:
+        return chr(fix | n)
+    if n < 0x10000:
+        return code16 + _pack_uint16(n)
+    return code32 + _pack_uint32(n)
+
+
+def _pack(value, out):
+    '''Append the encoding of a value to a list of strings.'''
+    t = type(value)
+    if t is str:
+        n = len(value)
+        if n < 32:
+            out.append(chr(0xa0 | n))
+        elif n < 0x100:
+            out.append('\xd9' + chr(n))
+        else:
+            out.append(_header(n, 0xa0, 0, '\xda', '\xdb'))
+        out.append(value)
+    elif t is float:
+        out.append('\xcb' + _pack_double(value))
+    elif t is int or t is long:
+        if 0 <= value < 0x80:
+            out.append(chr(value))
+        elif -32 <= value < 0:
+            out.append(chr(value & 0xff))
+        elif value < 0x8000000000000000:
+            out.append('\xd3' + _pack_int64(value))
+        else:
+            out.append('\xcf' + _pack_uint64(value))
+    elif t is list or t is tuple:
+        out.append(_header(len(value), 0x90, 16, '\xdc', '\xdd'))
+        for v in value:
+            _pack(v, out)
+    elif t is dict:
+        out.append(_header(len(value), 0x80, 16, '\xde', '\xdf'))
+        for k, v in value.iteritems():
+            _pack(k, out)
+            _pack(v, out)
+    elif value is None:
+        out.append('\xc0')
+    elif t is bool:
+        out.append(value and '\xc3' or '\xc2')
+    elif t is unicode:
+        _pack(value.encode('utf-8'), out)
+    elif t is Packed:
+        data = struct.pack('<%d%s' % (len(value.values), value.typecode),
+                           *value.values)
+        n = len(data)
+        if n < 0x100:
+            out.append('\xc7' + chr(n))
+        elif n < 0x10000:
+            out.append('\xc8' + _pack_uint16(n))
+        else:
+            out.append('\xc9' + _pack_uint32(n))
+        out.append(chr(PACKED_TYPES[value.typecode]))
+        out.append(data)
+    else:
+        raise TypeError('Cannot encode %s' % t.__name__)
+
+
+def pack(value):
+    '''Return the binary encoding of a value.'''
+    out = []
+    _pack(value, out)
+    return ''.join(out)
+
+
+def _unpack(data, offset):
+    '''Decode the value at an offset.
+
+    :returns: the value, and the offset following it.'''
+    b = ord(data[offset])
+    offset += 1
+
+    if b < 0x80:
+        return b, offset
+    if b >= 0xe0:
+        return b - 0x100, offset
+    if 0xa0 <= b < 0xc0:
+        n = b & 0x1f
+        return data[offset:offset + n], offset + n
+    if 0x90 <= b < 0xa0:
+        return _unpack_list(data, offset, b & 0x0f)
+    if 0x80 <= b < 0x90:
+        return _unpack_dict(data, offset, b & 0x0f)
+
+    if b == 0xc0:
+        return None, offset
+    if b == 0xc2:
+        return False, offset
+    if b == 0xc3:
+        return True, offset
+    if b == 0xcb:
+        return struct.unpack_from('>d', data, offset)[0], offset + 8
+    if b == 0xd3:
+        return struct.unpack_from('>q', data, offset)[0], offset + 8
+    if b == 0xcf:
+        return struct.unpack_from('>Q', data, offset)[0], offset + 8
+    if b == 0xd9:
+        n = ord(data[offset])
+        offset += 1
+        return data[offset:offset + n], offset + n
+    if b in (0xda, 0xdc, 0xde, 0xc8):
+        n = struct.unpack_from('>H', data, offset)[0]
+        offset += 2
+    elif b in (0xdb, 0xdd, 0xdf, 0xc9):
+        n = struct.unpack_from('>I', data, offset)[0]
+        offset += 4
+    elif b == 0xc7:
+        n = ord(data[offset])
+        offset += 1
+    else:
+        raise ValueError('Unsupported type 0x%02x at offset %d' %
+                         (b, offset - 1))
+
+    if b in (0xda, 0xdb):
+        return data[offset:offset + n], offset + n
+    if b in (0xdc, 0xdd):
+        return _unpack_list(data, offset, n)
+    if b in (0xde, 0xdf):
+        return _unpack_dict(data, offset, n)
+
+    # A packed array, as the tuple of its values.
+    code = PACKED_CODES.get(ord(data[offset]))
+    if code is None:
+        raise ValueError('Unsupported extension type %d' % ord(data[offset]))
+    offset += 1
+    return struct.unpack_from('<%d%s' % (n/8, code), data, offset), offset + n
+
+
+def _unpack_list(data, offset, n):
+    values = []
+    for i in xrange(n):
+        v, offset = _unpack(data, offset)
+        values.append(v)
+    return values, offset
+
+
+def _unpack_dict(data, offset, n):
+    values = dict()
+    for i in xrange(n):
+        k, offset = _unpack(data, offset)
+        values[k], offset = _unpack(data, offset)
+    return values, offset
+
+
+def unpack(data):
+    '''Decode a value from its binary encoding. Packed arrays are returned
+    as tuples.'''
+    try:
+        value, offset = _unpack(data, 0)
+    except (IndexError, struct.error), e:
+        raise ValueError('Truncated data: %s' % e)
+
+    if offset != len(data):
+        raise ValueError('%d bytes of trailing data' % (len(data) - offset))
+    return value
@@ -0,0 +1,255 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Fixed-memory history of interface statistics. Each interface has a ring
+#   buffer of timestamped samples in flat arrays of doubles. The arrays grow
+#   as samples are added, up to the number retained, and are then
+#   overwritten, so memory use does not grow beyond it over time.
+#
+#   Range queries can downsample the samples in a time range into a fixed
+#   number of buckets, each giving the min, max, average and last value of
+#   every field. Longer ranges are served from rollups (see StatsRollup).
+#------------------------------------------------------------------------------
+
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import izip
+
+
+def downsample(samples, start, end, buckets=0):
+    '''Aggregate time-ordered samples into equal-width time buckets.
+
+    :param samples: iterable of (time, values) pairs in time order, all
+        within [start, end].
+    :param start: start of the range.
+    :param end: end of the range.
+    :param buckets: number of equal-width buckets to divide the range
+        into, or 0 to return every sample.
+    :returns: a list of rows [time, count, mins, maxs, avgs, lasts], one
+        for each non-empty bucket, where time is the start of the bucket and
+        mins, maxs, avgs and lasts are lists with one entry per value.
+        Without buckets there is one row for each sample, with count 1.'''
+    if buckets <= 0 or end <= start:
+        rows = []
+        for t, v in samples:
+            v = list(v)
+            rows.append([t, 1, v, v, v, v])
+        return rows
+
+    width = float(end - start)/buckets
+    rows = []
+    current = None
+    for t, v in samples:
+        b = min(int((t - start)/width), buckets - 1)
+
+        if current is None or current[0] != b:
+            if current is not None:
+                rows.append(_finish_bucket(start, width, current))
+            current = [b, 1, list(v), list(v), list(v), v]
+            continue
+
+        current[1] += 1
+        mins, maxs, sums = current[2], current[3], current[4]
+        for k in xrange(len(sums)):
+            x = v[k]
+            if x < mins[k]:
+                mins[k] = x
+            if x > maxs[k]:
+                maxs[k] = x
+            sums[k] += x
+        current[5] = v
+
+    if current is not None:
+        rows.append(_finish_bucket(start, width, current))
+
+    return rows
+
+
+def downsample_columns(times, columns, start, end, buckets=0):
+    '''Aggregate time-ordered samples held by column, as downsample() does.
+
+    Each bucket is found by bisecting the times, and aggregated from slices
+    of the columns, so that no sample is handled on its own.
+
+    :param times: array of the samples' times in order, all within
+        [start, end].
+    :param columns: list of arrays, one per value, in step with times.
+    :param start: start of the range.
+    :param end: end of the range.
+    :param buckets: number of buckets, see downsample().
+    :returns: a list of rows, see downsample().'''
+    if buckets <= 0 or end <= start:
+        rows = []
+        for sample in izip(times, *columns):
+            v = list(sample[1:])
+            rows.append([sample[0], 1, v, v, v, v])
+        return rows
+
+    width = float(end - start)/buckets
+    rows = []
+    lo = 0
+    for b in xrange(buckets):
+        hi = len(times)
+        if b < buckets - 1:
+            hi = bisect_left(times, start + (b + 1)*width, lo)
+        if hi == lo:
+            continue
+
+        parts = [c[lo:hi] for c in columns]
+        n = hi - lo
+        rows.append([start + b*width, n, [min(p) for p in parts],
+                     [max(p) for p in parts],
+                     [sum(p)/n for p in parts], [p[-1] for p in parts]])
+        lo = hi
+
+    return rows
+
+
+def _finish_bucket(start, width, current):
+    '''Turn an accumulated bucket into a result row.'''
+    b, n, mins, maxs, sums, lasts = current
+    return [start + b*width, n, mins, maxs, [x/n for x in sums], list(lasts)]
+
+
+class Series(object):
+    '''Ring buffer of timestamped samples, each a vector of width values.'''
+
+
+    def __init__(self, capacity, width):
+        '''Constructor.
+
+        :param capacity: maximum number of samples retained.
+        :param width: number of values in each sample.'''
+        self.capacity = capacity
+        self.width = width
+
+        # Grown as samples are added, up to the capacity.
+        self.times = array('d')
+        self.values = array('d')
+
+        # Index of the oldest sample, and the number of samples held.
+        self.start = 0
+        self.count = 0
+
+    def append(self, timestamp, values):
+        '''Add a sample, overwriting the oldest one if the buffer is full.
+
+        Samples older than the newest one held are ignored.
+
+        :param timestamp: time of the sample.
+        :param values: sequence of width values.'''
+        if self.count and timestamp < self.time(self.count - 1):
+            return
+
+        if self.count < self.capacity:
+            self.times.append(timestamp)
+            self.values.extend(values)
+            self.count += 1
+            return
+
+        pos = self.start
+        self.start = (self.start + 1) % self.capacity
+
+        self.times[pos] = timestamp
+        offset = pos*self.width
+        self.values[offset:offset + self.width] = array('d', values)
+
+    def time(self, i):
+        '''Return the time of the i-th oldest sample.'''
+        return self.times[(self.start + i) % self.capacity]
+
+    def sample(self, i):
+        '''Return the values of the i-th oldest sample.'''
+        offset = ((self.start + i) % self.capacity)*self.width
+        return self.values[offset:offset + self.width]
+
+    def bisect(self, t, right=False):
+        '''Return the index of the first sample after (or at) time t.
+
+        :param t: the time to search for.
+        :param right: whether samples at time t are skipped.'''
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi)//2
+            m = self.time(mid)
+            if m < t or (right and m == t):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def query(self, start, end, buckets=0):
+        '''Return the samples between two times, optionally downsampled.
+
+        :param start: start of the range (inclusive).
+        :param end: end of the range (inclusive).
+        :param buckets: number of buckets, see downsample().
+        :returns: a list of rows, see downsample().'''
+        lo = self.bisect(start)
+        hi = self.bisect(end, right=True)
+        samples = ((self.time(i), self.sample(i)) for i in xrange(lo, hi))
+
+        if hi - lo <= buckets:
+            buckets = 0
+
+        return downsample(samples, start, end, buckets)
+
+    def oldest(self):
+        '''Return the time of the oldest sample, or None if empty.'''
+        if not self.count:
+            return None
+
+        return self.time(0)
+
+
+class StatsHistory(object):
+    '''History of statistics for a set of interfaces.'''
+
+
+    def __init__(self, fields, capacity):
+        '''Constructor.
+
+        :param fields: names of the values in each sample.
+        :param capacity: number of samples retained per interface.'''
+        self.fields = tuple(fields)
+        self.capacity = max(1, int(capacity))
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def record(self, id_, timestamp, values):
+        '''Record a sample for an interface.
+
+        :param id_: the interface id.
+        :param timestamp: time of the sample.
+        :param values: sequence of values, in fields order.'''
+        with self._lock:
+            series = self._series.get(id_)
+            if series is None:
+                series = Series(self.capacity, len(self.fields))
+                self._series[id_] = series
+            series.append(timestamp, values)
+
+    def query(self, id_, start, end, buckets=0):
+        '''Return an interface's samples between two times.
+
+        See Series.query(). Unknown interfaces have no samples.'''
+        with self._lock:
+            series = self._series.get(id_)
+            if series is None:
+                return []
+            return series.query(start, end, buckets)
+
+    def oldest(self, id_):
+        '''Return the time of an interface's oldest sample, or None.'''
+        with self._lock:
+            series = self._series.get(id_)
+            if series is None:
+                return None
+            return series.oldest()
+
+    def ids(self):
+        '''Return the ids of interfaces with recorded samples.'''
+        with self._lock:
+            return self._series.keys()
@@ -0,0 +1,242 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Instrumentation for the StatsServer. A Metrics registry holds counters
+#   and latency histograms, each identified by a name and optional labels
+#   such as the target or RPC method.
+#
+#   Metrics are updated once per poll or request rather than once per
+#   interface, and each update is an increment or a bisection into a short
+#   list of bucket bounds under a per-metric lock, so instrumentation can
+#   stay on at any number of interfaces.
+#
+#   The registry is exported as an XML-RPC struct, and in the Prometheus
+#   text exposition format.
+#------------------------------------------------------------------------------
+
+import threading
+from bisect import bisect_left
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Default upper bounds (s) of latency histogram buckets.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Content type of the Prometheus text exposition format.
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def _format_labels(labels, extra=()):
+    '''Return labels in Prometheus notation, e.g. {method="capture"}.
+
+    :param labels: tuple of (name, value) pairs.
+    :param extra: further pairs appended to the labels.'''
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+
+    escaped = []
+    for k, v in pairs:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"')
+        escaped.append('%s="%s"' % (k, v.replace('\n', '\\n')))
+    return '{%s}' % ','.join(escaped)
+
+
+def _format_value(value):
+    '''Return a sample value in Prometheus notation.'''
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class Counter(object):
+    '''A monotonically increasing count.'''
+
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        '''Constructor.
+
+        :param name: the metric name.
+        :param help: description of the metric.
+        :param labels: tuple of (name, value) pairs.'''
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        '''Add to the count.'''
+        with self._lock:
+            self.value += amount
+
+    def as_struct(self):
+        '''Return the metric as an XML-RPC struct.'''
+        return {
+            'name': self.name,
+            'type': self.kind,
+            'labels': dict(self.labels),
+            'value': float(self.value),
+            }
+
+    def samples(self):
+        '''Return the Prometheus samples as (name, labels, value) triples.'''
+        return [(self.name, _format_labels(self.labels), self.value)]
+
+
+class Histogram(object):
+    '''The distribution of observed values, counted in fixed buckets.'''
+
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        '''Constructor.
+
+        :param name: the metric name.
+        :param help: description of the metric.
+        :param labels: tuple of (name, value) pairs.
+        :param buckets: increasing upper bounds of the buckets. Values above
+            the last bound are only counted in the total.'''
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.bounds = tuple(buckets)
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        '''Record a value.'''
+        i = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative(self):
+        '''Return (bound, count of values <= bound) pairs, ending with an
+        infinite bound counting all values.'''
+        with self._lock:
+            counts = list(self.counts)
+
+        pairs = []
+        total = 0
+        for bound, n in zip(self.bounds + (float('inf'),), counts):
+            total += n
+            pairs.append((bound, total))
+        return pairs
+
+    def as_struct(self):
+        '''Return the metric as an XML-RPC struct. The last bucket bound
+        is given as the string "+Inf".'''
+        return {
+            'name': self.name,
+            'type': self.kind,
+            'labels': dict(self.labels),
+            'count': float(self.count),
+            'sum': self.sum,
+            'buckets': [[_format_value(b) if b == float('inf') else b,
+                         float(n)] for b, n in self.cumulative()],
+            }
+
+    def samples(self):
+        samples = []
+        for bound, n in self.cumulative():
+            samples.append((self.name + '_bucket',
+                            _format_labels(self.labels,
+                                           (('le', _format_value(bound)),)),
+                            n))
+
+        labels = _format_labels(self.labels)
+        samples.append((self.name + '_sum', labels, self.sum))
+        samples.append((self.name + '_count', labels, self.count))
+        return samples
+
+
+class Metrics(object):
+    '''Registry of counters and histograms.'''
+
+
+    def __init__(self, prefix=''):
+        '''Constructor.
+
+        :param prefix: prefix added to the name of every metric.'''
+        self.prefix = prefix
+        self._lock = threading.Lock()
+
+        # Metrics keyed by (name, labels), and the names in creation order.
+        self._metrics = dict()
+        self._names = []
+
+    def counter(self, name, help, **labels):
+        '''Return a counter, creating it on first use.
+
+        :param name: the metric name, without the registry prefix.
+        :param help: description of the metric.
+        :param labels: label values distinguishing it from others of the
+            same name.'''
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        '''Return a histogram, creating it on first use.
+
+        :param buckets: upper bounds of the buckets, used on creation.'''
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def _get(self, kind, name, help, labels, *args):
+        key = (self.prefix + name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is not None:
+            return metric
+
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = kind(key[0], help, key[1], *args)
+                if key[0] not in self._names:
+                    self._names.append(key[0])
+                self._metrics[key] = metric
+
+        return metric
+
+    def _grouped(self):
+        '''Return lists of metrics sharing a name, in creation order.'''
+        with self._lock:
+            metrics = self._metrics.values()
+            names = list(self._names)
+
+        groups = dict((name, []) for name in names)
+        for m in metrics:
+            groups[m.name].append(m)
+        return [sorted(groups[name], key=lambda m: m.labels)
+                for name in names]
+
+    def as_struct(self):
+        '''Return all metrics as a list of XML-RPC structs.'''
+        return [m.as_struct() for group in self._grouped() for m in group]
+
+    def prometheus(self):
+        '''Return all metrics in the Prometheus text exposition format.'''
+        lines = []
+        for group in self._grouped():
+            first = group[0]
+            lines.append('# HELP %s %s' % (first.name,
+                first.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (first.name, first.kind))
+            for m in group:
+                for name, labels, value in m.samples():
+                    lines.append('%s%s %s' % (name, labels,
+                                              _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,174 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Rate computation for interface counters. A RateEngine keeps the last
+#   counters and sample time of every interface, and turns each batch of new
+#   counters into per-second rates for all counters of all interfaces at
+#   once.
+#
+#   Counters are unsigned and may wrap around or be reset by the acquisition
+#   system. The difference between two readings is taken modulo the counter
+#   range, which handles a wraparound. A difference of more than half the
+#   range cannot be a wraparound at any plausible rate, so it is taken as a
+#   reset to zero and the new reading is used as the difference.
+#
+#   NumPy is used when it is installed, otherwise the batch is processed in
+#   a single pass over flat lists.
+#------------------------------------------------------------------------------
+
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Default width (bits) of the acquisition system's counters.
+COUNTER_BITS = 64
+
+# Number of interfaces for which space is allocated at first.
+INITIAL_CAPACITY = 64
+
+
+class RateEngine(object):
+    '''Compute counter rates for a set of interfaces.'''
+
+
+    def __init__(self, width, bits=COUNTER_BITS, vectorize=None):
+        '''Constructor.
+
+        :param width: number of counters per interface.
+        :param bits: width (bits) of each counter.
+        :param vectorize: whether to use NumPy, or None to use it when it is
+            installed.'''
+        if vectorize is None:
+            vectorize = numpy is not None
+        if vectorize and numpy is None:
+            raise ValueError('NumPy is not installed')
+
+        self.width = width
+        self.bits = bits
+        self.vectorize = vectorize
+        self._mask = (1 << bits) - 1
+        self._half = 1 << (bits - 1)
+
+        # Index of each interface in the state arrays.
+        self._index = dict()
+
+        if vectorize:
+            self._counters = numpy.zeros((INITIAL_CAPACITY, width),
+                                         dtype=numpy.uint64)
+            self._times = numpy.empty(INITIAL_CAPACITY)
+            self._times.fill(numpy.nan)
+        else:
+            self._counters = []
+            self._times = []
+
+    def update(self, ids, rows, timestamp):
+        '''Record new counters and return the rates since the last ones.
+
+        :param ids: list of interface ids.
+        :param rows: list of counter sequences, one for each id, each of
+            width unsigned integers.
+        :param timestamp: time the counters were read.
+        :returns: a list with, for each id, a list of width rates in units
+            per second, or None if there is no earlier sample to compare
+            with. Samples no newer than an interface's last one give None and
+            are otherwise ignored.'''
+        slots = [self._slot(id_) for id_ in ids]
+        if self.vectorize:
+            return self._update_arrays(slots, rows, timestamp)
+
+        return self._update_lists(slots, rows, timestamp)
+
+    def ids(self):
+        '''Return the ids of interfaces seen so far.'''
+        return self._index.keys()
+
+    def _slot(self, id_):
+        '''Return an interface's index, allocating one if needed.'''
+        slot = self._index.get(id_)
+        if slot is not None:
+            return slot
+
+        slot = len(self._index)
+        self._index[id_] = slot
+        if not self.vectorize:
+            self._counters.append(None)
+            self._times.append(None)
+        elif slot == len(self._times):
+            self._grow()
+
+        return slot
+
+    def _grow(self):
+        '''Double the size of the state arrays.'''
+        n = len(self._times)
+        counters = numpy.zeros((2*n, self.width), dtype=numpy.uint64)
+        counters[:n] = self._counters
+        times = numpy.empty(2*n)
+        times.fill(numpy.nan)
+        times[:n] = self._times
+        self._counters, self._times = counters, times
+
+    def _update_lists(self, slots, rows, timestamp):
+        '''Compute rates one interface after another.'''
+        mask, half = self._mask, self._half
+        counters, times = self._counters, self._times
+        rates = []
+
+        for slot, row in izip(slots, rows):
+            last = times[slot]
+            if last is None:
+                counters[slot] = row
+                times[slot] = timestamp
+                rates.append(None)
+                continue
+
+            dt = float(timestamp - last)
+            if dt <= 0:
+                rates.append(None)
+                continue
+
+            deltas = [(n - o) & mask for n, o in izip(row, counters[slot])]
+            if max(deltas) > half:
+                deltas = [d if d <= half else n for d, n in izip(deltas, row)]
+
+            counters[slot] = row
+            times[slot] = timestamp
+            rates.append([d/dt for d in deltas])
+
+        return rates
+
+    def _update_arrays(self, slots, rows, timestamp):
+        '''Compute rates for all interfaces as array operations.'''
+        if not slots:
+            return []
+
+        slots = numpy.array(slots, dtype=numpy.intp)
+        new = numpy.array(rows, dtype=numpy.uint64).reshape(len(slots),
+                                                              self.width)
+        old = self._counters[slots]
+        dt = timestamp - self._times[slots]
+
+        # Unsigned subtraction wraps modulo 2**64.
+        delta = new - old
+        if self.bits < 64:
+            delta &= numpy.uint64(self._mask)
+        delta = numpy.where(delta > numpy.uint64(self._half), new, delta)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            rates = delta/dt[:, numpy.newaxis]
+
+        # Interfaces seen for the first time have no time (NaN) and are
+        # stored; stale samples are not.
+        store = ~(dt <= 0)
+        self._counters[slots[store]] = new[store]
+        self._times[slots[store]] = timestamp
+
+        valid = (dt > 0).tolist()
+        return [r if v else None for r, v in izip(rates.tolist(), valid)]
@@ -7,66 +7,380 @@
 #
 #   Simple stats server implemented for a VDAS demonstration. This server
 #   reads data from a data acquisition system via an XML interface and then
-#   publishes it via a RESTful interface.
+#   publishes it via a RESTful interface, as JSON.
 #
-#   The StatServer class is responsible for acquiring the data, and then 
-#   serving it up. It can either acquire data from a live system, or generate
-#   fake data.
+#   The StatsRestServer shares the polling engine of a StatsServer running
+#   in the same process, and answers every request from its latest
+#   snapshot, without an XML RPC call in between. The resources are:
 #
-#   To generate and publish a fake data stream, use a command line similar to:
+#       /interface/<id>: interface counters, as returned by interface().
+#       /ethernet/<id>: interface rate (Gbps), as returned by ethernet().
+#       /capture: total capture rate (Gbps), or a single target's with
+#           ?target=<name>.
+#       /snapshot: all statistics from one update, as returned by
+#           snapshot().
+#       /interfaces: the interfaces discovered, as returned by
+#           list_interfaces().
+#
+#   Each response carries an ETag naming the snapshot it was rendered from.
+#   A request for a resource in the current snapshot whose If-None-Match
+#   matches it is answered with 304 Not Modified and no body, before
+#   anything is rendered, so
+#   clients polling faster than the acquisition system cost neither
+#   rendering nor transfer until it has changed. Bodies are rendered once
+#   per snapshot and shared by all requests for the same resource and
+#   parameters, whatever their order or other parameters, such as cache
+#   busters, the request carries.
 #
-#       $ python StatsServer.py -F
+#   To generate and publish a fake data stream, use a command line similar to:
 #
-#   The FakeData class handles fake data generation.
+#       $ python StatsRestServer.py -F
 #
-#   The parse_stats() function is responsible for handling the XML response
-#   from the data acquisition system.
+#   The XML RPC interface stays available on its own port (-x).
 #------------------------------------------------------------------------------
 
 import getopt
-import random
+import json
 import re
-import socket
-import string
 import sys
 import time
-import web
-from copy import copy
-from threading import Thread
-from xml.etree.ElementTree import fromstring
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread
+from SocketServer import ThreadingMixIn
+
+from StatsSchedule import timestamp
+from StatsServer import HISTORY_RETENTION, ThreadedStatsServer, to_gbps
+from StatsSimulation import PROFILES, FakeData
 
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Resources, as (name, path pattern) pairs.
 urls = (
-    '/', 'Index',
-    '/interface/(\d+)', 'Interface',
-    '/ethernet/(\d+)', 'Ethernet',
-    '/capture', 'Capture',
-)
+    ('index', re.compile(r'^/$')),
+    ('interface', re.compile(r'^/interface/([^/]+)$')),
+    ('ethernet', re.compile(r'^/ethernet/([^/]+)$')),
+    ('capture', re.compile(r'^/capture$')),
+    ('snapshot', re.compile(r'^/snapshot$')),
+    ('interfaces', re.compile(r'^/interfaces$')),
+    )
+
+# Query parameters used by each resource; others are ignored.
+PARAMETERS = {
+    'capture': ('target',),
+    }
+
+# Content type of every response.
+JSON_CONTENT_TYPE = 'application/json'
+
+
+class NotFound(Exception):
+    '''Raised by a resource that does not exist.'''
+
+
+def render_index(snapshot, arg, query):
+    return ['/interface/<id>', '/ethernet/<id>', '/capture', '/snapshot',
+            '/interfaces']
+
+
+def render_interface(snapshot, id_, query):
+    if not snapshot.counters.has_key(id_):
+        raise NotFound('Unknown interface: %s' % id_)
+
+    return [str(x) for x in snapshot.counters[id_]]
+
+
+def render_ethernet(snapshot, id_, query):
+    if not snapshot.counters.has_key(id_):
+        raise NotFound('Unknown interface: %s' % id_)
+
+    return to_gbps(snapshot.rates.get(id_, 0))
+
+
+def render_capture(snapshot, arg, query):
+    target = query.get('target')
+    if target is None:
+        return to_gbps(snapshot.capture_rate)
+
+    target = target[0]
+    if not snapshot.capture_rates.has_key(target):
+        raise NotFound('Unknown target: %s' % target)
+
+    return to_gbps(snapshot.capture_rates[target])
+
+
+def render_snapshot(snapshot, arg, query):
+    return snapshot.as_struct()
+
+
+def render_interfaces(snapshot, arg, query):
+    return snapshot.interfaces.as_struct()
+
+
+def resource_exists(snapshot, name, arg, query):
+    '''Return whether a resource is in a snapshot, without rendering it.
+
+    :param snapshot: the Snapshot.
+    :param name: the resource name.
+    :param arg: the argument taken from the path, or None.
+    :param query: the parameters, as returned by normalize_query().'''
+    if name in ('interface', 'ethernet'):
+        return snapshot.counters.has_key(arg)
+    if name == 'capture':
+        target = dict(query).get('target')
+        return target is None or snapshot.capture_rates.has_key(target[0])
+    return True
 
-class Index:
 
-    def GET(self):
-        print 'hello'
+# Renders each resource from a Snapshot, given the path argument and query.
+RENDERERS = {
+    'index': render_index,
+    'interface': render_interface,
+    'ethernet': render_ethernet,
+    'capture': render_capture,
+    'snapshot': render_snapshot,
+    'interfaces': render_interfaces,
+    }
 
 
-class Interface:
+def normalize_query(name, query):
+    '''Return the parameters of a query string used by a resource, as a
+    tuple of (name, values) pairs in order of name.'''
+    used = PARAMETERS.get(name)
+    if not used or not query:
+        return ()
 
-    def GET(self, id):
-        return 'hello, %s' % id
+    params = urlparse.parse_qs(query, keep_blank_values=True)
+    return tuple([(k, tuple(params[k])) for k in sorted(params)
+                  if k in used])
 
-class Ethernet:
 
-    def GET(self, id):
-        print 'ethernet, ', id
+class RestRequestHandler(BaseHTTPRequestHandler):
+    '''Answer REST requests from the latest snapshot.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    # Close connections left idle for longer than this (s).
+    timeout = 30
+
+    def do_GET(self):
+        start = timestamp()
+        server = self.server
+        path, _, query = self.path.partition('?')
+
+        for name, pattern in urls:
+            match = pattern.match(path)
+            if match is not None:
+                break
+        else:
+            self.send_json(404, {'error': 'Not found: %s' % path})
+            return
+
+        arg = None
+        if match.groups():
+            arg = urllib.unquote(match.group(1))
+
+        snapshot = server.stats.latest()
+        query = normalize_query(name, query)
+        etag = server.etag(snapshot)
+        # A resource not in the snapshot is rendered, to raise NotFound.
+        if resource_exists(snapshot, name, arg, query) and \
+           self.not_modified(etag):
+            self.send_body(304, '', etag)
+        else:
+            try:
+                body = server.render(snapshot, name, arg, query)
+            except NotFound, e:
+                self.send_json(404, {'error': str(e)})
+                return
+            self.send_body(200, body, etag)
+
+        server.stats.metrics.histogram('rest_seconds',
+            'Time to handle a REST request.',
+            resource=name).observe(timestamp() - start)
+
+    def not_modified(self, etag):
+        '''Return whether the request's If-None-Match matches an ETag.'''
+        header = self.headers.getheader('If-None-Match')
+        if header is None:
+            return False
+
+        tags = [t.strip() for t in header.split(',')]
+        return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+    def send_json(self, code, value, etag=None):
+        '''Send a response with a JSON body.'''
+        self.send_body(code, json.dumps(value), etag)
+
+    def send_body(self, code, body, etag=None):
+        '''Send a response with an already rendered body.'''
+        self.send_response(code)
+        if code != 304:
+            self.send_header('Content-Type', JSON_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        if code != 304:
+            self.wfile.write(body)
+
+    def log_request(self, code='-', size='-'):
+        if self.server.logRequests:
+            BaseHTTPRequestHandler.log_request(self, code, size)
+
+
+class StatsRestServer(ThreadingMixIn, HTTPServer):
+    '''Serve a StatsServer's statistics as JSON over HTTP.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+    logRequests = True
+
+    def __init__(self, address_tuple, stats):
+        '''Constructor.
+
+        :param address_tuple: the tuple (<ip address>, <port>).
+        :param stats: the StatsServer whose snapshots are served.'''
+        HTTPServer.__init__(self, address_tuple, RestRequestHandler)
+        self.stats = stats
+
+        # Distinguishes this server's ETags from those of earlier runs,
+        # whose snapshot versions started from the same number.
+        self._epoch = '%x' % int(time.time()*1000)
+
+        # Bodies rendered from the latest snapshot, keyed by request.
+        self._lock = Lock()
+        self._version = None
+        self._bodies = dict()
+
+    def etag(self, snapshot):
+        '''Return the ETag of responses rendered from a snapshot.'''
+        return '"%s-%d"' % (self._epoch, snapshot.version)
+
+    def render(self, snapshot, name, arg, query):
+        '''Return the JSON body of a resource, rendering it once per
+        snapshot.
+
+        :param snapshot: the Snapshot to render from.
+        :param name: the resource name.
+        :param arg: the argument taken from the path, or None.
+        :param query: the parameters, as returned by normalize_query().'''
+        key = (name, arg, query)
+        with self._lock:
+            if self._version == snapshot.version:
+                body = self._bodies.get(key)
+                if body is not None:
+                    return body
+
+        body = json.dumps(RENDERERS[name](snapshot, arg,
+                                          dict((k, list(v))
+                                               for k, v in query)))
+
+        with self._lock:
+            if self._version != snapshot.version:
+                self._version = snapshot.version
+                self._bodies = dict()
+            self._bodies[key] = body
+
+        return body
+
+
+def usage():
+    print '''
+usage: StatsRestServer -l <logger host>
+                       -p <logger port>
+                       -b <REST bind port>
+                       -x <XML RPC bind port>
+                       -i <polling interval(s)>
+                       -r <history retention(s)>
+                       -d <history store directory>
+                       -F   generate fake data
+                       -n <number of fake interfaces>
+                       -P <fake traffic profile: %s>
+                       -h   print this message.
+''' % ', '.join(sorted(PROFILES.keys()))
+
+#------------------------------------------------------------------------------
+# Main program
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    # Configuration variables with their defaults.
+    LOGGER_PORT = 6050
+    BIND_PORT = 8080
+    RPC_PORT = 9000
+    LOGGER_HOST = 'localhost'
+    POLLING_INTERVAL = 5
+    RETENTION = HISTORY_RETENTION
+    STORE = None
+    FAKE = False
+    FAKE_INTERFACES = 4
+    FAKE_PROFILE = 'steady'
 
+    # Parse command line options.
+    OPTIONS = 'l:p:b:x:i:r:d:n:P:hF'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], OPTIONS)
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
 
-class Capture:
+    for o, a in opts:
+        if o == '-l':
+            LOGGER_HOST = a
+        elif o == '-p':
+            LOGGER_PORT = int(a)
+        elif o == '-b':
+            BIND_PORT = int(a)
+        elif o == '-x':
+            RPC_PORT = int(a)
+        elif o == '-i':
+            POLLING_INTERVAL = float(a)
+        elif o == '-r':
+            RETENTION = int(a)
+        elif o == '-d':
+            STORE = a
+        elif o == '-F':
+            FAKE = True
+        elif o == '-n':
+            FAKE_INTERFACES = int(a)
+        elif o == '-P':
+            if not PROFILES.has_key(a):
+                print 'Unknown traffic profile: %s' % a
+                usage()
+                sys.exit(2)
+            FAKE_PROFILE = a
+        elif o == '-h':
+            usage()
+            sys.exit(2)
+        else:
+            usage()
+            assert False, 'Unhandled option: %s'%str(o)
 
-    def GET(self, id):
-        print 'capture, ', id
+    if FAKE:
+        FAKE = FakeData(FAKE_INTERFACES, FAKE_PROFILE, POLLING_INTERVAL)
 
+    # The StatsServer polls, and serves XML RPC in the background.
+    stats = ThreadedStatsServer(POLLING_INTERVAL, ('localhost', RPC_PORT),
+                                (LOGGER_HOST, LOGGER_PORT), FAKE, RETENTION,
+                                STORE)
+    stats.start()
+    rpc_thread = Thread(target=stats.serve_forever)
+    rpc_thread.daemon = True
+    rpc_thread.start()
 
-app = web.application(urls, globals())
+    server = StatsRestServer(('', BIND_PORT), stats)
+    print '** Serving REST on port %d' % BIND_PORT
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
 
-if __name__ == "__main__":
-    app.run()
+    stats.quit()
+    stats.shutdown()
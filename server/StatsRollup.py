@@ -0,0 +1,444 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Rollups of interface statistics for long time ranges. Each interface's
+#   samples are aggregated into buckets of 10 s, 1 min and 1 h, each holding
+#   the number of samples and the min, max, mean and last of every value,
+#   so that a chart of a day or a month is drawn from a few hundred rows
+#   rather than from every sample.
+#
+#   The rollups are maintained as samples are recorded. The samples of the
+#   latest 10 s are kept as they are, and only aggregated, column by column,
+#   once a sample falls in a later bucket. The bucket is then stored in the
+#   finest level, and merged into the open bucket of the next level when it
+#   closes, and so on, so recording a sample costs one append, and each level
+#   one merge per bucket of the level below.
+#
+#   Each level keeps its closed buckets in a ring of flat arrays of doubles,
+#   grown as buckets are added up to the level's retention, after which the
+#   oldest buckets are overwritten.
+#
+#   When a StatsServer restarts, each interface's rollups are rebuilt from
+#   its stored samples by load(). Each level is built directly from the
+#   samples within its retention that no finer level holds, a bucket at a
+#   time from slices of the samples' columns, so that a week of samples is
+#   not recorded again one at a time.
+#
+#   A query for a number of points uses the coarsest level whose buckets
+#   are no wider than the points, and merges its buckets into the points,
+#   with the open buckets of the finer levels and the latest samples, which
+#   have yet to be merged into it.
+#------------------------------------------------------------------------------
+
+import operator
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import izip
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Rollup levels, as (bucket width (s), retention (s)), finest first.
+ROLLUP_LEVELS = ((10, 3*3600), (60, 26*3600), (3600, 30*86400))
+
+
+def check_levels(levels):
+    '''Check rollup levels, returning them finest first.
+
+    Each level's buckets must be a whole number of the finer level's, so
+    that they are merged whole, and retained for at least one bucket.
+
+    :param levels: sequence of (bucket width (s), retention (s)) pairs.
+    :raises ValueError: if the levels are not valid.'''
+    levels = tuple(sorted(levels))
+    if not levels:
+        raise ValueError('No rollup levels')
+
+    previous = None
+    for resolution, retention in levels:
+        if resolution <= 0 or retention < resolution:
+            raise ValueError('Invalid rollup level: %s:%s' % (resolution,
+                                                              retention))
+        if previous is not None and resolution % previous:
+            raise ValueError('Rollup level of %ss is not a multiple of %ss'
+                             % (resolution, previous))
+        previous = resolution
+
+    return levels
+
+
+def parse_levels(spec):
+    '''Parse rollup levels from a command line specification.
+
+    :param spec: comma-separated <bucket width(s)>:<retention(s)> pairs,
+        e.g. '10:10800,60:93600'.
+    :raises ValueError: if the specification is not valid.'''
+    levels = []
+    for level in spec.split(','):
+        try:
+            resolution, retention = level.split(':')
+            levels.append((int(resolution), int(retention)))
+        except ValueError:
+            raise ValueError('Invalid rollup level: %s' % level)
+
+    return check_levels(levels)
+
+# Aggregates held for each value of a bucket, in the order they are stored.
+AGGREGATES = ('min', 'max', 'sum', 'last')
+
+
+def _merge(bucket, count, mins, maxs, sums, lasts):
+    '''Merge aggregates into an open bucket [time, count, mins, maxs, sums,
+    lasts], as of later samples.'''
+    bucket[1] += count
+    bucket[2] = map(min, bucket[2], mins)
+    bucket[3] = map(max, bucket[3], maxs)
+    bucket[4] = map(operator.add, bucket[4], sums)
+    bucket[5] = lasts
+
+
+def summarize(t, samples):
+    '''Aggregate samples into a bucket [time, count, mins, maxs, sums,
+    lasts].'''
+    columns = zip(*samples)
+    return [t, len(samples), map(min, columns), map(max, columns),
+            map(sum, columns), list(samples[-1])]
+
+
+def summarize_columns(t, columns, lo, hi):
+    '''Aggregate the samples lo to hi of columns into a bucket [time,
+    count, mins, maxs, sums, lasts].'''
+    parts = [c[lo:hi] for c in columns]
+    return [t, hi - lo, [min(p) for p in parts], [max(p) for p in parts],
+            [sum(p) for p in parts], [p[-1] for p in parts]]
+
+
+def aggregate(buckets, start, end, points):
+    '''Merge time-ordered buckets into equal-width points.
+
+    :param buckets: iterable of [time, count, mins, maxs, sums, lasts] in
+        time order.
+    :param start: start of the range.
+    :param end: end of the range.
+    :param points: number of equal-width points to divide the range into,
+        or 0 to keep every bucket.
+    :returns: a list of rows [time, count, mins, maxs, avgs, lasts], one for
+        each non-empty point, as returned by StatsHistory.downsample().'''
+    rows = []
+    if points <= 0 or end <= start:
+        for t, n, mins, maxs, sums, lasts in buckets:
+            rows.append([t, n, list(mins), list(maxs),
+                         [x/float(n) for x in sums], list(lasts)])
+        return rows
+
+    width = float(end - start)/points
+    current = None
+    for t, n, mins, maxs, sums, lasts in buckets:
+        b = min(max(int((t - start)/width), 0), points - 1)
+        if current is not None and current[0] == b:
+            _merge(current, n, mins, maxs, sums, lasts)
+            continue
+
+        if current is not None:
+            rows.append(_finish(start, width, current))
+        current = [b, n, list(mins), list(maxs), list(sums), list(lasts)]
+
+    if current is not None:
+        rows.append(_finish(start, width, current))
+
+    return rows
+
+
+def _finish(start, width, current):
+    '''Turn a merged point into a result row.'''
+    b, n, mins, maxs, sums, lasts = current
+    return [start + b*width, n, mins, maxs, [x/float(n) for x in sums],
+            list(lasts)]
+
+
+class RollupLevel(object):
+    '''The buckets of one interface at one level.'''
+
+
+    def __init__(self, resolution, capacity, width):
+        '''Constructor.
+
+        :param resolution: width (s) of the buckets.
+        :param capacity: maximum number of closed buckets retained.
+        :param width: number of values in each sample.'''
+        self.resolution = resolution
+        self.capacity = max(1, int(capacity))
+        self.width = width
+
+        # Closed buckets: start times, sample counts, and for each the
+        # aggregates of AGGREGATES, width values each.
+        self.times = array('d')
+        self.counts = array('d')
+        self.values = array('d')
+        self.start = 0
+
+        # The open bucket, as [time, count, mins, maxs, sums, lasts].
+        self.open = None
+
+    def add(self, t, count, mins, maxs, sums, lasts):
+        '''Add a sample, or the aggregates of a finer bucket.
+
+        :returns: the bucket closed by it, or None.'''
+        bucket = t - t % self.resolution
+        current = self.open
+        if current is not None:
+            if bucket == current[0]:
+                _merge(current, count, mins, maxs, sums, lasts)
+                return None
+            if bucket < current[0]:
+                # Older than the open bucket.
+                return None
+
+        self.open = [bucket, count, list(mins), list(maxs), list(sums),
+                     list(lasts)]
+        if current is not None:
+            self._store(current)
+        return current
+
+    def _store(self, bucket):
+        '''Append a closed bucket, overwriting the oldest one if full.'''
+        t, n, mins, maxs, sums, lasts = bucket
+        values = array('d', mins + maxs + sums + lasts)
+        if len(self.times) < self.capacity:
+            self.times.append(t)
+            self.counts.append(n)
+            self.values.extend(values)
+            return
+
+        pos = self.start
+        self.start = (self.start + 1) % self.capacity
+        self.times[pos] = t
+        self.counts[pos] = n
+        offset = pos*4*self.width
+        self.values[offset:offset + 4*self.width] = values
+
+    def _bucket(self, i):
+        '''Return the i-th oldest closed bucket.'''
+        pos = (self.start + i) % len(self.times)
+        w = self.width
+        offset = pos*4*w
+        values = self.values[offset:offset + 4*w]
+        return [self.times[pos], self.counts[pos], values[:w],
+                values[w:2*w], values[2*w:3*w], values[3*w:]]
+
+    def _time(self, i):
+        return self.times[(self.start + i) % len(self.times)]
+
+    def oldest(self):
+        '''Return the start of the oldest bucket, or None if empty.'''
+        if self.times:
+            return self._time(0)
+        if self.open is not None:
+            return self.open[0]
+        return None
+
+    def query(self, start, end, later=()):
+        '''Return the buckets overlapping a time range, oldest first, each
+        as [time, count, mins, maxs, sums, lasts].
+
+        :param later: later buckets, not yet added, to include too.'''
+        first = start - self.resolution
+        lo, hi = 0, len(self.times)
+        while lo < hi:
+            mid = (lo + hi)//2
+            if self._time(mid) <= first:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        buckets = []
+        for i in xrange(lo, len(self.times)):
+            if self._time(i) >= end:
+                break
+            buckets.append(self._bucket(i))
+
+        current = self.open
+        if current is not None and first < current[0] < end:
+            buckets.append([current[0], current[1], list(current[2]),
+                            list(current[3]), list(current[4]),
+                            list(current[5])])
+
+        for bucket in later:
+            if first < bucket[0] < end:
+                buckets.append(bucket)
+
+        return buckets
+
+
+class StatsRollups(object):
+    '''Rollups of statistics for a set of interfaces.'''
+
+
+    def __init__(self, fields, levels=ROLLUP_LEVELS):
+        '''Constructor.
+
+        :param fields: names of the values in each sample.
+        :param levels: sequence of (bucket width (s), retention (s)) pairs,
+            see check_levels().'''
+        self.fields = tuple(fields)
+        self.levels = check_levels(levels)
+        self._rollups = dict()
+        self._lock = threading.Lock()
+
+    def record(self, id_, timestamp, values):
+        '''Record a sample for an interface.
+
+        :param id_: the interface id.
+        :param timestamp: time of the sample.
+        :param values: sequence of values, in fields order.'''
+        bucket = timestamp - timestamp % self.levels[0][0]
+        with self._lock:
+            # Each interface's rollup is [time of the latest bucket, its
+            # samples, levels].
+            rollup = self._rollups.get(id_)
+            if rollup is None:
+                self._rollups[id_] = [bucket, [values], self._new_levels()]
+                return
+
+            if bucket == rollup[0]:
+                rollup[1].append(values)
+                return
+            if bucket < rollup[0]:
+                # Older than the latest bucket.
+                return
+
+            closed = summarize(rollup[0], rollup[1])
+            rollup[0] = bucket
+            rollup[1] = [values]
+            for level in rollup[2]:
+                closed = level.add(*closed)
+                if closed is None:
+                    break
+
+    def load(self, id_, times, columns, now):
+        '''Rebuild an interface's rollups from its samples, replacing any.
+
+        :param id_: the interface id.
+        :param times: array of the samples' times in order.
+        :param columns: list of arrays, one per field, in step with times.
+        :param now: the current time, from which the levels' retention is
+            counted.'''
+        if not len(times):
+            return
+
+        # The latest bucket's samples are kept as they are.
+        latest = times[-1] - times[-1] % self.levels[0][0]
+        end = bisect_left(times, latest)
+
+        levels = self._new_levels()
+        lo = 0
+        for k in xrange(len(levels) - 1, -1, -1):
+            resolution, retention = self.levels[k]
+            start = now - retention
+            lo = max(lo, bisect_left(times, start - start % resolution, 0,
+                                     end))
+
+            # Later samples are held by the finer level, from the start of
+            # its oldest bucket.
+            hi = end
+            if k:
+                finer, finer_retention = self.levels[k - 1]
+                start = now - finer_retention
+                hi = max(lo, bisect_left(times, start - start % finer, 0,
+                                         end))
+
+            while lo < hi:
+                t = times[lo]
+                bucket = t - t % resolution
+                next_lo = bisect_left(times, bucket + resolution, lo, hi)
+                closed = summarize_columns(bucket, columns, lo, next_lo)
+                for level in levels[k:]:
+                    closed = level.add(*closed)
+                    if closed is None:
+                        break
+                lo = next_lo
+
+        samples = list(izip(*[c[end:] for c in columns]))
+        with self._lock:
+            self._rollups[id_] = [latest, samples, levels]
+
+    def _new_levels(self):
+        '''Return the empty levels of an interface.'''
+        width = len(self.fields)
+        return [RollupLevel(r, retention/r, width)
+                for r, retention in self.levels]
+
+    def query(self, id_, start, end, points, cover=True):
+        '''Return an interface's statistics between two times, in at most a
+        number of points.
+
+        The coarsest level whose buckets are no wider than the points is
+        used, so that the points are as fine as they can be while as few
+        buckets as possible are read.
+
+        :param id_: the interface id.
+        :param start: start of the range.
+        :param end: end of the range.
+        :param points: the largest number of points to return.
+        :param cover: whether only levels holding buckets from the start of
+            the range may be used. Otherwise the level holding the oldest
+            buckets is used when none does.
+        :returns: a list of rows, see aggregate(), or None if no level can
+            be used.'''
+        if points <= 0 or end <= start:
+            return None
+
+        width = float(end - start)/points
+        with self._lock:
+            rollup = self._rollups.get(id_)
+            if rollup is None:
+                return None
+
+            finest = rollup[2][0]
+            oldest = dict((l, l.oldest()) for l in rollup[2])
+            if oldest[finest] is None:
+                oldest[finest] = rollup[0]
+
+            levels = [l for l in rollup[2]
+                      if l.resolution <= width and oldest[l] is not None]
+            if not levels:
+                return None
+
+            covering = [l for l in levels if oldest[l] <= start]
+            if covering:
+                level = covering[-1]
+            elif cover:
+                return None
+            else:
+                level = min(reversed(levels), key=lambda l: oldest[l])
+
+            # The open buckets of the finer levels, and the latest samples,
+            # are not yet merged into the level.
+            k = rollup[2].index(level)
+            later = [l.open for l in reversed(rollup[2][:k])
+                     if l.open is not None]
+            later = [[t, n, list(mins), list(maxs), list(sums), list(lasts)]
+                     for t, n, mins, maxs, sums, lasts in later]
+            later.append(summarize(rollup[0], rollup[1]))
+            buckets = level.query(start, end, later)
+
+        if len(buckets) <= points:
+            points = 0
+        return aggregate(buckets, start, end, points)
+
+    def oldest(self, id_):
+        '''Return the start of an interface's oldest bucket, or None.'''
+        with self._lock:
+            rollup = self._rollups.get(id_)
+            if rollup is None:
+                return None
+            times = [l.oldest() for l in rollup[2]
+                     if l.oldest() is not None]
+            return min(times + [rollup[0]])
+
+    def ids(self):
+        '''Return the ids of interfaces with recorded samples.'''
+        with self._lock:
+            return self._rollups.keys()
@@ -0,0 +1,202 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Poll scheduling for the StatsServer. A Schedule keeps the deadlines of
+#   one target's polls on a fixed grid, one interval apart, so the polling
+#   period does not stretch by the time each poll takes to be answered.
+#
+#   A poll answered after the next deadline has overrun it. The deadlines
+#   it overran are skipped rather than polled in a burst to catch up, and
+#   are counted.
+#
+#   Each poll may be sent up to a jitter time after its deadline, chosen at
+#   random, so that targets sharing an interval are not polled in lockstep.
+#   The jitter does not accumulate: the deadlines stay on the grid.
+#
+#   An adaptive schedule follows the target's smoothed round trip time. The
+#   interval is stretched when answers take more than half of it, up to a
+#   limit, and returns to the configured interval as they speed up again,
+#   so that a slow target is polled as often as it can answer without
+#   overrunning.
+#
+#   Polls, and the samples they return, are timed with timestamp(): seconds
+#   since the epoch read from a monotonic clock. Unlike time.time(), it does
+#   not step when the system clock is set, so the difference between two
+#   samples is the true time between them, and rates stay accurate at short
+#   polling intervals.
+#------------------------------------------------------------------------------
+
+import os
+import random
+import sys
+import time
+from threading import Lock
+
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = None
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Shortest polling interval (s) accepted from the command line.
+MIN_INTERVAL = 0.1
+
+# Weight of each new round trip time in the smoothed latency.
+LATENCY_WEIGHT = 0.2
+
+# An adaptive interval is kept at least this many times the latency.
+LATENCY_HEADROOM = 2.0
+
+# An adaptive interval is stretched to at most this many times the
+# configured interval.
+MAX_STRETCH = 10.0
+
+# Linux clock_gettime() identifier of the monotonic clock.
+CLOCK_MONOTONIC = 1
+
+
+def _clock_gettime():
+    '''Return a function reading the monotonic clock with clock_gettime(),
+    or None where it is not available.'''
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        import ctypes
+        import ctypes.util
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'libc.so.6',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def read():
+        '''Return the monotonic clock (s).'''
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return ts.tv_sec + ts.tv_nsec*1e-9
+
+    return read
+
+
+def _non_decreasing_time():
+    '''Return a function reading time.time(), held back so that it never
+    goes backwards, for systems without a monotonic clock.'''
+    lock = Lock()
+    last = [0.0]
+
+    def read():
+        '''Return the time (s), never less than the last reading.'''
+        now = time.time()
+        with lock:
+            if now < last[0]:
+                return last[0]
+            last[0] = now
+        return now
+
+    return read
+
+
+if monotonic is None:
+    monotonic = _clock_gettime() or _non_decreasing_time()
+
+# Offset from the monotonic clock to the epoch, taken once.
+_EPOCH_OFFSET = time.time() - monotonic()
+
+
+def timestamp():
+    '''Return the time (s since the epoch) read from the monotonic clock.'''
+    return monotonic() + _EPOCH_OFFSET
+
+
+class Schedule(object):
+    '''The deadlines of one target's polls.'''
+
+
+    def __init__(self, interval, jitter=0.0, adaptive=False,
+        max_interval=None, seed=None):
+        '''Constructor.
+
+        :param interval: time (s) between deadlines.
+        :param jitter: longest time (s) a poll is sent after its deadline.
+        :param adaptive: whether to stretch the interval to the target's
+            latency.
+        :param max_interval: longest adaptive interval (s), by default
+            MAX_STRETCH times the interval.
+        :param seed: seed for the jitter, or None.'''
+        self.interval = interval
+        self.jitter = jitter
+        self.adaptive = adaptive
+        self.max_interval = max_interval or interval*MAX_STRETCH
+
+        # The interval in effect, and the smoothed round trip time (s).
+        self.current = interval
+        self.latency = None
+
+        # The current deadline, and the time its poll is due to be sent.
+        self.deadline = None
+        self.due = None
+
+        # Number of deadlines overrun.
+        self.overruns = 0
+
+        self._random = random.Random(seed)
+
+    def start(self, now):
+        '''Start the deadlines afresh, as on connecting to the target.
+
+        :param now: the first deadline.
+        :returns: the time the first poll is due.'''
+        self.deadline = now
+        self.due = self._jittered(now)
+        return self.due
+
+    def completed(self, sent, now):
+        '''Record a poll's answer and move on to the next deadline.
+
+        :param sent: the time the poll was sent.
+        :param now: the time it was answered.
+        :returns: the number of deadlines the poll overran.'''
+        latency = now - sent
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_WEIGHT*(latency - self.latency)
+
+        if self.adaptive:
+            self.current = min(max(self.interval,
+                                   self.latency*LATENCY_HEADROOM),
+                               self.max_interval)
+
+        if self.deadline is None:
+            self.deadline = sent
+        self.deadline += self.current
+
+        overrun = 0
+        if self.current <= 0:
+            # Without an interval, the next poll is sent at once.
+            self.deadline = now
+        elif self.deadline <= now:
+            overrun = int((now - self.deadline)/self.current) + 1
+            self.deadline += overrun*self.current
+            self.overruns += overrun
+
+        self.due = self._jittered(self.deadline)
+        return overrun
+
+    def _jittered(self, deadline):
+        '''Return the time a poll with a deadline is sent.'''
+        if not self.jitter:
+            return deadline
+
+        return deadline + self._random.uniform(0, self.jitter)
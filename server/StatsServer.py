@@ -17,23 +17,69 @@
 #
 #       $ python StatsServer.py -F
 #
-#   The FakeData class handles fake data generation.
+#   The FakeData class (see StatsSimulation) handles fake data generation.
 #
 #   The parse_stats() function is responsible for handling the XML response
 #   from the data acquisition system.
+#
+#   Each response is timestamped as it is received, from a monotonic clock,
+#   and that time is used for its rates and history and is published with
+#   its statistics.
+#
+#   The same methods can be called over a binary transport, POSTed to
+#   /binary on the same port (see StatsBinary), which sends counters and
+#   rates as packed arrays. transports() tells clients it is available.
+#
+#   Each snapshot can also be published, in the same encoding, to a shared
+#   memory file (see StatsShared), from which clients on the same host read
+#   it without an RPC.
+#
+#   Each target's response is checked against alerting rules (see
+#   StatsAlerts). Active alerts and recent events are returned by the
+#   alerts() RPC, and alerts raised and cleared are passed to notifiers.
+#
+#   Polls, parsing, rate computation and RPC calls are instrumented (see
+#   StatsMetrics). The metrics are returned by the metrics() RPC, and served
+#   to Prometheus from http://<host>:<port>/metrics.
 #------------------------------------------------------------------------------
 
+import errno
 import getopt
-import random
-import re
+import os
+import select
 import socket
-import string
 import sys
+import textwrap
 import time
+import xmlrpclib
+from bisect import bisect_left
 from copy import copy
-from threading import Thread
-from xml.etree.ElementTree import fromstring
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+from itertools import chain, count, izip
+from threading import Condition, Thread
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+
+from StatsAlerts import (SIGNAL_SCOPES, AlertEngine, load_rules,
+                         make_notifier)
+from StatsBinary import BINARY_CONTENT_TYPE, BINARY_PATH, Packed, pack, unpack
+from StatsHistory import StatsHistory, downsample_columns
+from StatsMetrics import PROMETHEUS_CONTENT_TYPE, Metrics
+from StatsRates import RateEngine
+from StatsRollup import ROLLUP_LEVELS, StatsRollups, parse_levels
+from StatsSchedule import MIN_INTERVAL, Schedule, timestamp
+from StatsShared import SharedSnapshot
+from StatsSimulation import PROFILES, FakeData
+from StatsStore import StatsStore
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 
 #------------------------------------------------------------------------------
 # Globals
@@ -42,201 +88,908 @@ from SimpleXMLRPCServer import SimpleXMLRPCServer
 # Command to be sent to logging system.
 GET_STATS_CMD='''<x3c_cmd><cmdName>get stats</cmdName></x3c_cmd>'''
 
-# RE for response from logging system.
-RESPONSE_RE = re.compile('(<cmd_resp>.*</cmd_resp>)')
+# Tags delimiting a response from logging system.
+RESPONSE_START_TAG = '<cmd_resp>'
+RESPONSE_END_TAG = '</cmd_resp>'
+
+# Default time (s) for which interface history is kept.
+HISTORY_RETENTION = 3600
+
+# Largest number of samples of each interface kept in memory, however short
+# the polling interval. Longer ranges are answered from the rollups.
+HISTORY_SAMPLES = 3600
+
+# Names of the values recorded in interface history.
+HISTORY_FIELDS = ('byte_count', 'bytes_dropped', 'packet_count',
+                  'packets_dropped', 'error_count', 'byte_rate')
+
+# Maps response parameter names to InterfaceStats field indices.
+PARAM_FIELDS = {
+    'interfaceNumber': 0,
+    'byteCount': 1,
+    'bytesDropped': 2,
+    'packetCount': 3,
+    'packetsDropped': 4,
+    'errorCount': 5,
+    }
 
 
 def parse_stats(s):
     '''Parse XML response from logging system.
 
+    The response is parsed incrementally: each <param> is dispatched through
+    PARAM_FIELDS once it has been read and is then detached from the root,
+    so no document tree is built and memory use does not grow with the
+    response. Only start events are followed, as each one costs a call
+    through iterparse: a <param> is complete once the next one starts.
+
     :param s: XML string to be parsed.
-    :returns: a list of interface statistic vectors.
-        Each vector contains the following:
+    :returns: a dict mapping interface number strings to InterfaceStats
+        records. Each record also behaves as the vector:
             [
+                interfaceNumber,
                 byteCount,
                 bytesDropped,
                 packetCount,
                 packetsDropped,
                 errorCount,
             ].'''
-    root = fromstring(s)
     interfaces = dict()
 
-    # Loop through all params and collect interface info.
+    context = iterparse(StringIO(s), events=('start',))
+    event, root = context.next()
+
+    # Loop through all params and collect interface info, ending with None
+    # to handle the last one.
     current_interface = None
-    for p in root.findall('param'):
-        if cmp(p.findtext('name'), 'interfaceNumber') == 0:
-            if current_interface is not None:
-                # Add the current interface to the interfaces dict.
-                interfaces[current_interface[0]] = current_interface
+    previous = None
+    for event, p in chain(context, [(None, None)]):
+        if p is not None and p.tag != 'param':
+            continue
+
+        if previous is not None:
+            field = PARAM_FIELDS.get(previous.findtext('name'))
+            if field == 0:
+                # Create a new interface stats record.
+                value = previous.findtext('value')
+                current_interface = InterfaceStats(int(value))
+                interfaces[value] = current_interface
+
+            elif field is not None and current_interface is not None:
+                # Update the interface stats record.
+                current_interface[field] = int(previous.findtext('value'))
+
+            # Detach the params read so far from the root. Those the parser
+            # has read ahead are still referenced by their events.
+            del root[:-1]
+
+        previous = p
+
+    # Return the dict of stats records.
+    return interfaces
 
-            # Create a new interface stats vector.
-            current_interface = [0, 0, 0, 0, 0, 0]
-            current_interface[0] = p.findtext('value')
 
-        # Update the interface stats vector.
-        if current_interface is not None:
-            if cmp(p.findtext('name'), 'byteCount') == 0:
-                current_interface[1] = int(p.findtext('value'))
+def interface_id(target_name, number):
+    '''Return the published identifier for an interface.
 
-            elif cmp(p.findtext('name'), 'bytesDropped') == 0:
-                current_interface[2] = int(p.findtext('value'))
+    Interfaces of the unnamed (default) target keep their bare interface
+    numbers, others are qualified with the name of their target.
 
-            elif cmp(p.findtext('name'), 'packetCount') == 0:
-                current_interface[3] = int(p.findtext('value'))
+    :param target_name: name of the target the interface belongs to.
+    :param number: the interface number reported by the target.'''
+    if not target_name:
+        return str(number)
 
-            elif cmp(p.findtext('name'), 'packetsDropped') == 0:
-                current_interface[4] = int(p.findtext('value'))
+    return '%s:%s' % (target_name, number)
 
-            elif cmp(p.findtext('name'), 'errorCount') == 0:
-                current_interface[5] = int(p.findtext('value'))
 
-    interfaces[current_interface[0]] = current_interface
+def to_gbps(rate):
+    '''Convert a byte rate to Gbps, rounded for display.
 
-    # Return the list of stats vectors.
-    return interfaces
+    :param rate: rate in bytes per second.'''
+    return round(rate*8/1000000000.0, 1)
 
 
 #------------------------------------------------------------------------------
 # Class definitions
 #------------------------------------------------------------------------------
-class FakeData(object):
-    '''Generate fake acquisition system data.'''
-
-
-    # Static fake data tags and templates.
-    FAKE_START_TAG = '''<cmd_resp>'''
-    FAKE_END_TAG = '''</cmd_resp>'''
-    FAKE_HEADER = string.Template('''
-        <cmd_name>get stats</cmd_name>
-        <retVal>0</retVal>
-        <reason>success</reason>
-        <param>
-          <name>interfaceCount</name><type>unsigned</type><value>${num_interfaces}</value>
-        </param>''')
-
-    FAKE_BODY = string.Template('''
-        <param>
-          <name>interfaceType</name><type>keyword</type><value>Ethernet</value>
-        </param>
-        <param>
-          <name>interfaceNumber</name><type>unsigned</type><value>${int_id}</value>
-        </param>
-        <param>
-          <name>byteCount</name><type>unsigned long</type><value>${byte_count}</value>
-        </param>
-        <param>
-          <name>bytesDropped</name><type>unsigned long</type><value>${bytes_dropped}</value>
-        </param>
-        <param>
-          <name>packetCount</name><type>unsigned long</type><value>${packet_count}</value>
-        </param>
-        <param>
-          <name>packetsDropped</name><type>unsigned long</type><value>${packets_dropped}</value>
-        </param>
-        <param>
-          <name>errorCount</name><type>unsigned long</type><value>${error_count}</value>
-        </param>''')
-
-    # List of keys that will be updated.
-    STAT_KEYS = ['byte_count', 'bytes_dropped', 'packet_count',
-        'packets_dropped', 'error_count']
-
-    # Useful constants.
-    BYTE_INCREMENT = 1000000000
-    PACKET_INCREMENT = BYTE_INCREMENT/8000
-
-    def __init__(self, num_interfaces=4):
-        '''Constructor.
+class InterfaceStats(object):
+    '''Statistics for a single interface.
+
+    Fields may be accessed by name or, for compatibility with the original
+    statistics vectors, by index in FIELDS order.'''
 
-        :param num_interfaces: the number of interfaces.'''
-        self.num_interfaces = num_interfaces
 
-        # Initialize interfaces dict.
-        self.interfaces = [{'int_id': x} for x in xrange(self.num_interfaces)]
+    FIELDS = ('interface', 'byte_count', 'bytes_dropped', 'packet_count',
+              'packets_dropped', 'error_count')
 
-        # Initialize interfaces statistics.
-        for i in xrange(self.num_interfaces):
-            for k in FakeData.STAT_KEYS:
-                self.interfaces[i][k] = 0
+    __slots__ = FIELDS
 
-    def update_interface(self, int_id, byte_count, bytes_dropped, packet_count,
-        packets_dropped, error_count):
-        '''Update the statistics on an interface.
+    def __init__(self, interface, byte_count=0, bytes_dropped=0,
+        packet_count=0, packets_dropped=0, error_count=0):
+        '''Constructor.
 
-        :param int_id: interface identifier/index.
+        :param interface: interface number.
         :param byte_count: total byte count so far.
         :param bytes_dropped: total bytes dropped so far.
         :param packet_count: total packet count so far.
         :param packets_dropped: total packets dropped so far.
         :param error_count: errors seen so far.'''
-        if int_id < 0 or int_id >= self.num_interfaces:
-            raise 'Invalid interface id: %d' % int_id
+        self.interface = interface
+        self.byte_count = byte_count
+        self.bytes_dropped = bytes_dropped
+        self.packet_count = packet_count
+        self.packets_dropped = packets_dropped
+        self.error_count = error_count
+
+    def __getitem__(self, index):
+        return getattr(self, InterfaceStats.FIELDS[index])
+
+    def __setitem__(self, index, value):
+        setattr(self, InterfaceStats.FIELDS[index], value)
+
+    def __len__(self):
+        return len(InterfaceStats.FIELDS)
+
+    def __iter__(self):
+        return (getattr(self, f) for f in InterfaceStats.FIELDS)
 
-        # Update the interface statistics.
-        for k in FakeData.STAT_KEYS:
-            self.interfaces[int_id][k] += locals()[k]
+    def __eq__(self, other):
+        return list(self) == list(other)
 
-    def __str__(self):
-        '''Returns new statistic XML string for parsing.'''
-        for i in xrange(self.num_interfaces):
-            bc = random.randint(0, FakeData.BYTE_INCREMENT)
-            bd = random.randint(0, FakeData.BYTE_INCREMENT)
-            pc = random.randint(0, FakeData.PACKET_INCREMENT)
-            pd = random.randint(0, FakeData.PACKET_INCREMENT)
-            ec = random.randint(0, FakeData.PACKET_INCREMENT)
-            self.update_interface(i, bc, bd, pc, pd, ec)
+    def __ne__(self, other):
+        return not self == other
 
-        xml_body = [FakeData.FAKE_START_TAG]
-        xml_body.append(FakeData.FAKE_HEADER.substitute({'num_interfaces':
-                                                         self.num_interfaces}))
+    def __repr__(self):
+        return 'InterfaceStats(%s)' % ', '.join(str(x) for x in self)
 
-        for i in xrange(self.num_interfaces):
-            xml_body.append(FakeData.FAKE_BODY.substitute(self.interfaces[i]))
+    def counters(self):
+        '''Return the counters, without the interface number.'''
+        return (self.byte_count, self.bytes_dropped, self.packet_count,
+                self.packets_dropped, self.error_count)
 
-        xml_body.append(FakeData.FAKE_END_TAG)
 
-        return ''.join(xml_body)
+class StreamReader(object):
+    '''Read framed responses from a stream socket.
+
+    Data is read with large recv_into() calls into a reusable buffer, and the
+    buffer is scanned incrementally for the end tag, so each byte is only
+    examined once regardless of how the response is split across reads.'''
+
+
+    def __init__(self, sock, start_tag=RESPONSE_START_TAG,
+        end_tag=RESPONSE_END_TAG, buffer_size=65536):
+        '''Constructor.
+
+        :param sock: the connected socket to read from.
+        :param start_tag: the tag that opens a response.
+        :param end_tag: the tag that closes a response.
+        :param buffer_size: initial size of the receive buffer.'''
+        self._sock = sock
+        self._start_tag = start_tag
+        self._end_tag = end_tag
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+
+        # Unconsumed data lies in self._buffer[self._head:self._tail].
+        self._head = 0
+        self._tail = 0
+
+        # Start of the current frame (or -1 if not yet seen) and the offset
+        # from which to resume scanning for the end tag.
+        self._frame_start = -1
+        self._scan_from = 0
+
+    def read_frame(self):
+        '''Block until a complete response has been received.
+
+        :returns: the response string, including start and end tags.'''
+        frame = self.next_frame()
+        while frame is None:
+            self.fill()
+            frame = self.next_frame()
+
+        return frame
+
+    def next_frame(self):
+        '''Extract a complete response from the buffered data.
+
+        :returns: the response string, or None if more data is needed.'''
+        buf = self._buffer
+
+        if self._frame_start < 0:
+            start = buf.find(self._start_tag, self._head, self._tail)
+            if start < 0:
+                # Discard everything that cannot be part of a start tag.
+                self._head = max(self._head,
+                                 self._tail - len(self._start_tag) + 1)
+                return None
+
+            self._frame_start = start
+            self._scan_from = start + len(self._start_tag)
+
+        end = buf.find(self._end_tag, self._scan_from, self._tail)
+        if end < 0:
+            # Resume where a partially received end tag could begin.
+            self._scan_from = max(self._scan_from,
+                                  self._tail - len(self._end_tag) + 1)
+            return None
+
+        end += len(self._end_tag)
+        frame = str(buf[self._frame_start:end])
+
+        self._head = end
+        self._frame_start = -1
+        if self._head == self._tail:
+            self._head = self._tail = 0
+
+        return frame
+
+    def fill(self):
+        '''Receive more data into the buffer.
+
+        This blocks unless the socket is readable or non-blocking.
+
+        :returns: the number of bytes received.'''
+        if self._tail == len(self._buffer):
+            self._make_room()
+
+        n = self._sock.recv_into(self._view[self._tail:])
+        if n == 0:
+            raise socket.error('Connection closed by peer')
+
+        self._tail += n
+        return n
+
+    def _make_room(self):
+        '''Compact the buffer, growing it if it is still full.'''
+        offset = self._head
+        if self._frame_start >= 0:
+            offset = min(offset, self._frame_start)
+
+        if offset > 0:
+            size = self._tail - offset
+            self._buffer[:size] = self._buffer[offset:self._tail]
+            self._head -= offset
+            self._tail = size
+            if self._frame_start >= 0:
+                self._frame_start -= offset
+                self._scan_from -= offset
+
+        if self._tail == len(self._buffer):
+            # Drop the view before resizing the underlying buffer.
+            self._view = None
+            self._buffer.extend(bytearray(len(self._buffer)))
+            self._view = memoryview(self._buffer)
+
+
+class Target(object):
+    '''A data acquisition system polled by a Poller.'''
+
+
+    # Connection states.
+    DISCONNECTED = 'disconnected'
+    CONNECTING = 'connecting'
+    IDLE = 'idle'
+    WAITING = 'waiting'
+
+    def __init__(self, name, address, polling_interval=5, timeout=2.0,
+        min_backoff=1.0, max_backoff=60.0, jitter=0.0, adaptive=False):
+        '''Constructor.
+
+        :param name: name used to qualify the target's interfaces.
+        :param address: the tuple (<host>, <port>).
+        :param polling_interval: how frequently to poll (s).
+        :param timeout: time allowed to connect or to receive a response (s).
+        :param min_backoff: delay before the first reconnect attempt (s).
+        :param max_backoff: maximum delay between reconnect attempts (s).
+        :param jitter: longest random delay (s) of each poll.
+        :param adaptive: whether to poll less often while the target is
+            slow to answer.'''
+        self.name = name
+        self.address = address
+        self.polling_interval = polling_interval
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.schedule = Schedule(polling_interval, jitter, adaptive)
+
+        # Connection state, managed by the Poller.
+        self.state = Target.DISCONNECTED
+        self.sock = None
+        self.reader = None
+        self.pending = ''
+        self.sent = None
+        self.next_time = 0
+        self.deadline = None
+        self.backoff = min_backoff
+
+        # Counters.
+        self.polls = 0
+        self.failures = 0
+
+    def __repr__(self):
+        return 'Target(%r, %s:%s)' % (self.name, self.address[0],
+                                      self.address[1])
+
+
+class Poller(object):
+    '''Poll several acquisition systems concurrently from a single thread.
+
+    Each target is moved through the states DISCONNECTED -> CONNECTING ->
+    IDLE <-> WAITING by a select() loop using non-blocking sockets. Complete
+    responses are handed to on_response(target, response, timestamp), where
+    timestamp is the time the response was received. Failed connections and
+    timeouts are reported to on_error(target, reason) and retried with
+    exponential backoff.
+
+    Polls are sent on each target's Schedule of deadlines, which restarts
+    when the target is reconnected.
+
+    When given a Metrics registry, the poller records for each target the
+    round trip time of each poll, how late it was sent, the bytes read, the
+    deadlines overrun, and the polls completed, failed, and dropped because
+    their response could not be handled.'''
+
+
+    # Longest time (s) to block in select(), bounds the time to notice stop().
+    MAX_WAIT = 0.5
+
+    def __init__(self, targets, on_response, on_error=None, metrics=None):
+        '''Constructor.
+
+        :param targets: list of Target objects to poll.
+        :param on_response: called with each complete response.
+        :param on_error: called when a connection or request fails.
+        :param metrics: the Metrics registry to record polls in, or None.'''
+        self.targets = list(targets)
+        self._on_response = on_response
+        self._on_error = on_error
+        self._metrics = metrics
+        self._running = True
+        self._by_socket = dict()
+
+    def run(self):
+        '''Poll targets until stop() is called.'''
+        now = timestamp()
+        for t in self.targets:
+            t.next_time = t.schedule.start(now)
+
+        while self._running:
+            self.step()
+
+        for t in self.targets:
+            self._close(t)
+
+    def stop(self):
+        '''Stop polling.'''
+        self._running = False
+
+    def step(self, max_wait=MAX_WAIT):
+        '''Run a single iteration of the event loop.
+
+        :param max_wait: the longest time (s) to wait for activity.'''
+        now = timestamp()
+        wake = now + max_wait
+        readers = []
+        writers = []
+
+        # Start due connections and requests, and expire overdue ones.
+        for t in self.targets:
+            if t.state in (Target.CONNECTING, Target.WAITING):
+                if now >= t.deadline:
+                    self._fail(t, now, 'timed out')
+            elif now >= t.next_time:
+                if t.state == Target.DISCONNECTED:
+                    self._connect(t, now)
+                else:
+                    self._send_request(t, now)
+
+            if t.state in (Target.CONNECTING, Target.WAITING):
+                wake = min(wake, t.deadline)
+            else:
+                wake = min(wake, t.next_time)
+
+            if t.state == Target.CONNECTING or t.pending:
+                writers.append(t.sock)
+            if t.state == Target.WAITING:
+                readers.append(t.sock)
+
+        timeout = max(0, wake - timestamp())
+        if not readers and not writers:
+            time.sleep(timeout)
+            return
+
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+        now = timestamp()
+
+        for sock in writable:
+            t = self._by_socket.get(sock)
+            if t is None:
+                continue
+            elif t.state == Target.CONNECTING:
+                self._connected(t, now)
+            else:
+                self._flush(t, now)
+
+        for sock in readable:
+            t = self._by_socket.get(sock)
+            if t is not None and t.state == Target.WAITING:
+                self._receive(t, now)
+
+    def _connect(self, t, now):
+        '''Start a non-blocking connection to a target.'''
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            err = sock.connect_ex(t.address)
+        except socket.error, e:
+            self._fail(t, now, str(e))
+            return
+
+        t.sock = sock
+        self._by_socket[sock] = t
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._fail(t, now, os.strerror(err))
+            return
+
+        t.state = Target.CONNECTING
+        t.deadline = now + t.timeout
+
+    def _connected(self, t, now):
+        '''Complete a connection and send the first request.'''
+        err = t.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self._fail(t, now, os.strerror(err))
+            return
+
+        print '** Connected to %s' % (t.name or '%s:%s' % t.address)
+        t.reader = StreamReader(t.sock)
+        t.state = Target.IDLE
+        self._send_request(t, now)
+
+    def _send_request(self, t, now):
+        '''Send the stats command to a connected target.'''
+        if self._metrics is not None:
+            self._metrics.histogram('poll_lag_seconds',
+                                    'Time from a poll being due to it being '
+                                    'sent.', target=t.name).observe(
+                                        max(0, now - t.next_time))
+
+        t.pending = GET_STATS_CMD
+        t.sent = now
+        t.state = Target.WAITING
+        t.deadline = now + t.timeout
+        self._flush(t, now)
+
+    def _flush(self, t, now):
+        '''Send as much of the pending request as the socket accepts.'''
+        try:
+            sent = t.sock.send(t.pending)
+            t.pending = t.pending[sent:]
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._fail(t, now, str(e))
+
+    def _receive(self, t, now):
+        '''Read available data and dispatch a complete response.'''
+        metrics = self._metrics
+        try:
+            n = t.reader.fill()
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._fail(t, now, str(e))
+            return
+
+        if metrics is not None:
+            metrics.counter('das_bytes_read_total',
+                            'Bytes read from the acquisition system.',
+                            target=t.name).inc(n)
+
+        response = t.reader.next_frame()
+        if response is None:
+            return
+
+        t.state = Target.IDLE
+        overrun = t.schedule.completed(t.sent, now)
+        t.next_time = t.schedule.due
+        t.backoff = t.min_backoff
+        t.polls += 1
+
+        if metrics is not None:
+            metrics.counter('polls_total', 'Polls answered.',
+                            target=t.name).inc()
+            metrics.counter('poll_overruns_total',
+                            'Poll deadlines missed while waiting for an '
+                            'answer.', target=t.name).inc(overrun)
+            metrics.histogram('das_round_trip_seconds',
+                              'Time from sending a poll to its response.',
+                              target=t.name).observe(now - t.sent)
+
+        try:
+            self._on_response(t, response, now)
+        except Exception, e:
+            print 'STATS LOOP: %s: %s' % (t.name, e)
+            if metrics is not None:
+                metrics.counter('polls_dropped_total',
+                                'Responses that could not be handled.',
+                                target=t.name).inc()
+
+    def _fail(self, t, now, reason):
+        '''Drop a target's connection and schedule a reconnect.'''
+        print '** %s failed: %s' % (t.name or '%s:%s' % t.address, reason)
+        self._close(t)
+        t.failures += 1
+        if self._metrics is not None:
+            self._metrics.counter('polls_failed_total',
+                                  'Polls failed by a connection error or '
+                                  'timeout.', target=t.name).inc()
+        t.next_time = t.schedule.start(now + t.backoff)
+        t.backoff = min(t.backoff*2, t.max_backoff)
+
+        if self._on_error is not None:
+            self._on_error(t, reason)
+
+    def _close(self, t):
+        '''Close a target's connection.'''
+        if t.sock is not None:
+            self._by_socket.pop(t.sock, None)
+            t.sock.close()
+
+        t.state = Target.DISCONNECTED
+        t.sock = None
+        t.reader = None
+        t.pending = ''
+
+
+class InterfaceList(object):
+    '''The interfaces discovered from the targets' responses.
+
+    Interfaces are ordered by target, then by interface number. A list is
+    never modified: when a target reports a different set of interfaces, a
+    new list is made with the next version.'''
+
+
+    __slots__ = ('version', 'ids', 'index', 'targets', 'order', '_numbers')
+
+    def __init__(self, order=(), version=0, targets=None, numbers=None):
+        '''Constructor.
+
+        :param order: names of the targets, in the order their interfaces
+            are listed. Other targets follow in the order they are seen.
+        :param version: number of changes to the list so far.
+        :param targets: dict mapping target names to tuples of their
+            interface ids.
+        :param numbers: dict mapping target names to sets of their
+            interface numbers.'''
+        self.version = version
+        self.targets = targets or dict()
+        self.order = tuple(order)
+        self._numbers = numbers or dict()
+
+        # Interface ids in order, and the position of each id.
+        self.ids = tuple(id_ for name in self.order
+                         for id_ in self.targets.get(name, ()))
+        self.index = dict((id_, i) for i, id_ in enumerate(self.ids))
+
+    def update(self, target_name, numbers):
+        '''Return the list after a target reports its interfaces.
+
+        :param target_name: name of the target.
+        :param numbers: the interface numbers in its latest response.
+        :returns: a new InterfaceList, or this one if nothing changed.'''
+        numbers = frozenset(numbers)
+        if self._numbers.get(target_name) == numbers:
+            return self
+
+        order = self.order
+        if target_name not in order:
+            order += (target_name,)
+
+        targets = dict(self.targets)
+        targets[target_name] = tuple(interface_id(target_name, n)
+                                     for n in sorted(numbers))
+        all_numbers = dict(self._numbers)
+        all_numbers[target_name] = numbers
+
+        return InterfaceList(order, self.version + 1, targets, all_numbers)
+
+    def as_struct(self):
+        '''Return the list as an XML-RPC struct, see list_interfaces().'''
+        return {
+            'version': self.version,
+            'interfaces': list(self.ids),
+            'targets': dict((k, list(v)) for k, v in
+                            self.targets.iteritems()),
+            }
+
+
+class Snapshot(object):
+    '''Statistics published by one update of a StatsServer.
+
+    A snapshot is never modified once published. The poll thread builds a
+    new one and replaces the server's reference to it in a single
+    assignment, so request handlers read a consistent view without locking
+    by taking the reference once.'''
+
+
+    __slots__ = ('version', 'counters', 'rates', 'counter_rates',
+                 'capture_rates', 'capture_rate', 'timestamp', 'interval',
+                 'interfaces', 'sampled', '_struct', '_binary')
+
+    def __init__(self, version=0, counters=None, rates=None,
+        capture_rates=None, capture_rate=0, timestamp=None, interval=0,
+        counter_rates=None, interfaces=None, sampled=None):
+        '''Constructor.
+
+        :param version: number of the update that produced the snapshot.
+        :param counters: dict mapping interface ids to counter tuples.
+        :param rates: dict mapping interface ids to byte rates.
+        :param capture_rates: dict mapping target names to byte rates.
+        :param capture_rate: total byte rate over all targets.
+        :param timestamp: time of the update.
+        :param interval: expected time (s) until the next update.
+        :param counter_rates: dict mapping interface ids to tuples of the
+            rates of each counter.
+        :param interfaces: the InterfaceList of the interfaces reported.
+        :param sampled: dict mapping target names to the time their latest
+            response was received.'''
+        self.version = version
+        self.counters = counters or dict()
+        self.rates = rates or dict()
+        self.counter_rates = counter_rates or dict()
+        self.capture_rates = capture_rates or dict()
+        self.capture_rate = capture_rate
+        self.timestamp = timestamp
+        self.interval = interval
+        self.interfaces = interfaces or InterfaceList()
+        self.sampled = sampled or dict()
+        self._struct = None
+        self._binary = None
+
+    def as_struct(self):
+        '''Return the snapshot as an XML-RPC struct.
+
+        Counters are strings, as they may not fit in an XML-RPC int, and
+        rates are in Gbps as returned by ethernet() and capture(). The struct
+        is built on first use and shared by later callers.'''
+        if self._struct is None:
+            self._struct = {
+                'version': self.version,
+                'timestamp': self.timestamp or 0,
+                'interval': self.interval,
+                'interfaces': dict((k, [str(x) for x in v])
+                                   for k, v in self.counters.iteritems()),
+                'ethernet': dict((k, to_gbps(v))
+                                 for k, v in self.rates.iteritems()),
+                'rates': dict((k, list(v))
+                              for k, v in self.counter_rates.iteritems()),
+                'targets': dict((k, to_gbps(v))
+                                for k, v in self.capture_rates.iteritems()),
+                'capture': to_gbps(self.capture_rate),
+                'ids': list(self.interfaces.ids),
+                'ids_version': self.interfaces.version,
+                'sampled': dict(self.sampled),
+                }
+
+        return self._struct
+
+    def as_binary(self):
+        '''Return the snapshot for the binary transport.
+
+        The struct has the keys of as_struct(), but the interfaces, ethernet
+        and rates entries are Packed arrays with a row for each interface,
+        in the order of ids. Each interfaces row holds width counters, as
+        integers, each rates row width - 1 rates, NaN before an interface
+        has a rate. Like the struct, it is built once.'''
+        if self._binary is None:
+            ids = [id_ for id_ in self.interfaces.ids
+                   if self.counters.has_key(id_)]
+            if len(ids) < len(self.counters):
+                listed = set(ids)
+                ids += sorted(k for k in self.counters if k not in listed)
+
+            width = len(InterfaceStats.FIELDS)
+            no_rates = (float('nan'),)*(width - 1)
+            counters = []
+            rates = []
+            for id_ in ids:
+                counters.extend(self.counters[id_])
+                rates.extend(self.counter_rates.get(id_, no_rates))
+
+            self._binary = {
+                'version': self.version,
+                'timestamp': self.timestamp or 0,
+                'interval': self.interval,
+                'ids': ids,
+                'ids_version': self.interfaces.version,
+                'width': width,
+                'interfaces': Packed('Q', counters),
+                'ethernet': Packed('d', [to_gbps(self.rates.get(id_, 0))
+                                         for id_ in ids]),
+                'rates': Packed('d', rates),
+                'targets': dict((k, to_gbps(v))
+                                for k, v in self.capture_rates.iteritems()),
+                'capture': to_gbps(self.capture_rate),
+                'sampled': dict(self.sampled),
+                }
+
+        return self._binary
+
+
+class StatsRequestHandler(SimpleXMLRPCRequestHandler):
+    '''Request handler that also serves the server's metrics to GET
+    requests for /metrics, in the Prometheus text format, and binary
+    requests POSTed to /binary.'''
+
+
+    metrics_path = '/metrics'
+    binary_path = BINARY_PATH
+
+    def do_POST(self):
+        if self.path != self.binary_path:
+            SimpleXMLRPCRequestHandler.do_POST(self)
+            return
+
+        try:
+            length = int(self.headers['content-length'])
+            method, params = unpack(self.rfile.read(length))
+            response = {'result': self.server._dispatch(method, params,
+                                                        binary=True)}
+        except xmlrpclib.Fault, e:
+            response = {'fault': [e.faultCode, e.faultString]}
+        except Exception, e:
+            response = {'fault': [1, '%s:%s' % (type(e), e)]}
+
+        try:
+            body = pack(response)
+        except TypeError, e:
+            body = pack({'fault': [1, '%s:%s' % (type(e), e)]})
+
+        self.send_response(200)
+        self.send_header('Content-type', BINARY_CONTENT_TYPE)
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != self.metrics_path:
+            self.report_404()
+            return
+
+        body = self.server.metrics.prometheus()
+        self.send_response(200)
+        self.send_header('Content-type', PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class KeepAliveRequestHandler(StatsRequestHandler):
+    '''Request handler that keeps HTTP/1.1 connections open between
+    requests, so that clients can reuse them.'''
+
+
+    protocol_version = 'HTTP/1.1'
+
+    # Close connections left idle for longer than this (s).
+    timeout = 30
 
 
 class StatsServer(SimpleXMLRPCServer):
     '''This class customizes the default SimpleXMLRPCServer.'''
 
 
-    def __init__(self, polling_interval, address_tuple, target, fake=False):
+    # Handler for incoming requests.
+    request_handler = StatsRequestHandler
+
+    # Longest time (s) wait() blocks. A single-threaded server cannot block
+    # without stalling every other client, so it answers immediately.
+    max_wait = 0
+
+    def __init__(self, polling_interval, address_tuple, target, fake=False,
+        retention=HISTORY_RETENTION, store=None, shared=None, alerts=None,
+        verbose=False, rollups=ROLLUP_LEVELS):
         '''Constructor.
 
-        :param polling_interval: how frequently to poll.
+        :param polling_interval: how frequently to poll (s), at least
+            MIN_INTERVAL.
         :param address_tuple: the tuple (<ip address>, <port>).
-        :param target: the target logging system.
-        :param fake: whether or not to generate fake data.'''
-        SimpleXMLRPCServer.__init__(self, address_tuple)
+        :param target: the target logging system, either a tuple
+            (<host>, <port>) or a list of Target objects.
+        :param fake: whether or not to generate fake data, or the FakeData
+            instance to generate it with.
+        :param retention: time (s) for which interface history is kept, in
+            at most HISTORY_SAMPLES samples per interface.
+        :param store: directory of a StatsStore in which history is kept
+            across restarts, or None to keep history in memory only.
+        :param shared: path of a file to which each snapshot is published
+            for readers on the same host, or None.
+        :param alerts: the AlertEngine evaluating each update, by default
+            one with the default rules and no notifiers.
+        :param verbose: whether to print the rates after each update.
+        :param rollups: the rollup levels, as (bucket width (s), retention
+            (s)) pairs (see StatsRollup).'''
+        SimpleXMLRPCServer.__init__(self, address_tuple, self.request_handler)
 
         self._polling_interval = polling_interval
-        if polling_interval < 1:
-            self._polling_interval = 1
+        if polling_interval < MIN_INTERVAL:
+            self._polling_interval = MIN_INTERVAL
+
+        if isinstance(target, tuple):
+            target = [Target('', target, self._polling_interval)]
 
-        self._target = target
+        self._targets = list(target)
+        self._poller = None
         self._fake = fake
         self._running = False
+        self._verbose = verbose
 
-        self._last_update = time.time()
+        self._start_time = time.time()
+        self._engine = RateEngine(len(InterfaceStats.FIELDS) - 1)
         self._rates = dict()
+        self._counter_rates = dict()
+        self._capture_rates = dict()
         self._capture_rate = 0
         self._cstatistics = dict()
+        self._target_interfaces = dict()
+        self._sampled = dict()
+        self._interfaces = InterfaceList([t.name for t in self._targets])
+        self._snapshot = Snapshot()
+        self._published = Condition()
+        self._history = StatsHistory(HISTORY_FIELDS,
+            min(retention/self._update_interval(), HISTORY_SAMPLES))
+        self._rollups = StatsRollups(HISTORY_FIELDS, rollups)
+
+        self.metrics = Metrics('statsserver_')
+        self._parse_time = self.metrics.histogram('parse_seconds',
+            'Time to parse a response.')
+        self._rate_time = self.metrics.histogram('rates_seconds',
+            'Time to compute the rates from a response.')
+        self._update_time = self.metrics.histogram('update_seconds',
+            'Time to publish the statistics from a parsed response.')
+        self._alert_time = self.metrics.histogram('alerts_seconds',
+            'Time to evaluate the alerting rules on a response.')
+
+        self._alerts = alerts
+        if alerts is None:
+            self._alerts = AlertEngine()
+
+        self._store = None
+        if store is not None:
+            self._store = StatsStore(store, HISTORY_FIELDS)
+            self._restore_history(retention)
+
+        self._shared = None
+        if shared is not None:
+            self._shared = SharedSnapshot(shared)
 
         # Register external API handlers.
         self.register_introspection_functions()
         self.register_function(self.interface)
         self.register_function(self.ethernet)
         self.register_function(self.capture)
+        self.register_function(self.snapshot)
+        self.register_function(self.list_interfaces)
+        self.register_function(self.wait)
+        self.register_function(self.history)
+        self.register_function(self.metrics_struct, 'metrics')
+        self.register_function(self.alerts)
+        self.register_function(self.transports)
+
+        # Methods answered differently over the binary transport.
+        self.binary_funcs = {
+            'snapshot': self.snapshot_binary,
+            'wait': self.wait_binary,
+            'interface': self.interface_binary,
+            }
 
     def start(self):
         '''Start the server.'''
         self._running = True
+        self._start_time = time.time()
         self._stats_thread = Thread(target=lambda: self.run())
         self._stats_thread.start()
-        self._start_time = time.time()
 
     def server_bind(self):
         '''Ensure TCP resources released immediately if server killed.'''
@@ -255,7 +1008,16 @@ class StatsServer(SimpleXMLRPCServer):
 
     def quit(self):
         '''Shutdown server.'''
-        self._running = False
+        with self._published:
+            self._running = False
+            self._published.notify_all()
+        if self._poller is not None:
+            self._poller.stop()
+        if self._store is not None:
+            self._store.close()
+        shared, self._shared = self._shared, None
+        if shared is not None:
+            shared.close()
         return 0
 
     def run(self):
@@ -269,129 +1031,464 @@ class StatsServer(SimpleXMLRPCServer):
 
     def _run(self):
         '''Acquire and publish real data.'''
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(self._target)
-
-        print '** Connected'
-        while self._running:
-            s.sendall(GET_STATS_CMD)
-            received_data = []
-            try:
-                # Command loop
-                while True:
-                    data = s.recv(1)
-                    data = data.strip()
-                    received_data.append(data)
-                    received_string = ''.join(received_data)
-                    m = re.match(RESPONSE_RE, received_string)
-                    if m:
-                        received_response, = m.groups(0)
-                        now = time.time()
-                        delta_t = now - self._last_update
-                        interfaces = parse_stats(received_response)
-
-                        for i, V in interfaces.iteritems():
-                            try:
-                                if not self._cstatistics.has_key(str(i)):
-                                    self._cstatistics[i] = list(V)
-                                    continue
-
-                                self._rates[i] = 0
-                                delta_v = int(V[1]) - int(self._cstatistics[str(i)][1])
-                                self._cstatistics[str(i)][1] = V[1]
-                                self._rates[i] = float(delta_v)/delta_t
-                            except Exception, e:
-                                print 'STATS LOOP:', str(e)
-
-                        self._capture_rate = 0
-                        for i, v in self._rates.iteritems():
-                            self._capture_rate += v
-
-                        self._last_update = time.time()
-                        print 'STATS', self._rates
-                        break
-
-                time.sleep(self._polling_interval)
-            except Exception, e:
-                print '** Shutting down'
-                self.quit()
-                self.shutdown()
+        self._poller = Poller(self._targets, self._handle_response,
+                              metrics=self.metrics)
+        if not self._running:
+            return
 
-        s.close()
+        print '** Polling %d target(s)' % len(self._targets)
+        self._poller.run()
 
     def _fake_run(self):
         '''Publish fake data.'''
         print '** Connected'
-        fd = FakeData()
+        fd = self._fake
+        if not isinstance(fd, FakeData):
+            fd = FakeData(interval=self._polling_interval)
 
+        schedule = Schedule(self._polling_interval)
+        schedule.start(timestamp())
         while self._running:
             received_data = str(fd)
             try:
                 # Command loop
-                now = time.time()
-                delta_t = now - self._last_update
-                interfaces = parse_stats(received_data)
-
-                for i, V in interfaces.iteritems():
-                   try:
-                       if not self._cstatistics.has_key(str(i)):
-                           self._cstatistics[i] = list(V)
-                           continue
-
-                       self._rates[i] = 0
-                       delta_v = int(V[1]) - int(self._cstatistics[str(i)][1])
-                       self._cstatistics[str(i)][1] = V[1]
-                       self._rates[i] = float(delta_v)/delta_t
-                   except Exception, e:
-                       print 'STATS LOOP:', str(e)
-
-                self._capture_rate = 0
-                for i, v in self._rates.iteritems():
-                   self._capture_rate += v
-
-                self._last_update = time.time()
-                print 'STATS', self._rates
-
-                time.sleep(self._polling_interval)
+                now = timestamp()
+                self._process('', received_data, now)
+                if self._verbose:
+                    print 'STATS', self._rates
+
+                schedule.completed(now, timestamp())
+                time.sleep(max(0, schedule.due - timestamp()))
             except Exception, e:
                 print '** Shutting down: %s' %e
                 self.quit()
                 self.shutdown()
 
+    def _handle_response(self, target, response, now):
+        '''Update statistics from a target's response.
+
+        :param target: the Target that responded.
+        :param response: the response string.
+        :param now: the time the response was received.'''
+        self._process(target.name, response, now)
+        if self._verbose:
+            print 'STATS', self._rates
+
+    def _process(self, target_name, response, now):
+        '''Parse a target's response and update statistics from it.'''
+        start = timestamp()
+        interfaces = parse_stats(response)
+        self._parse_time.observe(timestamp() - start)
+        self._update_statistics(target_name, interfaces, now)
+
+    def _update_statistics(self, target_name, interfaces, now):
+        '''Update counters and rates for one target's interfaces.
+
+        :param target_name: name of the target the interfaces belong to.
+        :param interfaces: dict of interface statistics from parse_stats().
+        :param now: the time the statistics were acquired.'''
+        start = timestamp()
+        stats = interfaces.values()
+        ids = [interface_id(target_name, s.interface) for s in stats]
+        counters = [s.counters() for s in stats]
+        rates = self._engine.update(ids, counters, now)
+        self._rate_time.observe(timestamp() - start)
+
+        # Forget interfaces the target no longer reports.
+        discovered = self._interfaces.update(target_name,
+                                             [s.interface for s in stats])
+        if discovered is not self._interfaces:
+            removed = [id_ for id_ in
+                       self._interfaces.targets.get(target_name, ())
+                       if not discovered.index.has_key(id_)]
+            for id_ in removed:
+                self._cstatistics.pop(id_, None)
+                self._rates.pop(id_, None)
+                self._counter_rates.pop(id_, None)
+            self._interfaces = discovered
+            self._count_alerts(self._alerts.forget(removed, now))
+
+        # Positions of the interfaces whose rates changed, to be evaluated
+        # by the alerting rules.
+        changed = []
+        for k, id_, s, c, r in izip(count(), ids, stats, counters, rates):
+            self._cstatistics[id_] = tuple(s)
+            if r is None:
+                continue
+
+            self._rates[id_] = r[0]
+            r = tuple(r)
+            if self._counter_rates.get(id_) != r:
+                changed.append(k)
+            self._counter_rates[id_] = r
+
+            values = c + (r[0],)
+            self._history.record(id_, now, values)
+            self._rollups.record(id_, now, values)
+            if self._store is not None:
+                self._store.record(id_, now, values)
+
+        self._target_interfaces[target_name] = ids
+        self._sampled[target_name] = now
+
+        # Update this target's capture rate, then the total.
+        capture_rate = 0
+        for id_ in ids:
+            capture_rate += self._rates.get(id_, 0)
+        self._capture_rates[target_name] = capture_rate
+
+        self._capture_rate = 0
+        for v in self._capture_rates.itervalues():
+            self._capture_rate += v
+
+        alert_start = timestamp()
+        self._count_alerts(self._alerts.update(target_name, ids, rates,
+                                               capture_rate,
+                                               self._capture_rate, now,
+                                               changed))
+        self._alert_time.observe(timestamp() - alert_start)
+
+        self._publish(now)
+        self._update_time.observe(timestamp() - start)
+
+    def _count_alerts(self, events):
+        '''Count the alerts raised and cleared in the server's metrics.'''
+        for event in events:
+            self.metrics.counter('alerts_%s_total' % event['state'],
+                'Alerts %s.' % event['state'],
+                rule=event['rule']).inc()
+
+    def _publish(self, now):
+        '''Publish the current statistics as a new Snapshot.
+
+        :param now: the time of the update.'''
+        snapshot = Snapshot(self._snapshot.version + 1,
+                            dict(self._cstatistics), dict(self._rates),
+                            dict(self._capture_rates), self._capture_rate,
+                            now, self._update_interval(),
+                            dict(self._counter_rates), self._interfaces,
+                            dict(self._sampled))
+
+        with self._published:
+            self._snapshot = snapshot
+            self._published.notify_all()
+
+        shared = self._shared
+        if shared is not None:
+            shared.publish(pack(snapshot.as_binary()), now,
+                           snapshot.interval)
+
+    def _restore_history(self, retention):
+        '''Load recent history from the store, rebuild the rollups over each
+        level's retention, and expire old segments.
+
+        :param retention: time (s) of history to load.'''
+        now = timestamp()
+        self._store.expire(now)
+        longest = max(retention, self._rollups.levels[-1][1])
+        for id_ in self._store.ids():
+            times, columns = self._store.query(id_, now - longest, now)
+            self._rollups.load(id_, times, columns, now)
+
+            recent = bisect_left(times, now - retention)
+            for t, values in izip(times[recent:],
+                                  izip(*[c[recent:] for c in columns])):
+                self._history.record(id_, t, values)
+
+    def _update_interval(self):
+        '''Return the expected time (s) between updates.'''
+        if self._fake:
+            return self._polling_interval
+
+        return min(t.schedule.current for t in self._targets)
+
     def join(self):
         self._stats_thread.join()
 
+    def _dispatch(self, method, params, binary=False):
+        '''Call a registered method, recording its latency.
+
+        :param binary: whether the call came over the binary transport, so
+            that methods in binary_funcs are answered in their binary form.'''
+        func = None
+        if binary:
+            func = self.binary_funcs.get(method)
+        if func is None and method not in self.funcs:
+            return SimpleXMLRPCServer._dispatch(self, method, params)
+
+        start = timestamp()
+        try:
+            if func is not None:
+                return func(*params)
+            return SimpleXMLRPCServer._dispatch(self, method, params)
+        except Exception:
+            self.metrics.counter('rpc_errors_total',
+                                 'RPC calls that raised an error.',
+                                 method=method).inc()
+            raise
+        finally:
+            self.metrics.histogram('rpc_seconds', 'Time to handle an RPC.',
+                                   method=method).observe(timestamp() - start)
+
+    def metrics_struct(self):
+        '''Return the server's metrics, registered as metrics().
+
+        :returns: a list of structs, each with the keys name, type (counter
+            or histogram) and labels, and either value for a counter, or
+            count, sum and buckets for a histogram. Buckets are
+            [upper bound, cumulative count] pairs.'''
+        return self.metrics.as_struct()
+
+    def alerts(self):
+        '''Return the alerts raised by the alerting rules.
+
+        :returns: a struct with the keys:
+            active: the alerts active, in the order they were raised, each a
+                struct with the keys rule, signal, severity, subject (an
+                interface id, a target name or 'total'), value, peak,
+                raised, updated and samples.
+            recent: the latest alerts raised and cleared, oldest first,
+                each an alert struct with the keys state (raised or
+                cleared) and time.
+            rules: the rules, each a struct with the keys name, signal,
+                above, clear, samples and severity.'''
+        return self._alerts.as_struct()
+
+    def transports(self):
+        '''Return the transports the server can be called over, besides XML
+        RPC.
+
+        :returns: a struct mapping transport names to their paths.'''
+        return {'binary': BINARY_PATH}
+
     def interface(self, id_):
         '''Return interface statistics.
 
         :param id_: the interface being queried.'''
-        print self._cstatistics[id_]
-        return [ str(x) for x in self._cstatistics[id_] ]
+        snapshot = self._snapshot
+        return [ str(x) for x in snapshot.counters[id_] ]
+
+    def interface_binary(self, id_):
+        '''Return interface statistics as a Packed array of integers.'''
+        return Packed('Q', self._snapshot.counters[id_])
 
     def ethernet(self, id_):
         '''Return ethernet statistics.
 
         :param id_: the interface being queried.'''
-        if self._rates.has_key(id_):
-            raw_rate = self._rates[id_]*8/1000000000.0
-            return round(raw_rate,1)
+        snapshot = self._snapshot
+        if snapshot.rates.has_key(id_):
+            return to_gbps(snapshot.rates[id_])
 
         return 0
 
-    def capture(self):
-        '''Return capture statistics.'''
-        raw_rate = self._capture_rate*8/1000000000.0
-        return round(raw_rate,1)
+    def capture(self, target=None):
+        '''Return capture statistics.
+
+        :param target: name of the target being queried. When omitted, the
+            total over all targets is returned.'''
+        snapshot = self._snapshot
+        if target is None:
+            return to_gbps(snapshot.capture_rate)
+
+        return to_gbps(snapshot.capture_rates.get(target, 0))
+
+    def snapshot(self):
+        '''Return all statistics from the latest update in one call.
+
+        The result is a struct with the keys:
+            version: number of the update, increasing by one each time.
+            timestamp: time of the update, the receipt of a response.
+            interval: expected time (s) until the next update.
+            interfaces: interface statistics, as returned by interface(),
+                keyed by interface id.
+            ethernet: interface rates, as returned by ethernet(), keyed by
+                interface id.
+            rates: per second rates of each counter, in the order of
+                interface() without the interface number, keyed by
+                interface id.
+            targets: capture rates keyed by target name.
+            capture: total capture rate, as returned by capture().
+            ids: the interface ids, as returned by list_interfaces().
+            ids_version: the version of the interface list.
+            sampled: the time each target's latest response was received,
+                keyed by target name. Its interfaces' counters were read
+                then, so rates can be taken between two snapshots.
+
+        Times are seconds since the epoch, read from a monotonic clock (see
+        StatsSchedule.timestamp()), so the difference between two of them
+        is exact even if the system clock is set in between.'''
+        return self._snapshot.as_struct()
+
+    def snapshot_binary(self):
+        '''Return all statistics from the latest update, for the binary
+        transport. See Snapshot.as_binary().'''
+        return self._snapshot.as_binary()
+
+    def list_interfaces(self):
+        '''Return the interfaces discovered from the targets' responses.
+
+        :returns: a struct with the keys:
+            version: incremented each time the set of interfaces changes.
+            interfaces: the interface ids, ordered by target and interface
+                number.
+            targets: the interface ids of each target, keyed by target
+                name.'''
+        return self._snapshot.interfaces.as_struct()
+
+    def latest(self):
+        '''Return the latest published Snapshot, for use in-process.'''
+        return self._snapshot
+
+    def _wait(self, version, timeout):
+        '''Return the first Snapshot whose version differs from a given one,
+        or the current one after the timeout.'''
+        deadline = timestamp() + min(timeout, self.max_wait)
+        with self._published:
+            while self._snapshot.version == version and self._running:
+                remaining = deadline - timestamp()
+                if remaining <= 0:
+                    break
+                self._published.wait(remaining)
+
+            snapshot = self._snapshot
+
+        return snapshot
+
+    def wait(self, version, timeout):
+        '''Wait for a snapshot newer than a given version.
+
+        :param version: version of the caller's latest snapshot.
+        :param timeout: longest time (s) to wait, limited to max_wait.
+        :returns: the first snapshot, as returned by snapshot(), whose
+            version differs from the given one, or the current snapshot if
+            none is published before the timeout.'''
+        return self._wait(version, timeout).as_struct()
+
+    def wait_binary(self, version, timeout):
+        '''Wait for a snapshot newer than a given version, see wait().
+
+        :returns: the snapshot, as returned by snapshot_binary().'''
+        return self._wait(version, timeout).as_binary()
+
+    def history(self, ids, start, end=0, buckets=0):
+        '''Return the history of interface statistics over a time range.
+
+        :param ids: list of the interfaces being queried.
+        :param start: start of the range. Values of zero or less are taken
+            relative to the end of the range.
+        :param end: end of the range, or zero for the current time.
+        :param buckets: the largest number of points to return, each
+            aggregating an equal part of the range, or zero for every sample.
+        :returns: a struct with the keys:
+            fields: the names of the values in each sample.
+            start, end: the absolute time range.
+            interfaces: for each interface id, a list of rows
+                [time, count, mins, maxs, avgs, lasts] as described in
+                StatsHistory.downsample().
+
+        Ranges divided into buckets of 10 s or more are answered from the
+        rollups (see StatsRollup), at the coarsest resolution that fills
+        the buckets. Other ranges starting before the history kept in memory
+        are answered from the store, when there is one.'''
+        if end <= 0:
+            end = timestamp()
+        if start <= 0:
+            start = end + start
+
+        interfaces = dict()
+        for id_ in ids:
+            interfaces[id_] = self._query_history(id_, start, end, buckets)
+
+        return {
+            'fields': list(self._history.fields),
+            'start': start,
+            'end': end,
+            'interfaces': interfaces,
+            }
+
+    def _query_history(self, id_, start, end, buckets):
+        '''Return an interface's history, as for history().'''
+        rows = self._rollups.query(id_, start, end, buckets)
+        if rows is not None:
+            return rows
+
+        oldest = self._history.oldest(id_)
+        if oldest is None or start < oldest:
+            if self._store is not None:
+                return self._stored_history(id_, start, end, buckets)
+
+            # Rollups may reach further back than the samples kept.
+            rollup_oldest = self._rollups.oldest(id_)
+            if rollup_oldest is not None and \
+               (oldest is None or rollup_oldest < oldest):
+                rows = self._rollups.query(id_, start, end, buckets,
+                                           cover=False)
+                if rows is not None:
+                    return rows
+
+        return self._history.query(id_, start, end, buckets)
+
+    def _stored_history(self, id_, start, end, buckets):
+        '''Return an interface's history from the store, as for history().'''
+        times, columns = self._store.query(id_, start, end)
+        if len(times) <= buckets:
+            buckets = 0
+
+        return downsample_columns(times, columns, start, end, buckets)
+
+
+class ThreadedStatsServer(ThreadingMixIn, StatsServer):
+    '''A StatsServer that handles each request in its own thread.
+
+    Slow clients no longer delay others. Handlers only read the published
+    Snapshot, so no locking is needed. As a connection no longer blocks the
+    server, connections are kept open for reuse by clients.'''
+
+
+    daemon_threads = True
+    request_handler = KeepAliveRequestHandler
+
+    # Allow bursts of connections from many clients without dropping SYNs.
+    request_queue_size = 128
+
+    # Each waiting client only holds its own thread.
+    max_wait = 60
+
 
 def usage():
     print '''
 usage: statsserver -l <logger host>
                    -p <logger port>
+                   -T <name>=<logger host>:<logger port>[:<polling interval(s)>]
+                        poll an additional named logger (may be repeated)
                    -b <bind port>
-                   -i <polling interval(s)>
+                   -i <polling interval(s), from %g>
+                   -j <polling jitter(s)>
+                   -a   stretch the polling interval while loggers are slow
+                   -r <history retention(s), at most %d samples>
+                   -R <rollup levels, <bucket width(s)>:<retention(s)>,...>
+                        (%s by default)
+                   -d <history store directory>
+                   -m <shared memory file>, e.g. /dev/shm/statsserver
+                   -A <alerting rules file, a JSON list of rules>
+                   -N <alert notifier: log, file:<path> or webhook:<url>>
+                        (may be repeated, log by default)
+                   -c   serve requests concurrently
+                   -v   print the rates after each poll
                    -F   generate fake data
+                   -n <number of fake interfaces>
+                   -P <fake traffic profile: %s>
                    -h   print this message.
-'''
+
+Alerting rules are structs with the keys name, signal, above and optionally
+clear, samples and severity. The signals are:
+%s
+''' % (MIN_INTERVAL, HISTORY_SAMPLES,
+       ','.join(['%d:%d' % level for level in ROLLUP_LEVELS]),
+       ', '.join(sorted(PROFILES.keys())),
+       textwrap.fill(', '.join(sorted(SIGNAL_SCOPES.keys())), 76,
+                     initial_indent='    ', subsequent_indent='    '))
 
 #------------------------------------------------------------------------------
 # Main program
@@ -402,10 +1499,23 @@ if __name__ == '__main__':
     BIND_PORT = 9000
     LOGGER_HOST = 'localhost'
     POLLING_INTERVAL = 5
+    JITTER = 0.0
+    ADAPTIVE = False
+    RETENTION = HISTORY_RETENTION
+    ROLLUPS = ROLLUP_LEVELS
+    STORE = None
+    SHARED = None
+    RULES = None
+    NOTIFIERS = []
     FAKE = False
+    FAKE_INTERFACES = 4
+    FAKE_PROFILE = 'steady'
+    CONCURRENT = False
+    VERBOSE = False
+    TARGETS = []
 
     # Parse command line options.
-    OPTIONS = 'l:p:b:i:hF'
+    OPTIONS = 'l:p:T:b:i:j:r:R:d:m:A:N:n:P:achvF'
     try:
         opts, args = getopt.getopt(sys.argv[1:], OPTIONS)
     except getopt.GetoptError, err:
@@ -418,12 +1528,67 @@ if __name__ == '__main__':
             LOGGER_HOST = a
         elif o == '-p':
             LOGGER_PORT = int(a)
+        elif o == '-T':
+            try:
+                name, spec = a.split('=', 1)
+                spec = spec.split(':')
+                interval = None
+                if len(spec) > 2:
+                    interval = float(spec[2])
+                TARGETS.append((name, spec[0], int(spec[1]), interval))
+            except (ValueError, IndexError):
+                print 'Invalid target: %s' % a
+                usage()
+                sys.exit(2)
         elif o == '-b':
             BIND_PORT = int(a)
         elif o == '-i':
-            POLLING_INTERVAL = int(a)
+            POLLING_INTERVAL = float(a)
+        elif o == '-j':
+            JITTER = float(a)
+        elif o == '-a':
+            ADAPTIVE = True
+        elif o == '-r':
+            RETENTION = int(a)
+        elif o == '-R':
+            try:
+                ROLLUPS = parse_levels(a)
+            except ValueError, e:
+                print str(e)
+                usage()
+                sys.exit(2)
+        elif o == '-d':
+            STORE = a
+        elif o == '-m':
+            SHARED = a
+        elif o == '-A':
+            try:
+                RULES = load_rules(a)
+            except (IOError, ValueError), e:
+                print 'Invalid alerting rules: %s' % e
+                usage()
+                sys.exit(2)
+        elif o == '-N':
+            try:
+                NOTIFIERS.append(make_notifier(a))
+            except ValueError, e:
+                print str(e)
+                usage()
+                sys.exit(2)
+        elif o == '-c':
+            CONCURRENT = True
+        elif o == '-v':
+            VERBOSE = True
         elif o == '-F':
             FAKE = True
+        elif o == '-n':
+            FAKE_INTERFACES = int(a)
+        elif o == '-P':
+            if not PROFILES.has_key(a):
+                print 'Unknown traffic profile: %s' % a
+                usage()
+                sys.exit(2)
+            FAKE_PROFILE = a
         elif o == '-h':
             usage()
             sys.exit(2)
@@ -431,9 +1596,32 @@ if __name__ == '__main__':
             usage()
             assert False, 'Unhandled option: %s'%str(o)
 
+    # Named targets are polled instead of the default logger.
+    if not TARGETS:
+        TARGETS = [('', LOGGER_HOST, LOGGER_PORT, None)]
+
+    TARGET = []
+    for name, host, port, interval in TARGETS:
+        if interval is None:
+            interval = POLLING_INTERVAL
+        TARGET.append(Target(name, (host, port),
+                             max(interval, MIN_INTERVAL), jitter=JITTER,
+                             adaptive=ADAPTIVE))
+
+    if FAKE:
+        FAKE = FakeData(FAKE_INTERFACES, FAKE_PROFILE, POLLING_INTERVAL)
+
+    if not NOTIFIERS:
+        NOTIFIERS = [make_notifier('log')]
+    ALERTS = AlertEngine(RULES, NOTIFIERS)
+
     # Instantiate and start the server.
-    s = StatsServer(POLLING_INTERVAL, ('localhost', BIND_PORT),
-                    (LOGGER_HOST, LOGGER_PORT), FAKE)
+    server_class = StatsServer
+    if CONCURRENT:
+        server_class = ThreadedStatsServer
+
+    s = server_class(POLLING_INTERVAL, ('localhost', BIND_PORT), TARGET, FAKE,
+                     RETENTION, STORE, SHARED, ALERTS, VERBOSE, ROLLUPS)
     s.start()
     s.serve_forever()
 
@@ -0,0 +1,150 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Shared memory publishing of the StatsServer's snapshots. Each snapshot is
+#   written, in the encoding of the binary transport (see StatsBinary), to a
+#   memory mapped file, usually under /dev/shm, so that readers on the same
+#   host map the file and read the latest snapshot without a network call.
+#
+#   The file starts with a header of HEADER_SIZE bytes, little-endian:
+#
+#       offset  0: MAGIC
+#       offset  4: LAYOUT_VERSION, unsigned 32-bit
+#       offset  8: sequence, unsigned 64-bit
+#       offset 16: length of the snapshot, unsigned 64-bit
+#       offset 24: time of the snapshot (s since the epoch), double
+#       offset 32: polling interval (s), double
+#
+#   and the encoded snapshot follows it. Writes are guarded by the sequence,
+#   as a seqlock: it is made odd before the snapshot is written and even
+#   again once it is complete. A reader reads the sequence, then the
+#   snapshot, then the sequence again, and retries if it was odd or has
+#   changed. Readers take no lock, and never delay the writer.
+#
+#   The file only grows, so a reader's mapping stays valid. A snapshot larger
+#   than the file grows it, and readers remap it to read beyond their
+#   mapping. The sequence carries on from the file's, so that readers do not
+#   mistake a restarted server's first snapshots for ones they have read.
+#
+#   Directories such as /dev/shm are writable by every user, so the file is
+#   created exclusively with permissions 0600, and an existing one is only
+#   used if it is a regular file, not a symbolic link, owned by the server's
+#   user and writable by no other. Readers make the same check, so the
+#   StatsServer and its readers run as the same user.
+#------------------------------------------------------------------------------
+
+import errno
+import mmap
+import os
+import stat
+import struct
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Identifies a shared snapshot file, and the layout of its header.
+MAGIC = 'VDSS'
+LAYOUT_VERSION = 1
+
+# Size (bytes) of the header, and of a new file.
+HEADER_SIZE = 64
+INITIAL_SIZE = 1 << 16
+
+# Offsets of the header fields.
+SEQUENCE_OFFSET = 8
+LENGTH_OFFSET = 16
+
+# Flag refusing to open a file through a symbolic link, where supported.
+_O_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)
+
+_sequence = struct.Struct('<Q')
+_layout = struct.Struct('<4sI')
+_fields = struct.Struct('<Qdd')
+
+
+def is_private(st):
+    '''Return whether a file is a regular file owned by the current user and
+    writable by no other.
+
+    :param st: the file's status, as returned by os.fstat().'''
+    return stat.S_ISREG(st.st_mode) and st.st_uid == os.getuid() and \
+        not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+class SharedSnapshot(object):
+    '''Publish snapshots to a memory mapped file.'''
+
+
+    def __init__(self, path, size=INITIAL_SIZE):
+        '''Constructor.
+
+        :param path: path of the file, created if it does not exist.
+        :param size: initial size (bytes) of the file.
+        :raises OSError: if an existing file is a symbolic link or not
+            private to the current user (see is_private()).'''
+        self.path = path
+        try:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0600)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            self._fd = os.open(path, os.O_RDWR | _O_NOFOLLOW)
+            if not is_private(os.fstat(self._fd)):
+                os.close(self._fd)
+                raise OSError(errno.EACCES, 'Not private to this user', path)
+
+        size = max(size, HEADER_SIZE, os.fstat(self._fd).st_size)
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+        # Carry on from the sequence of an earlier server, made even.
+        self._sequence = 0
+        if _layout.unpack_from(self._map, 0) == (MAGIC, LAYOUT_VERSION):
+            self._sequence = _sequence.unpack_from(self._map,
+                                                   SEQUENCE_OFFSET)[0]
+            self._sequence += self._sequence & 1
+
+        _sequence.pack_into(self._map, SEQUENCE_OFFSET, self._sequence + 1)
+        _layout.pack_into(self._map, 0, MAGIC, LAYOUT_VERSION)
+        _sequence.pack_into(self._map, SEQUENCE_OFFSET, self._sequence)
+
+    def sequence(self):
+        '''Return the sequence number of the latest snapshot written.'''
+        return self._sequence
+
+    def publish(self, data, timestamp, interval):
+        '''Write a snapshot.
+
+        :param data: the encoded snapshot.
+        :param timestamp: time of the snapshot.
+        :param interval: expected time (s) until the next snapshot.'''
+        n = len(data)
+        _sequence.pack_into(self._map, SEQUENCE_OFFSET, self._sequence + 1)
+
+        if HEADER_SIZE + n > len(self._map):
+            self._grow(HEADER_SIZE + n)
+
+        self._map[HEADER_SIZE:HEADER_SIZE + n] = data
+        _fields.pack_into(self._map, LENGTH_OFFSET, n, timestamp or 0,
+                          interval)
+
+        self._sequence += 2
+        _sequence.pack_into(self._map, SEQUENCE_OFFSET, self._sequence)
+
+    def _grow(self, size):
+        '''Grow the file to hold at least size bytes.'''
+        new_size = len(self._map)
+        while new_size < size:
+            new_size *= 2
+
+        os.ftruncate(self._fd, new_size)
+        self._map.close()
+        self._map = mmap.mmap(self._fd, new_size)
+
+    def close(self):
+        '''Unmap the file, leaving the latest snapshot in it.'''
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+            self._map = None
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Simulated acquisition system data, for demonstrations and load testing.
+#
+#   FakeData keeps the counters of any number of interfaces. Each update
+#   advances them by one interval of traffic drawn from a profile, with the
+#   random values for all interfaces drawn in one batch, and renders the
+#   response from templates compiled once. The profiles are:
+#
+#       steady: uniformly random traffic, as the original FakeData produced.
+#       bursty: interfaces alternate between idle periods and line-rate
+#           bursts.
+#       drops: steady traffic with occasional drop storms, during which a
+#           large share of bytes and packets is dropped and errors appear.
+#       wrap: steady traffic with counters starting just below the counter
+#           range, so that they may wrap around after a few updates.
+#
+#   To measure how fast responses are generated, use:
+#
+#       $ python StatsSimulation.py -n 1000 -P bursty
+#------------------------------------------------------------------------------
+
+import getopt
+import random
+import sys
+import time
+from itertools import izip
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Maximum increments per second of an interface's counters.
+BYTE_INCREMENT = 1000000000
+PACKET_INCREMENT = BYTE_INCREMENT/8000
+
+# Width (bits) of the simulated counters.
+COUNTER_BITS = 64
+
+
+class SteadyProfile(object):
+    '''Uniformly random traffic on every interface.'''
+
+
+    def __init__(self, num_interfaces, rnd):
+        '''Constructor.
+
+        :param num_interfaces: the number of interfaces.
+        :param rnd: the random.Random instance to draw from.'''
+        self.num_interfaces = num_interfaces
+        self.rnd = rnd
+
+    def initial(self, bits):
+        '''Return the initial values of the counters, in FakeData.STAT_KEYS
+        order.'''
+        return [0]*5
+
+    def uniform(self, scale):
+        '''Return a list of uniform random integers in [0, scale], one for
+        each interface.'''
+        r = self.rnd.random
+        return [int(r()*scale) for i in xrange(self.num_interfaces)]
+
+    def increments(self, interval):
+        '''Return the counter increments for one update.
+
+        :param interval: simulated time (s) since the last update.
+        :returns: a list of five lists, one for each counter in
+            FakeData.STAT_KEYS order, of one increment per interface.'''
+        b = BYTE_INCREMENT*interval
+        p = PACKET_INCREMENT*interval
+        return [self.uniform(b), self.uniform(b), self.uniform(p),
+                self.uniform(p), self.uniform(p)]
+
+
+class BurstyProfile(SteadyProfile):
+    '''Idle periods broken by line-rate bursts.'''
+
+
+    # Chance per update of a burst starting, and of one ending.
+    START = 0.1
+    END = 0.3
+
+    # Share of the maximum rate while idle.
+    IDLE = 0.05
+
+    def __init__(self, num_interfaces, rnd):
+        SteadyProfile.__init__(self, num_interfaces, rnd)
+        self.bursting = [False]*num_interfaces
+
+    def increments(self, interval):
+        r = self.rnd.random
+        self.bursting = [r() > BurstyProfile.END if bursting
+                         else r() < BurstyProfile.START
+                         for bursting in self.bursting]
+
+        idle = BurstyProfile.IDLE
+        scale = [(0.9 + 0.1*r())*(1.0 if bursting else idle)
+                 for bursting in self.bursting]
+        byte_scale = BYTE_INCREMENT*interval
+        packet_scale = PACKET_INCREMENT*interval
+
+        return [[int(s*byte_scale) for s in scale],
+                self.uniform(byte_scale*idle),
+                [int(s*packet_scale) for s in scale],
+                self.uniform(packet_scale*idle),
+                self.uniform(packet_scale*idle)]
+
+
+class DropStormProfile(SteadyProfile):
+    '''Steady traffic with occasional storms of drops and errors.'''
+
+
+    # Chance per update of a storm starting, and of one ending.
+    START = 0.02
+    END = 0.25
+
+    # Share of traffic dropped outside of and during storms.
+    CALM = 0.001
+    STORM = 0.5
+
+    def __init__(self, num_interfaces, rnd):
+        SteadyProfile.__init__(self, num_interfaces, rnd)
+        self.storming = [False]*num_interfaces
+
+    def increments(self, interval):
+        r = self.rnd.random
+        self.storming = [r() > DropStormProfile.END if s
+                         else r() < DropStormProfile.START
+                         for s in self.storming]
+
+        share = [DropStormProfile.STORM if s else DropStormProfile.CALM
+                 for s in self.storming]
+        byte_count = self.uniform(BYTE_INCREMENT*interval)
+        packet_count = self.uniform(PACKET_INCREMENT*interval)
+
+        return [byte_count,
+                [int(b*s*r()) for b, s in izip(byte_count, share)],
+                packet_count,
+                [int(p*s*r()) for p, s in izip(packet_count, share)],
+                [int(p*s*s*r()) for p, s in izip(packet_count, share)]]
+
+
+class WrapProfile(SteadyProfile):
+    '''Steady traffic with counters about to wrap around.'''
+
+
+    # Number of updates at the maximum rate before the counters wrap.
+    UPDATES = 3
+
+    def initial(self, bits):
+        b = BYTE_INCREMENT*WrapProfile.UPDATES
+        p = PACKET_INCREMENT*WrapProfile.UPDATES
+        return [((1 << bits) - x) % (1 << bits) for x in (b, b, p, p, p)]
+
+
+# Traffic profiles by name.
+PROFILES = {
+    'steady': SteadyProfile,
+    'bursty': BurstyProfile,
+    'drops': DropStormProfile,
+    'wrap': WrapProfile,
+    }
+
+
+class FakeData(object):
+    '''Generate fake acquisition system data.'''
+
+
+    # Static fake data tags and templates.
+    FAKE_START_TAG = '''<cmd_resp>'''
+    FAKE_END_TAG = '''</cmd_resp>'''
+    FAKE_HEADER = '''
+        <cmd_name>get stats</cmd_name>
+        <retVal>0</retVal>
+        <reason>success</reason>
+        <param>
+          <name>interfaceCount</name><type>unsigned</type><value>%d</value>
+        </param>'''
+
+    FAKE_BODY = '''
+        <param>
+          <name>interfaceType</name><type>keyword</type><value>Ethernet</value>
+        </param>
+        <param>
+          <name>interfaceNumber</name><type>unsigned</type><value>%d</value>
+        </param>
+        <param>
+          <name>byteCount</name><type>unsigned long</type><value>%d</value>
+        </param>
+        <param>
+          <name>bytesDropped</name><type>unsigned long</type><value>%d</value>
+        </param>
+        <param>
+          <name>packetCount</name><type>unsigned long</type><value>%d</value>
+        </param>
+        <param>
+          <name>packetsDropped</name><type>unsigned long</type><value>%d</value>
+        </param>
+        <param>
+          <name>errorCount</name><type>unsigned long</type><value>%d</value>
+        </param>'''
+
+    # List of keys that will be updated.
+    STAT_KEYS = ['byte_count', 'bytes_dropped', 'packet_count',
+        'packets_dropped', 'error_count']
+
+    # Useful constants.
+    BYTE_INCREMENT = BYTE_INCREMENT
+    PACKET_INCREMENT = PACKET_INCREMENT
+
+    def __init__(self, num_interfaces=4, profile='steady', interval=1.0,
+        seed=None, bits=COUNTER_BITS):
+        '''Constructor.
+
+        :param num_interfaces: the number of interfaces.
+        :param profile: name of the traffic profile, see PROFILES.
+        :param interval: simulated time (s) between updates.
+        :param seed: seed for the random traffic, or None.
+        :param bits: width (bits) of the counters.'''
+        if not PROFILES.has_key(profile):
+            raise ValueError('Unknown traffic profile: %s' % profile)
+
+        self.num_interfaces = num_interfaces
+        self.interval = interval
+        self.profile = PROFILES[profile](num_interfaces, random.Random(seed))
+        self._mask = (1 << bits) - 1
+
+        # The counters, one list for each of STAT_KEYS.
+        self.counters = [[x]*num_interfaces
+                         for x in self.profile.initial(bits)]
+
+        # Rendering format for all the interfaces at once.
+        self._format = ''.join([FakeData.FAKE_START_TAG,
+                                FakeData.FAKE_HEADER % num_interfaces,
+                                FakeData.FAKE_BODY*num_interfaces,
+                                FakeData.FAKE_END_TAG])
+
+    @property
+    def interfaces(self):
+        '''The statistics of each interface, as a list of dicts.'''
+        interfaces = []
+        for i in xrange(self.num_interfaces):
+            stats = dict((k, c[i]) for k, c in izip(FakeData.STAT_KEYS,
+                                                     self.counters))
+            stats['int_id'] = i
+            interfaces.append(stats)
+
+        return interfaces
+
+    def update_interface(self, int_id, byte_count, bytes_dropped, packet_count,
+        packets_dropped, error_count):
+        '''Update the statistics on an interface.
+
+        :param int_id: interface identifier/index.
+        :param byte_count: total byte count so far.
+        :param bytes_dropped: total bytes dropped so far.
+        :param packet_count: total packet count so far.
+        :param packets_dropped: total packets dropped so far.
+        :param error_count: errors seen so far.'''
+        if int_id < 0 or int_id >= self.num_interfaces:
+            raise ValueError('Invalid interface id: %d' % int_id)
+
+        increments = (byte_count, bytes_dropped, packet_count,
+                      packets_dropped, error_count)
+        for c, x in izip(self.counters, increments):
+            c[int_id] = (c[int_id] + x) & self._mask
+
+    def update(self, interval=None):
+        '''Advance all interfaces by one interval of traffic.
+
+        :param interval: simulated time (s) since the last update, or None
+            for the configured interval.'''
+        if interval is None:
+            interval = self.interval
+
+        mask = self._mask
+        increments = self.profile.increments(interval)
+        self.counters = [[(c + x) & mask for c, x in izip(counter, increment)]
+                         for counter, increment in izip(self.counters,
+                                                        increments)]
+
+    def render(self):
+        '''Return the current statistics as an XML response.'''
+        values = [None]*(6*self.num_interfaces)
+        values[0::6] = xrange(self.num_interfaces)
+        for k, c in enumerate(self.counters):
+            values[k + 1::6] = c
+
+        return self._format % tuple(values)
+
+    def __str__(self):
+        '''Returns new statistic XML string for parsing.'''
+        self.update()
+        return self.render()
+
+
+def usage():
+    print '''
+usage: StatsSimulation -n <number of interfaces>
+                       -P <traffic profile: %s>
+                       -t <duration of the measurement(s)>
+                       -h   print this message.
+''' % ', '.join(sorted(PROFILES.keys()))
+
+#------------------------------------------------------------------------------
+# Main program
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    NUM_INTERFACES = 1000
+    PROFILE = 'steady'
+    DURATION = 5.0
+
+    # Parse command line options.
+    OPTIONS = 'n:P:t:h'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], OPTIONS)
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-n':
+            NUM_INTERFACES = int(a)
+        elif o == '-P':
+            if not PROFILES.has_key(a):
+                print 'Unknown traffic profile: %s' % a
+                usage()
+                sys.exit(2)
+            PROFILE = a
+        elif o == '-t':
+            DURATION = float(a)
+        elif o == '-h':
+            usage()
+            sys.exit(2)
+        else:
+            usage()
+            assert False, 'Unhandled option: %s'%str(o)
+
+    fd = FakeData(NUM_INTERFACES, PROFILE)
+    updates = 0
+    size = 0
+    start = time.time()
+    while time.time() - start < DURATION:
+        size += len(str(fd))
+        updates += 1
+    elapsed = time.time() - start
+
+    print '%d updates of %d interfaces in %.1fs: %.0f records/s, %.1f MB/s' % (
+        updates, NUM_INTERFACES, elapsed, updates*NUM_INTERFACES/elapsed,
+        size/elapsed/1000000)
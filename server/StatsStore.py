@@ -0,0 +1,388 @@
+#------------------------------------------------------------------------------
+# Description:
+#
+#   Durable on-disk store for interface statistics samples.
+#
+#   Each interface has a directory of append-only segment files. A segment
+#   holds the samples for one aligned time slot (an hour by default) and is
+#   named after the start of that slot, so the files covering a time range
+#   are found from their names alone. Each file starts with a fixed-size
+#   header, followed by fixed-size records:
+#
+#       header: magic, header size, values per record, slot start, duration
+#       record: timestamp, values..., crc32 of the preceding bytes, padding
+#
+#   all little-endian doubles and unsigned ints. Records are appended with a
+#   single write() so a process killed at any point leaves at most the last
+#   record torn; it is detected by its length or checksum and truncated the
+#   next time the segment is opened for writing. Segments no longer written
+#   to are opened read-only, skipping a torn record rather than truncating
+#   it, so a query never modifies a file.
+#
+#   Reads go through read-only memory maps. The records in the requested
+#   range are converted to arrays of doubles in one piece, and each column
+#   is sliced out of them, so no record is decoded on its own.
+#
+#   Segments whose slot has ended more than the retention period ago are
+#   deleted as new segments are started.
+#------------------------------------------------------------------------------
+
+import mmap
+import os
+import struct
+import sys
+import threading
+import urllib
+import zlib
+from array import array
+from itertools import izip
+
+#------------------------------------------------------------------------------
+# Globals
+#------------------------------------------------------------------------------
+
+# Segment file header.
+MAGIC = 'VDASSEG1'
+HEADER = struct.Struct('<8sIIdd')
+HEADER_SIZE = 64
+
+# Suffix of segment file names.
+SEGMENT_SUFFIX = '.seg'
+
+# Default time (s) covered by each segment, and kept before deletion.
+SEGMENT_DURATION = 3600
+STORE_RETENTION = 7*86400
+
+
+class Segment(object):
+    '''An append-only file of fixed-size, time-ordered records.'''
+
+
+    def __init__(self, path, width, start=None, duration=None,
+        readonly=False):
+        '''Open a segment, creating it if start and duration are given.
+
+        :param path: the segment file path.
+        :param width: number of values in each record.
+        :param start: start of the time slot covered by a new segment.
+        :param duration: length (s) of the time slot of a new segment.
+        :param readonly: whether to open an existing segment for reading
+            only, leaving any torn record to the writer.'''
+        self.path = path
+        self.width = width
+        self.record = struct.Struct('<%dd' % (width + 1))
+        self.record_size = self.record.size + 8
+
+        # Each record is width + 2 doubles long, with the checksum and
+        # padding in the last.
+        self.stride = self.record_size//8
+
+        if readonly:
+            self._fd = os.open(path, os.O_RDONLY)
+        else:
+            self._create(path, width, start, duration)
+            self._fd = os.open(path, os.O_RDWR | os.O_APPEND)
+        self._read_header()
+        self._recover(truncate=not readonly)
+
+        self._map = None
+        self._map_count = 0
+
+    def _create(self, path, width, start, duration):
+        '''Create the segment file if it does not exist.'''
+        if not os.path.exists(path):
+            # Write the header to a new file first, so that a segment is
+            # never seen without one.
+            header = HEADER.pack(MAGIC, HEADER_SIZE, width, start, duration)
+            with open(path + '.new', 'wb') as f:
+                f.write(header.ljust(HEADER_SIZE, '\0'))
+            os.rename(path + '.new', path)
+
+    def _read_header(self):
+        '''Read and validate the segment header.'''
+        header = self._pread(0, HEADER.size)
+        magic, size, width, self.start, self.duration = HEADER.unpack(header)
+        if magic != MAGIC or size != HEADER_SIZE or width != self.width:
+            raise ValueError('Invalid segment: %s' % self.path)
+
+        self.end = self.start + self.duration
+
+    def _pread(self, offset, size):
+        '''Read from the segment without moving the append position.'''
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def _recover(self, truncate=True):
+        '''Count the complete records, discarding a torn record left by an
+        interrupted append.
+
+        :param truncate: whether to truncate the file after the complete
+            records.'''
+        size = os.fstat(self._fd).st_size
+        self.count = (size - HEADER_SIZE)//self.record_size
+
+        if self.count > 0:
+            offset = HEADER_SIZE + (self.count - 1)*self.record_size
+            data = self._pread(offset, self.record_size)
+            if not self._valid(data):
+                self.count -= 1
+
+        valid = HEADER_SIZE + self.count*self.record_size
+        if truncate and valid != size:
+            os.ftruncate(self._fd, valid)
+
+        self.last = None
+        if self.count > 0:
+            offset = HEADER_SIZE + (self.count - 1)*self.record_size
+            self.last = self.record.unpack_from(
+                self._pread(offset, self.record.size))[0]
+
+    def _valid(self, data):
+        '''Return whether a record's checksum matches its contents.'''
+        body = data[:self.record.size]
+        crc, = struct.unpack_from('<I', data, self.record.size)
+        return crc == zlib.crc32(body) & 0xffffffff
+
+    def append(self, timestamp, values):
+        '''Append a record.
+
+        :param timestamp: time of the sample.
+        :param values: sequence of width values.'''
+        body = self.record.pack(timestamp, *values)
+        os.write(self._fd, body + struct.pack('<II',
+                                              zlib.crc32(body) & 0xffffffff, 0))
+        self.count += 1
+        self.last = timestamp
+
+    def _view(self):
+        '''Return a read-only map of the segment's complete records.'''
+        count = self.count
+        if self._map is None or self._map_count != count:
+            self._map = mmap.mmap(self._fd,
+                                  HEADER_SIZE + count*self.record_size,
+                                  access=mmap.ACCESS_READ)
+            self._map_count = count
+
+        return self._map, count
+
+    def _time(self, view, i):
+        return struct.unpack_from('<d', view, HEADER_SIZE +
+                                  i*self.record_size)[0]
+
+    def _bisect(self, view, count, t, right=False):
+        '''Return the index of the first record after (or at) time t.'''
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi)//2
+            m = self._time(view, mid)
+            if m < t or (right and m == t):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def slice(self, start, end):
+        '''Return the records between two times without copying them.
+
+        :param start: start of the range (inclusive).
+        :param end: end of the range (inclusive).
+        :returns: a (buffer, count) pair, where the buffer refers directly
+            to the count records in the mapped file.'''
+        view, count = self._view()
+        lo = self._bisect(view, count, start)
+        hi = self._bisect(view, count, end, right=True)
+        offset = HEADER_SIZE + lo*self.record_size
+        return buffer(view, offset, (hi - lo)*self.record_size), hi - lo
+
+    def columns(self, data, count):
+        '''Return the columns of records returned by slice().
+
+        :returns: a (times, values) pair, where times is an array of the
+            records' times and values a list of arrays, one per value.'''
+        records = array('d')
+        records.fromstring(data)
+        if sys.byteorder == 'big':
+            records.byteswap()
+
+        stride = self.stride
+        return records[::stride], [records[1 + k::stride]
+                                   for k in xrange(self.width)]
+
+    def close(self):
+        '''Close the segment.'''
+        self._map = None
+        os.close(self._fd)
+
+
+class StatsStore(object):
+    '''Durable store of timestamped samples for a set of interfaces.'''
+
+
+    def __init__(self, root, fields, duration=SEGMENT_DURATION,
+        retention=STORE_RETENTION):
+        '''Constructor.
+
+        :param root: directory holding the store.
+        :param fields: names of the values in each sample.
+        :param duration: time (s) covered by each segment.
+        :param retention: time (s) for which segments are kept.'''
+        self.root = root
+        self.fields = tuple(fields)
+        self.duration = duration
+        self.retention = retention
+        self._lock = threading.Lock()
+
+        # The segment being written for each interface.
+        self._segments = dict()
+
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def record(self, id_, timestamp, values):
+        '''Append a sample for an interface.
+
+        Samples older than the interface's newest sample are ignored.
+
+        :param id_: the interface id.
+        :param timestamp: time of the sample.
+        :param values: sequence of values, in fields order.'''
+        slot = timestamp - timestamp % self.duration
+        with self._lock:
+            segment = self._segments.get(id_)
+            if segment is not None and segment.last is not None and \
+               timestamp < segment.last:
+                return
+
+            if segment is None or segment.start != slot:
+                segment = self._start(id_, slot)
+            segment.append(timestamp, values)
+
+    def query(self, id_, start, end):
+        '''Return an interface's samples between two times, by column.
+
+        :param id_: the interface id.
+        :param start: start of the range (inclusive).
+        :param end: end of the range (inclusive).
+        :returns: a (times, values) pair, where times is an array of the
+            samples' times in order, and values a list of arrays, one per
+            field.'''
+        times = array('d')
+        values = [array('d') for f in self.fields]
+        for segment, data, count in self._slices(id_, start, end):
+            t, v = segment.columns(data, count)
+            times.extend(t)
+            for column, c in izip(values, v):
+                column.extend(c)
+
+        return times, values
+
+    def oldest(self, id_):
+        '''Return the time of an interface's oldest sample, or None.'''
+        for segment, data, count in self._slices(id_, 0, float('inf')):
+            if count:
+                return segment.record.unpack_from(data)[0]
+
+        return None
+
+    def ids(self):
+        '''Return the ids of interfaces with stored samples.'''
+        return [urllib.unquote(d) for d in os.listdir(self.root)
+                if os.path.isdir(os.path.join(self.root, d))]
+
+    def expire(self, now):
+        '''Delete segments that ended more than the retention period ago.
+
+        :param now: the current time.'''
+        with self._lock:
+            for id_ in self.ids():
+                self._expire(id_, now)
+
+    def close(self):
+        '''Close all open segments.'''
+        with self._lock:
+            for segment in self._segments.itervalues():
+                segment.close()
+            self._segments = dict()
+
+    def _slices(self, id_, start, end):
+        '''Slice the segments of an interface overlapping a time range.
+
+        :returns: a list of (segment, buffer, count) triples.'''
+        slices = []
+        with self._lock:
+            for slot in self._slots(id_):
+                if slot > end or slot + self.duration < start:
+                    continue
+
+                # Segments no longer written to are opened read-only and
+                # not kept open, their maps stay valid once closed.
+                path = self._path(id_, slot)
+                segment = self._segments.get(id_)
+                if segment is None or segment.path != path:
+                    segment = Segment(path, len(self.fields), readonly=True)
+                    data, count = segment.slice(start, end)
+                    segment.close()
+                else:
+                    data, count = segment.slice(start, end)
+
+                slices.append((segment, data, count))
+
+        return slices
+
+    def _start(self, id_, slot):
+        '''Start writing an interface's segment for a new slot, reopening it
+        if it already exists.'''
+        path = self._path(id_, slot)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Only the segment being written is kept open.
+        previous = self._segments.pop(id_, None)
+        if previous is not None:
+            previous.close()
+
+        segment = Segment(path, len(self.fields), slot, self.duration)
+        self._segments[id_] = segment
+        self._expire(id_, slot)
+        return segment
+
+    def _expire(self, id_, now):
+        '''Delete an interface's segments that ended more than the retention
+        period before now.'''
+        horizon = now - self.retention
+        for slot in self._slots(id_):
+            if slot + self.duration >= horizon:
+                break
+
+            path = self._path(id_, slot)
+            segment = self._segments.get(id_)
+            if segment is not None and segment.path == path:
+                del self._segments[id_]
+                segment.close()
+            os.remove(path)
+
+        directory = os.path.dirname(self._path(id_, 0))
+        if not os.listdir(directory):
+            os.rmdir(directory)
+
+    def _slots(self, id_):
+        '''Return the start times of an interface's segments, in order.'''
+        directory = os.path.join(self.root, urllib.quote(id_, safe=''))
+        if not os.path.isdir(directory):
+            return []
+
+        slots = []
+        for name in os.listdir(directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                slots.append(int(name[:-len(SEGMENT_SUFFIX)])/1000.0)
+
+        return sorted(slots)
+
+    def _path(self, id_, slot):
+        '''Return the path of a segment.'''
+        return os.path.join(self.root, urllib.quote(id_, safe=''),
+                            '%015d%s' % (int(round(slot*1000)),
+                                         SEGMENT_SUFFIX))
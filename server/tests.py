@@ -0,0 +1,1594 @@
+'''
+Unit tests for the StatsServer components.
+
+Run from this directory with:
+
+    $ python -m unittest tests
+'''
+
+import httplib
+import json
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import time
+import unittest
+import urllib2
+import xmlrpclib
+from array import array
+from itertools import izip
+from threading import Thread
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from FakeDas import FakeDas
+from StatsAlerts import (AlertEngine, FileNotifier, Rule, WebhookNotifier,
+                         load_rules, make_notifier)
+from StatsBinary import BINARY_PATH, Packed, pack, unpack
+from StatsHistory import Series, StatsHistory, downsample, downsample_columns
+from StatsMetrics import Metrics
+from StatsRestServer import StatsRestServer
+from StatsRollup import StatsRollups, parse_levels
+from StatsRates import RateEngine, numpy
+from StatsSchedule import MIN_INTERVAL, Schedule, monotonic, timestamp
+from StatsShared import HEADER_SIZE, MAGIC, SharedSnapshot
+from StatsStore import Segment, StatsStore
+from StatsServer import (GET_STATS_CMD, HISTORY_SAMPLES, InterfaceList,
+    InterfaceStats, Poller, StatsServer, StreamReader, Target,
+    ThreadedStatsServer, parse_stats)
+from StatsSimulation import PROFILES, FakeData
+
+
+def start_das(num_interfaces=4, **kwargs):
+    '''Start a local acquisition system serving FakeData.'''
+    das = FakeDas(fake=FakeData(num_interfaces=num_interfaces), **kwargs)
+    das.start()
+    return das
+
+
+def run_until(poller, condition, timeout=5.0):
+    '''Step a poller until condition() holds or the timeout expires.'''
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        poller.step(0.05)
+    return condition()
+
+
+class StreamReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reader_sock, self.writer_sock = socket.socketpair()
+
+    def tearDown(self):
+        self.reader_sock.close()
+        self.writer_sock.close()
+
+    def test_frame_spanning_reads(self):
+        response = str(FakeData(num_interfaces=64))
+        reader = StreamReader(self.reader_sock, buffer_size=128)
+
+        # Feed the response in pieces, checking no frame is produced early.
+        pieces = [response[i:i+100] for i in xrange(0, len(response), 100)]
+        for piece in pieces[:-1]:
+            self.writer_sock.sendall(piece)
+            reader.fill()
+            self.assertEqual(reader.next_frame(), None)
+
+        self.writer_sock.sendall(pieces[-1])
+        self.assertEqual(reader.read_frame(), response)
+
+    def test_frames_in_one_read(self):
+        first = str(FakeData(num_interfaces=2))
+        second = str(FakeData(num_interfaces=3))
+        self.writer_sock.sendall('junk' + first + '\n' + second)
+
+        reader = StreamReader(self.reader_sock)
+        self.assertEqual(reader.read_frame(), first)
+        self.assertEqual(reader.read_frame(), second)
+
+    def test_end_tag_split_across_reads(self):
+        response = str(FakeData(num_interfaces=1))
+        reader = StreamReader(self.reader_sock)
+
+        self.writer_sock.sendall(response[:-5])
+        reader.fill()
+        self.assertEqual(reader.next_frame(), None)
+
+        self.writer_sock.sendall(response[-5:])
+        self.assertEqual(reader.read_frame(), response)
+
+    def test_connection_closed(self):
+        self.writer_sock.sendall('<cmd_resp>partial')
+        self.writer_sock.close()
+
+        reader = StreamReader(self.reader_sock)
+        self.assertRaises(socket.error, reader.read_frame)
+
+
+class ParseStatsTest(unittest.TestCase):
+
+    def test_matches_fake_data(self):
+        fd = FakeData(num_interfaces=16)
+        interfaces = parse_stats(str(fd))
+
+        self.assertEqual(sorted(interfaces.keys()),
+                         sorted(str(i) for i in xrange(16)))
+        for i in xrange(16):
+            expected = fd.interfaces[i]
+            record = interfaces[str(i)]
+            self.assertEqual(record.interface, i)
+            self.assertEqual(record.byte_count, expected['byte_count'])
+            self.assertEqual(record.bytes_dropped, expected['bytes_dropped'])
+            self.assertEqual(record.packet_count, expected['packet_count'])
+            self.assertEqual(record.packets_dropped,
+                             expected['packets_dropped'])
+            self.assertEqual(record.error_count, expected['error_count'])
+
+    def test_ignores_unknown_params(self):
+        response = '''<cmd_resp><cmd_name>get stats</cmd_name>
+            <param><name>byteCount</name><value>7</value></param>
+            <param><name>interfaceNumber</name><value>3</value></param>
+            <param><name>interfaceType</name><value>Ethernet</value></param>
+            <param><name>errorCount</name><value>5</value></param>
+            </cmd_resp>'''
+        self.assertEqual(parse_stats(response),
+                         {'3': InterfaceStats(3, error_count=5)})
+
+    def test_record_vector_access(self):
+        record = InterfaceStats(1, 10, 20, 30, 40, 50)
+        self.assertEqual(list(record), [1, 10, 20, 30, 40, 50])
+        self.assertEqual(record[1], 10)
+
+        record[1] = 11
+        self.assertEqual(record.byte_count, 11)
+        self.assertRaises(AttributeError, setattr, record, 'other', 0)
+
+
+class FakeDataTest(unittest.TestCase):
+
+    def test_profiles_parse(self):
+        for name in PROFILES:
+            fd = FakeData(8, name, seed=1)
+            for i in xrange(3):
+                interfaces = parse_stats(str(fd))
+                self.assertEqual(len(interfaces), 8)
+                self.assertEqual(list(interfaces['7'])[1:],
+                                 [c[7] for c in fd.counters])
+
+    def test_seeded_traffic_repeats(self):
+        self.assertEqual(str(FakeData(4, 'bursty', seed=3)),
+                         str(FakeData(4, 'bursty', seed=3)))
+
+    def test_counters_wrap(self):
+        fd = FakeData(16, 'wrap', seed=5)
+        self.assertTrue(fd.counters[0][0] > 2**63)
+        for i in xrange(20):
+            fd.update()
+        self.assertTrue(all(c < 2**63 for c in fd.counters[0]))
+
+    def test_drop_storms(self):
+        fd = FakeData(64, 'drops', seed=2)
+        storms = 0
+        for i in xrange(20):
+            fd.update()
+            storms += sum(fd.profile.storming)
+        self.assertTrue(storms > 0)
+        for dropped, count in zip(fd.counters[1], fd.counters[0]):
+            self.assertTrue(dropped <= count)
+
+    def test_interval_scales_traffic(self):
+        fd = FakeData(64, 'bursty', interval=0.1, seed=4)
+        fd.update()
+        self.assertTrue(max(fd.counters[0]) <= FakeData.BYTE_INCREMENT*0.1)
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, FakeData, 4, 'unknown')
+        self.assertRaises(ValueError, FakeData(4).update_interface,
+                          4, 1, 1, 1, 1, 1)
+
+
+class SeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.series = Series(4, 2)
+
+    def test_ring_wraps(self):
+        for t in xrange(6):
+            self.series.append(t, [t, -t])
+
+        self.assertEqual(self.series.count, 4)
+        rows = self.series.query(0, 10)
+        self.assertEqual([r[0] for r in rows], [2, 3, 4, 5])
+        self.assertEqual(rows[0][4], [2, -2])
+
+    def test_grows_to_capacity(self):
+        self.assertEqual(len(self.series.times), 0)
+        for t in xrange(6):
+            self.series.append(t, [t, -t])
+            self.assertEqual(len(self.series.times), min(t + 1, 4))
+        self.assertEqual(len(self.series.values), 8)
+
+    def test_range_bounds_inclusive(self):
+        for t in xrange(4):
+            self.series.append(t, [t, t])
+
+        self.assertEqual([r[0] for r in self.series.query(1, 2)], [1, 2])
+        self.assertEqual(self.series.query(5, 9), [])
+
+    def test_downsampling(self):
+        series = Series(100, 1)
+        for t in xrange(100):
+            series.append(t, [t])
+
+        rows = series.query(0, 100, 4)
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0], [0, 25, [0], [24], [12], [24]])
+        self.assertEqual(rows[3], [75, 25, [75], [99], [87], [99]])
+
+    def test_ignores_out_of_order(self):
+        self.series.append(5, [1, 1])
+        self.series.append(4, [2, 2])
+        self.assertEqual(self.series.count, 1)
+
+
+class DownsampleColumnsTest(unittest.TestCase):
+
+    def test_matches_downsample(self):
+        times = array('d', [0.5*t for t in xrange(200)])
+        columns = [array('d', [(t*7919) % 101 for t in xrange(200)]),
+                   array('d', [-t for t in xrange(200)])]
+        samples = [(sample[0], sample[1:])
+                   for sample in izip(times, *columns)]
+
+        for buckets in (0, 1, 7, 64, 400):
+            self.assertEqual(downsample_columns(times, columns, 0, 100,
+                                                buckets),
+                             downsample(samples, 0, 100, buckets))
+
+
+class StatsHistoryTest(unittest.TestCase):
+
+    def test_records_per_interface(self):
+        history = StatsHistory(('a', 'b'), 10)
+        history.record('0', 1.0, [1, 2])
+        history.record('1', 1.0, [3, 4])
+
+        self.assertEqual(sorted(history.ids()), ['0', '1'])
+        self.assertEqual(history.query('1', 0, 2), [[1.0, 1, [3, 4], [3, 4],
+                                                     [3, 4], [3, 4]]])
+        self.assertEqual(history.query('2', 0, 2), [])
+
+
+class StatsRollupsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rollups = StatsRollups(('a',))
+        for t in xrange(7200):
+            self.rollups.record('0', t, (t,))
+
+    def test_aggregates(self):
+        rows = self.rollups.query('0', 0, 600, 60)
+        self.assertEqual(len(rows), 60)
+        self.assertEqual(rows[0], [0, 10, [0], [9], [4.5], [9]])
+        self.assertEqual(rows[-1], [590, 10, [590], [599], [594.5], [599]])
+
+    def test_cascades(self):
+        # Whole minutes and hours are merged from the finer buckets.
+        rows = self.rollups.query('0', 0, 3600, 60)
+        self.assertEqual(rows[1], [60, 60, [60], [119], [89.5], [119]])
+        rows = self.rollups.query('0', 0, 7200, 2)
+        self.assertEqual(rows[0], [0, 3600, [0], [3599], [1799.5], [3599]])
+
+        # The latest samples are answered at every level.
+        self.assertEqual(rows[1], [3600, 3600, [3600], [7199], [5399.5],
+                                   [7199]])
+
+    def test_latest_samples(self):
+        # The latest 10 s are answered before their bucket closes.
+        rows = self.rollups.query('0', 7180, 7200, 2)
+        self.assertEqual(rows[-1], [7190, 10, [7190], [7199], [7194.5],
+                                    [7199]])
+
+    def test_chooses_coarsest_level(self):
+        # Two hours in 30 points of 4 min are merged from 1 min buckets.
+        rows = self.rollups.query('0', 0, 7200, 30)
+        self.assertEqual(len(rows), 30)
+        self.assertEqual(rows[0], [0, 240, [0], [239], [119.5], [239]])
+
+        # Points narrower than the finest buckets are not answered.
+        self.assertEqual(self.rollups.query('0', 0, 600, 120), None)
+        self.assertEqual(self.rollups.query('1', 0, 600, 60), None)
+
+    def test_retention(self):
+        rollups = StatsRollups(('a',), ((10, 100), (60, 600)))
+        for t in xrange(1000):
+            rollups.record('0', t, (t,))
+
+        self.assertEqual(rollups.oldest('0'), 360)
+        self.assertEqual(rollups.query('0', 890, 1000, 11)[0][0], 890)
+        self.assertEqual(rollups.query('0', 800, 1000, 20), None)
+
+        # Before the finest level's buckets, the coarser ones answer.
+        rows = rollups.query('0', 600, 960, 6)
+        self.assertEqual(rows[0], [600, 60, [600], [659], [629.5], [659]])
+        self.assertEqual(rollups.query('0', 0, 1000, 10), None)
+        rows = rollups.query('0', 0, 1000, 10, cover=False)
+        self.assertEqual(rows[0][0], 300)
+
+    def test_ignores_out_of_order(self):
+        self.rollups.record('0', 100, (-1,))
+        rows = self.rollups.query('0', 100, 110, 1)
+        self.assertEqual(rows[0][2], [100])
+
+    def test_load(self):
+        levels = ((10, 100), (60, 600), (300, 3000))
+        recorded = StatsRollups(('a', 'b'), levels)
+        for t in xrange(5000):
+            recorded.record('0', t, (t, -t))
+        times = array('d', xrange(5000))
+        loaded = StatsRollups(('a', 'b'), levels)
+        loaded.load('0', times, [times, array('d', [-t for t in times])],
+                    5000)
+
+        # Within each level's retention, the rebuilt buckets are the
+        # recorded ones.
+        for start, end, points in ((4900, 5000, 10), (4500, 5000, 5),
+                                   (4420, 4960, 9), (2100, 5000, 29),
+                                   (4990, 5000, 1)):
+            self.assertEqual(loaded.query('0', start, end, points),
+                             recorded.query('0', start, end, points))
+        self.assertEqual(loaded.oldest('0'), recorded.oldest('0'))
+
+        # Recording continues from the rebuilt rollups.
+        for rollups in (recorded, loaded):
+            for t in xrange(5000, 5100):
+                rollups.record('0', t, (t, -t))
+        self.assertEqual(loaded.query('0', 4800, 5100, 5),
+                         recorded.query('0', 4800, 5100, 5))
+
+    def test_levels(self):
+        self.assertEqual(parse_levels('60:600,10:100'),
+                         ((10, 100), (60, 600)))
+        for spec in ('', '10', '10:100,15:600', '10:5', '0:100', '10:a'):
+            self.assertRaises(ValueError, parse_levels, spec)
+        self.assertRaises(ValueError, StatsRollups, ('a',), ())
+
+
+class RateEngineTest(unittest.TestCase):
+
+    vectorize = False
+
+    def engine(self, width, bits=64):
+        return RateEngine(width, bits, vectorize=self.vectorize)
+
+    def test_rates_for_all_counters(self):
+        engine = self.engine(3)
+        self.assertEqual(engine.update(['0', '1'], [[0, 0, 0], [5, 5, 5]], 1),
+                         [None, None])
+        self.assertEqual(engine.update(['0', '1'], [[10, 20, 30], [5, 7, 9]],
+                                       3),
+                         [[5.0, 10.0, 15.0], [0.0, 1.0, 2.0]])
+
+    def test_uses_each_interfaces_sample_time(self):
+        engine = self.engine(1)
+        engine.update(['0'], [[0]], 0)
+        engine.update(['1'], [[0]], 8)
+        self.assertEqual(engine.update(['0', '1'], [[10], [10]], 10),
+                         [[1.0], [5.0]])
+
+    def test_wraparound(self):
+        engine = self.engine(1)
+        engine.update(['0'], [[2**64 - 10]], 0)
+        self.assertEqual(engine.update(['0'], [[10]], 1), [[20.0]])
+
+        engine = self.engine(1, bits=32)
+        engine.update(['0'], [[2**32 - 10]], 0)
+        self.assertEqual(engine.update(['0'], [[10]], 1), [[20.0]])
+
+    def test_reset(self):
+        engine = self.engine(1, bits=32)
+        engine.update(['0'], [[1000000]], 0)
+        self.assertEqual(engine.update(['0'], [[50]], 2), [[25.0]])
+
+    def test_ignores_stale_samples(self):
+        engine = self.engine(1)
+        engine.update(['0'], [[100]], 5)
+        self.assertEqual(engine.update(['0'], [[200]], 5), [None])
+        self.assertEqual(engine.update(['0'], [[0]], 4), [None])
+        self.assertEqual(engine.update(['0'], [[110]], 6), [[10.0]])
+
+    def test_many_interfaces(self):
+        engine = self.engine(2)
+        ids = [str(i) for i in xrange(1000)]
+        engine.update(ids, [[i, 0] for i in xrange(1000)], 0)
+        rates = engine.update(ids, [[2*i, i] for i in xrange(1000)], 1)
+        self.assertEqual(rates[999], [999.0, 999.0])
+        self.assertEqual(len(engine.ids()), 1000)
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class VectorizedRateEngineTest(RateEngineTest):
+
+    vectorize = True
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def test_fixed_deadlines(self):
+        schedule = Schedule(1.0)
+        self.assertEqual(schedule.start(100.0), 100.0)
+
+        # The time taken to answer does not delay the next deadline.
+        for i in range(1, 6):
+            sent = schedule.due
+            self.assertEqual(schedule.completed(sent, sent + 0.3), 0)
+            self.assertEqual(schedule.due, 100.0 + i)
+        self.assertEqual(schedule.overruns, 0)
+
+    def test_overrun(self):
+        schedule = Schedule(1.0)
+        schedule.start(100.0)
+
+        # Deadlines passed while waiting are skipped.
+        self.assertEqual(schedule.completed(100.0, 102.5), 2)
+        self.assertEqual(schedule.due, 103.0)
+        self.assertEqual(schedule.completed(103.0, 104.0), 1)
+        self.assertEqual(schedule.due, 105.0)
+        self.assertEqual(schedule.overruns, 3)
+
+    def test_jitter(self):
+        schedule = Schedule(1.0, jitter=0.2, seed=1)
+        due = [schedule.start(100.0)]
+        for i in range(20):
+            schedule.completed(due[-1], due[-1] + 0.1)
+            due.append(schedule.due)
+
+        for i, t in enumerate(due):
+            self.assertTrue(100.0 + i <= t <= 100.2 + i)
+        self.assertNotEqual(len(set(t - int(t) for t in due)), 1)
+
+    def test_timestamp(self):
+        readings = [monotonic() for i in range(1000)]
+        self.assertEqual(readings, sorted(readings))
+        self.assertTrue(abs(timestamp() - time.time()) < 1)
+
+    def test_adaptive(self):
+        schedule = Schedule(1.0, adaptive=True, max_interval=4.0)
+        schedule.start(100.0)
+
+        # A slow target is polled less often, up to the limit.
+        now = 100.0
+        for i in range(20):
+            schedule.completed(now, now + 3.0)
+            now = schedule.due
+        self.assertEqual(schedule.current, 4.0)
+
+        # Then as often as configured once it is fast again.
+        for i in range(30):
+            schedule.completed(now, now + 0.1)
+            now = schedule.due
+        self.assertEqual(schedule.current, 1.0)
+
+
+class StatsBinaryTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        values = [None, True, False, 0, 1, 127, 128, -1, -32, -33, 2**63 - 1,
+                  2**64 - 1, -2**63, 0.5, '', 'x'*31, 'x'*32, 'x'*256,
+                  'x'*70000, [], range(16), range(70000), {},
+                  dict((str(i), i) for i in range(20)),
+                  {'a': [1, {'b': None}]}]
+        for value in values:
+            self.assertEqual(unpack(pack(value)), value)
+        self.assertEqual(unpack(pack((1, 2))), [1, 2])
+        self.assertEqual(unpack(pack(u'\xe9')), '\xc3\xa9')
+
+    def test_packed(self):
+        counters = [0, 1, 2**64 - 1] + range(100)
+        rates = [0.5, float('inf'), -1.25]
+        value = unpack(pack({'c': Packed('Q', counters),
+                             'r': Packed('d', rates)}))
+        self.assertEqual(value, {'c': tuple(counters), 'r': tuple(rates)})
+        self.assertEqual(len(pack(Packed('Q', range(1000)))), 8000 + 4)
+
+    def test_invalid(self):
+        data = pack({'a': range(10)})
+        self.assertRaises(ValueError, unpack, data[:-1])
+        self.assertRaises(ValueError, unpack, data + '\x00')
+        self.assertRaises(ValueError, unpack, '\xc1')
+        self.assertRaises(TypeError, pack, object())
+
+
+class SharedSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'shared')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def header(self):
+        '''Return the file's header fields, and the snapshot.'''
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        magic, layout, sequence, length, published, interval = \
+            struct.unpack_from('<4sIQQdd', data)
+        self.assertEqual((magic, layout), (MAGIC, 1))
+        return (sequence, published, interval,
+                data[HEADER_SIZE:HEADER_SIZE + length])
+
+    def test_publish(self):
+        shared = SharedSnapshot(self.path)
+        self.assertEqual(self.header(), (0, 0.0, 0.0, ''))
+
+        shared.publish(pack({'version': 1}), 1358000000.0, 5)
+        shared.publish(pack({'version': 2}), 1358000005.0, 5)
+        sequence, published, interval, data = self.header()
+        self.assertEqual(sequence, 4)
+        self.assertEqual((published, interval), (1358000005.0, 5))
+        self.assertEqual(unpack(data), {'version': 2})
+        shared.close()
+
+    def test_grows(self):
+        shared = SharedSnapshot(self.path, 1024)
+        value = {'interfaces': Packed('Q', range(1000))}
+        shared.publish(pack(value), 0, 1)
+        self.assertEqual(os.path.getsize(self.path), 8192)
+        self.assertEqual(unpack(self.header()[3])['interfaces'],
+                         tuple(range(1000)))
+
+        # The file is never shrunk, so readers' mappings stay valid.
+        shared.publish(pack({}), 0, 1)
+        self.assertEqual(os.path.getsize(self.path), 8192)
+        shared.close()
+
+    def test_sequence_carries_on(self):
+        shared = SharedSnapshot(self.path)
+        shared.publish(pack(1), 0, 1)
+        shared.close()
+
+        shared = SharedSnapshot(self.path)
+        self.assertEqual(shared.sequence(), 2)
+        shared.publish(pack(2), 0, 1)
+        self.assertEqual(self.header()[0], 4)
+        shared.close()
+
+    def test_private(self):
+        SharedSnapshot(self.path).close()
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+
+        # Files others may write to, and links, are refused and left alone.
+        os.chmod(self.path, 0666)
+        self.assertRaises(OSError, SharedSnapshot, self.path)
+        target = os.path.join(self.root, 'target')
+        with open(target, 'w') as f:
+            f.write('x')
+        os.unlink(self.path)
+        os.symlink(target, self.path)
+        self.assertRaises(OSError, SharedSnapshot, self.path)
+        self.assertEqual(os.path.getsize(target), 1)
+
+
+class RecordingNotifier(object):
+    '''Keeps the events it is notified of.'''
+
+    def __init__(self):
+        self.events = []
+
+    def notify(self, event):
+        self.events.append((event['state'], event['rule'], event['subject']))
+
+
+def rates(byte_rate=0.0, packet_rate=1000.0, packets_dropped_rate=0.0,
+    error_rate=0.0):
+    '''Return the rates of an interface's counters.'''
+    return [byte_rate, 0.0, packet_rate, packets_dropped_rate, error_rate]
+
+
+# Byte rate of 1 Gbps.
+GBPS = 1e9/8
+
+
+class AlertEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.notifier = RecordingNotifier()
+        self.engine = AlertEngine(notifiers=[self.notifier])
+
+    def update(self, rows, target='das', total=None, now=0):
+        ids = ['%s:%d' % (target, i) for i in range(len(rows))]
+        rate = sum(r[0] for r in rows if r is not None)
+        if total is None:
+            total = rate
+        return self.engine.update(target, ids, rows, rate, total, now)
+
+    def test_hysteresis(self):
+        for gbps in (8.0, 9.5, 9.9, 8.8, 9.2, 8.4, 8.8):
+            self.update([rates(gbps*GBPS), rates()])
+        self.assertEqual(self.notifier.events,
+                         [('raised', 'ethernet_high', 'das:0'),
+                          ('cleared', 'ethernet_high', 'das:0')])
+        self.assertEqual(self.engine.active(), [])
+
+    def test_deduplicated(self):
+        for t in range(5):
+            self.update([rates(9.5*GBPS + t)], now=t)
+        self.assertEqual(len(self.notifier.events), 1)
+
+        alert, = self.engine.active()
+        self.assertEqual((alert['rule'], alert['subject']),
+                         ('ethernet_high', 'das:0'))
+        self.assertEqual((alert['raised'], alert['updated']), (0, 4))
+        self.assertEqual(alert['samples'], 5)
+        self.assertAlmostEqual(alert['peak'], 9.5 + 4*8e-9)
+
+    def test_consecutive_samples(self):
+        # Errors are only alerted on once seen in two samples in a row.
+        for errors in (1.0, 0.0, 1.0, 0.0):
+            self.update([rates(error_rate=errors)])
+        self.assertEqual(self.notifier.events, [])
+
+        self.update([rates(error_rate=1.0)])
+        self.update([rates(error_rate=1.0)])
+        self.assertEqual(self.notifier.events,
+                         [('raised', 'errors', 'das:0')])
+
+    def test_drop_ratio(self):
+        self.update([rates(packets_dropped_rate=5.0),
+                     rates(packets_dropped_rate=50.0), rates(), None])
+        self.assertEqual(self.notifier.events,
+                         [('raised', 'drop_ratio_high', 'das:1')])
+        self.assertAlmostEqual(self.engine.active()[0]['value'], 50/1050.0)
+
+    def test_capture(self):
+        rows = [rates(9.0*GBPS), rates(8.0*GBPS), rates(3.0*GBPS)]
+        self.update(rows)
+        self.assertEqual(self.notifier.events,
+                         [('raised', 'capture_high', 'total')])
+
+        self.update(rows, total=17.0*GBPS)
+        self.assertEqual(self.notifier.events[-1],
+                         ('cleared', 'capture_high', 'total'))
+
+    def test_other_targets(self):
+        self.update([rates(9.5*GBPS)], target='a')
+        self.update([rates()], target='b')
+        self.assertEqual([a['subject'] for a in self.engine.active()],
+                         ['a:0'])
+
+        # An interface without new rates keeps its state.
+        self.update([None], target='a')
+        self.assertEqual(len(self.engine.active()), 1)
+
+    def test_changed(self):
+        rows = [rates(), rates(error_rate=1.0), rates()]
+        ids = ['das:0', 'das:1', 'das:2']
+        self.engine.update('das', ids, rows, 0, 0, 0, changed=[1])
+
+        # Unchanged interfaces are not evaluated, but those pending are
+        # sampled again.
+        rows[2] = rates(9.5*GBPS)
+        self.engine.update('das', ids, rows, 0, 0, 1, changed=[])
+        self.assertEqual(self.notifier.events,
+                         [('raised', 'errors', 'das:1')])
+
+        rows[1] = rates()
+        self.engine.update('das', ids, rows, 0, 0, 2, changed=[1, 2])
+        self.assertEqual(self.notifier.events[1:],
+                         [('raised', 'ethernet_high', 'das:2'),
+                          ('cleared', 'errors', 'das:1')])
+
+    def test_forget(self):
+        self.update([rates(9.5*GBPS)])
+        events = self.engine.forget(['das:0'], 1)
+        self.assertEqual([e['state'] for e in events], ['cleared'])
+        self.assertEqual(self.engine.active(), [])
+
+    def test_rules(self):
+        engine = AlertEngine([Rule('slow', 'target_capture', 1.0,
+                                   severity='critical')])
+        engine.update('das', [], [], 2*GBPS, 2*GBPS, 0)
+        alert, = engine.active()
+        self.assertEqual((alert['subject'], alert['severity']),
+                         ('das', 'critical'))
+
+        struct = engine.as_struct()
+        self.assertEqual(struct['rules'][0]['clear'], 1.0)
+        self.assertEqual(struct['recent'][0]['state'], 'raised')
+        xmlrpclib.dumps((struct,), methodresponse=True)
+
+        self.assertRaises(ValueError, Rule, 'x', 'unknown', 1)
+        self.assertRaises(ValueError, Rule, 'x', 'ethernet', 1, 2)
+        self.assertRaises(ValueError, Rule.from_struct, {'name': 'x'})
+        self.assertRaises(ValueError, AlertEngine,
+                          [Rule('x', 'ethernet', 1)]*2)
+
+    def test_load_rules(self):
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, 'rules.json')
+            with open(path, 'w') as f:
+                json.dump([{'name': 'busy', 'signal': 'ethernet',
+                            'above': 5, 'samples': 3}], f)
+            rule, = load_rules(path)
+            with open(path, 'w') as f:
+                json.dump({'name': 'busy'}, f)
+            self.assertRaises(ValueError, load_rules, path)
+        finally:
+            shutil.rmtree(root)
+
+        self.assertEqual((rule.name, rule.above, rule.samples),
+                         ('busy', 5.0, 3))
+
+    def test_failing_notifier(self):
+        class Failing(object):
+            def notify(self, event):
+                raise IOError('unavailable')
+
+        engine = AlertEngine(notifiers=[Failing(), self.notifier])
+        engine.update('das', ['das:0'], [rates(9.5*GBPS)], 0, 0, 0)
+        self.assertEqual(len(self.notifier.events), 1)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        self.server.events.append(json.loads(body))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+class NotifierTest(unittest.TestCase):
+
+    def test_file(self):
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, 'alerts.log')
+            engine = AlertEngine(notifiers=[FileNotifier(path)])
+            engine.update('das', ['das:0'], [rates(9.5*GBPS)], 0, 0, 0)
+            engine.update('das', ['das:0'], [rates()], 0, 0, 1)
+            with open(path) as f:
+                events = [json.loads(line) for line in f]
+        finally:
+            shutil.rmtree(root)
+
+        self.assertEqual([(e['state'], e['time']) for e in events],
+                         [('raised', 0), ('cleared', 1)])
+
+    def test_webhook(self):
+        server = HTTPServer(('localhost', 0), WebhookHandler)
+        server.events = []
+        thread = Thread(target=server.serve_forever, args=(0.05,))
+        thread.start()
+        try:
+            notifier = WebhookNotifier('http://%s:%d/alerts' %
+                                       server.server_address)
+            engine = AlertEngine(notifiers=[notifier])
+            engine.update('das', ['das:0'], [rates(9.5*GBPS)], 0, 0, 0)
+            notifier.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.assertEqual(notifier.sent, 1)
+        self.assertEqual(server.events[0]['rule'], 'ethernet_high')
+
+    def test_make_notifier(self):
+        self.assertEqual(make_notifier('file:/tmp/x').path, '/tmp/x')
+        self.assertRaises(ValueError, make_notifier, 'file')
+        self.assertRaises(ValueError, make_notifier, 'mail:x')
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_counter(self):
+        metrics = Metrics('test_')
+        metrics.counter('polls_total', 'Polls.', target='a').inc()
+        metrics.counter('polls_total', 'Polls.', target='a').inc(2)
+        metrics.counter('polls_total', 'Polls.', target='b').inc()
+
+        self.assertEqual(metrics.prometheus(),
+                         '# HELP test_polls_total Polls.\n'
+                         '# TYPE test_polls_total counter\n'
+                         'test_polls_total{target="a"} 3\n'
+                         'test_polls_total{target="b"} 1\n')
+
+    def test_histogram(self):
+        metrics = Metrics()
+        h = metrics.histogram('latency_seconds', 'Latency.', (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            h.observe(value)
+
+        lines = metrics.prometheus().splitlines()
+        self.assertEqual(lines[2:], [
+            'latency_seconds_bucket{le="0.1"} 2',
+            'latency_seconds_bucket{le="1"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            'latency_seconds_sum 2.65',
+            'latency_seconds_count 4',
+            ])
+
+        struct, = metrics.as_struct()
+        self.assertEqual(struct['count'], 4)
+        self.assertEqual(struct['buckets'], [[0.1, 2], [1.0, 3],
+                                             ['+Inf', 4]])
+
+    def test_escapes_labels(self):
+        metrics = Metrics()
+        metrics.counter('errors_total', 'Errors.', target='a"b\\').inc()
+        self.assertTrue('errors_total{target="a\\"b\\\\"} 1' in
+                        metrics.prometheus())
+
+
+class StatsStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = StatsStore(self.root, ('a', 'b'), duration=10,
+                                retention=30)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.root)
+
+    def segments(self, id_):
+        return sorted(os.listdir(os.path.join(self.root, id_)))
+
+    def test_rolls_over_segments(self):
+        for t in xrange(25):
+            self.store.record('0', float(t), [t, -t])
+
+        self.assertEqual(len(self.segments('0')), 3)
+        times, values = self.store.query('0', 8, 11)
+        self.assertEqual(list(times), [8.0, 9.0, 10.0, 11.0])
+        self.assertEqual([list(v) for v in values],
+                         [[8.0, 9.0, 10.0, 11.0], [-8.0, -9.0, -10.0, -11.0]])
+        self.assertEqual(len(self.store.query('0', 5, 24)[0]), 20)
+        self.assertEqual(self.store.oldest('0'), 0.0)
+
+    def test_ignores_out_of_order(self):
+        self.store.record('0', 5.0, [1, 1])
+        self.store.record('0', 4.0, [2, 2])
+        self.store.record('0', 15.0, [3, 3])
+        self.store.record('0', 6.0, [4, 4])
+        self.assertEqual(list(self.store.query('0', 0, 20)[0]), [5.0, 15.0])
+
+    def test_survives_reopen(self):
+        self.store.record('a:1', 1.0, [1, 2])
+        self.store.close()
+
+        store = StatsStore(self.root, ('a', 'b'), duration=10)
+        store.record('a:1', 2.0, [3, 4])
+        self.assertEqual(store.ids(), ['a:1'])
+        times, values = store.query('a:1', 0, 10)
+        self.assertEqual(list(times), [1.0, 2.0])
+        self.assertEqual([list(v) for v in values], [[1.0, 3.0], [2.0, 4.0]])
+        store.close()
+
+    def test_truncates_torn_record(self):
+        for t in xrange(3):
+            self.store.record('0', float(t), [t, t])
+        self.store.close()
+
+        path = os.path.join(self.root, '0', self.segments('0')[0])
+        size = os.path.getsize(path)
+        with open(path, 'ab') as f:
+            f.write('\1'*10)
+        segment = Segment(path, 2)
+        self.assertEqual((segment.count, segment.last), (3, 2.0))
+        segment.close()
+        self.assertEqual(os.path.getsize(path), size)
+
+        # A full-length record with a bad checksum is also discarded.
+        with open(path, 'ab') as f:
+            f.write('\1'*segment.record_size)
+        segment = Segment(path, 2)
+        self.assertEqual(segment.count, 3)
+        segment.close()
+
+    def test_queries_leave_torn_record(self):
+        for t in xrange(15):
+            self.store.record('0', float(t), [t, t])
+
+        # A torn record in a segment no longer written is skipped by
+        # queries, but only the writer truncates it.
+        path = os.path.join(self.root, '0', self.segments('0')[0])
+        with open(path, 'ab') as f:
+            f.write('\1'*10)
+        size = os.path.getsize(path)
+        self.assertEqual(len(self.store.query('0', 0, 9)[0]), 10)
+        self.assertEqual(os.path.getsize(path), size)
+
+    def test_expires_old_segments(self):
+        for t in xrange(0, 100, 5):
+            self.store.record('0', float(t), [t, t])
+
+        # Segments ending before 90 - 30 are deleted as new ones start.
+        self.assertEqual(self.store.oldest('0'), 50.0)
+        self.store.expire(1000)
+        self.assertEqual(self.store.ids(), [])
+
+
+class FakeDasTest(unittest.TestCase):
+
+    def setUp(self):
+        self.das = None
+        self.sock = None
+
+    def tearDown(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.das.close()
+
+    def connect(self, **kwargs):
+        self.das = start_das(2, **kwargs)
+        self.sock = socket.create_connection(self.das.address, 5)
+        return StreamReader(self.sock)
+
+    def test_answers_get_stats(self):
+        reader = self.connect()
+        self.sock.sendall(GET_STATS_CMD*2)
+        for i in xrange(2):
+            self.assertEqual(len(parse_stats(reader.read_frame())), 2)
+
+        self.sock.sendall('<x3c_cmd><cmdName>reboot</cmdName></x3c_cmd>')
+        self.assertTrue('<retVal>1</retVal>' in reader.read_frame())
+
+        # A response is counted once it has been written.
+        deadline = time.time() + 1
+        while self.das.responses < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual((self.das.commands, self.das.responses), (3, 3))
+
+    def test_fragmented_slow_response(self):
+        reader = self.connect(fragment=100, rate=200000, latency=0.05)
+        start = time.time()
+        self.sock.sendall(GET_STATS_CMD)
+        response = reader.read_frame()
+        elapsed = time.time() - start
+
+        self.assertEqual(len(parse_stats(response)), 2)
+        self.assertTrue(elapsed >= 0.05 + float(len(response))/200000*0.8)
+
+    def test_disconnect(self):
+        reader = self.connect(disconnect=1.0)
+        self.sock.sendall(GET_STATS_CMD)
+        self.assertRaises(socket.error, reader.read_frame)
+        self.assertEqual(self.das.disconnects, 1)
+
+
+class PollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.das = []
+        self.responses = []
+        self.errors = []
+
+    def tearDown(self):
+        for d in self.das:
+            d.close()
+
+    def make_das(self, *args, **kwargs):
+        d = start_das(*args, **kwargs)
+        self.das.append(d)
+        return d
+
+    def on_response(self, target, response, now):
+        self.responses.append((target.name, parse_stats(response)))
+
+    def on_error(self, target, reason):
+        self.errors.append((target.name, reason))
+
+    def test_polls_several_targets(self):
+        targets = [Target('das%d' % i, self.make_das(i + 1).address, 0.01)
+                   for i in xrange(3)]
+        poller = Poller(targets, self.on_response, self.on_error)
+
+        self.assertTrue(run_until(poller,
+            lambda: all(t.polls >= 3 for t in targets)))
+        self.assertEqual(self.errors, [])
+        for name, interfaces in self.responses:
+            self.assertEqual(len(interfaces), int(name[-1]) + 1)
+
+    def test_reconnects_after_disconnect(self):
+        das = self.make_das(close_after=1)
+        target = Target('das', das.address, 0.01, min_backoff=0.01)
+        poller = Poller([target], self.on_response, self.on_error)
+
+        self.assertTrue(run_until(poller, lambda: target.polls >= 3))
+        self.assertTrue(das.connections >= 3)
+        self.assertTrue(len(self.errors) >= 2)
+
+    def test_timeout_backs_off(self):
+        das = self.make_das(respond=False)
+        target = Target('das', das.address, 0.01, timeout=0.05,
+                        min_backoff=0.01, max_backoff=0.04)
+        poller = Poller([target], self.on_response, self.on_error)
+
+        self.assertTrue(run_until(poller, lambda: target.failures >= 3))
+        self.assertEqual(self.responses, [])
+        self.assertEqual(self.errors[0], ('das', 'timed out'))
+        self.assertEqual(target.backoff, 0.04)
+
+    def test_faulty_target(self):
+        das = self.make_das(latency=0.01, jitter=0.01, fragment=50,
+                            disconnect=0.3, seed=1)
+        target = Target('das', das.address, 0.01, min_backoff=0.01)
+        poller = Poller([target], self.on_response, self.on_error)
+
+        self.assertTrue(run_until(poller, lambda: target.polls >= 10, 10))
+        self.assertTrue(das.disconnects > 0)
+        self.assertEqual(len(self.errors), das.disconnects)
+        for name, interfaces in self.responses:
+            self.assertEqual(len(interfaces), 4)
+
+    def test_records_metrics(self):
+        das = self.make_das(4)
+        target = Target('das', das.address, 0.01)
+        metrics = Metrics()
+        poller = Poller([target], self.on_response, self.on_error, metrics)
+
+        self.assertTrue(run_until(poller, lambda: target.polls >= 3))
+        self.assertEqual(metrics.counter('polls_total', '',
+                                         target='das').value, target.polls)
+        self.assertEqual(metrics.histogram('das_round_trip_seconds', '',
+                                           target='das').count, target.polls)
+        self.assertTrue(metrics.counter('das_bytes_read_total', '',
+            target='das').value >= target.polls*len(str(FakeData(4))))
+
+    def test_counts_overruns(self):
+        das = self.make_das(latency=0.05)
+        target = Target('das', das.address, 0.02)
+        metrics = Metrics()
+        poller = Poller([target], self.on_response, self.on_error, metrics)
+
+        self.assertTrue(run_until(poller, lambda: target.polls >= 3))
+        self.assertTrue(target.schedule.overruns >= 3)
+        self.assertEqual(metrics.counter('poll_overruns_total', '',
+            target='das').value, target.schedule.overruns)
+        self.assertEqual(metrics.histogram('poll_lag_seconds', '',
+                                           target='das').count, target.polls)
+
+    def test_connection_refused(self):
+        # Find a port with nothing listening on it.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('localhost', 0))
+        address = sock.getsockname()
+        sock.close()
+
+        target = Target('das', address, 0.01, min_backoff=0.01)
+        poller = Poller([target], self.on_response, self.on_error)
+        self.assertTrue(run_until(poller, lambda: target.failures >= 2))
+        self.assertEqual(target.polls, 0)
+
+
+class InterfaceListTest(unittest.TestCase):
+
+    def test_update(self):
+        interfaces = InterfaceList(['b'])
+        self.assertEqual(interfaces.ids, ())
+
+        interfaces = interfaces.update('a', [10, 2]).update('b', [0])
+        self.assertEqual(interfaces.ids, ('b:0', 'a:2', 'a:10'))
+        self.assertEqual(interfaces.index['a:10'], 2)
+        self.assertEqual(interfaces.version, 2)
+
+        # Reporting the same interfaces keeps the list.
+        self.assertTrue(interfaces.update('a', [2, 10]) is interfaces)
+
+        changed = interfaces.update('a', [2])
+        self.assertEqual(changed.ids, ('b:0', 'a:2'))
+        self.assertEqual(changed.version, 3)
+        self.assertEqual(interfaces.ids, ('b:0', 'a:2', 'a:10'))
+        self.assertEqual(changed.as_struct(),
+                         {'version': 3, 'interfaces': ['b:0', 'a:2'],
+                          'targets': {'a': ['a:2'], 'b': ['b:0']}})
+
+
+class StatsServerTest(unittest.TestCase):
+
+    def test_merges_targets(self):
+        das = [start_das(2), start_das(3)]
+        targets = [Target('a', das[0].address, 0.01),
+                   Target('b', das[1].address, 0.01)]
+        server = StatsServer(1, ('localhost', 0), targets, retention=10)
+        server.start()
+        try:
+            deadline = time.time() + 5
+            while time.time() < deadline and \
+                  not all(t.polls >= 3 for t in targets):
+                time.sleep(0.01)
+        finally:
+            server.quit()
+            server.join()
+            server.server_close()
+            for d in das:
+                d.close()
+
+        self.assertEqual(sorted(server._cstatistics.keys()),
+                         ['a:0', 'a:1', 'b:0', 'b:1', 'b:2'])
+        self.assertEqual(len(server.interface('b:2')), 6)
+        self.assertTrue(server.capture('a') > 0)
+        self.assertTrue(server.capture('b') > 0)
+        self.assertAlmostEqual(server.capture(),
+                               server.capture('a') + server.capture('b'), 0)
+        self.assertEqual(server.capture('missing'), 0)
+
+        snapshot = server.snapshot()
+        self.assertEqual(sorted(snapshot['interfaces'].keys()),
+                         sorted(server._cstatistics.keys()))
+        self.assertEqual(snapshot['interfaces']['b:2'],
+                         server.interface('b:2'))
+        self.assertEqual(snapshot['ethernet']['a:1'], server.ethernet('a:1'))
+        self.assertEqual(len(snapshot['rates']['a:1']), 5)
+        self.assertEqual(snapshot['rates']['a:1'][0], server._rates['a:1'])
+        self.assertEqual(snapshot['targets'],
+                         {'a': server.capture('a'), 'b': server.capture('b')})
+        self.assertEqual(snapshot['capture'], server.capture())
+        self.assertTrue(snapshot['version'] >= 6)
+        self.assertEqual(sorted(snapshot['sampled'].keys()), ['a', 'b'])
+        self.assertEqual(max(snapshot['sampled'].values()),
+                         snapshot['timestamp'])
+        xmlrpclib.dumps((snapshot,), methodresponse=True)
+
+        history = server.history(['a:0', 'missing'], -60)
+        self.assertEqual(history['fields'][-1], 'byte_rate')
+        self.assertEqual(history['interfaces']['missing'], [])
+        rows = history['interfaces']['a:0']
+        self.assertTrue(len(rows) >= 2)
+        self.assertEqual(rows[-1][4][-1], server._snapshot.rates['a:0'])
+        self.assertEqual(len(server.history(['a:0'], -60, 0, 1)
+                             ['interfaces']['a:0']), 1)
+        xmlrpclib.dumps((history,), methodresponse=True)
+
+    def test_restores_history_from_store(self):
+        root = tempfile.mkdtemp()
+        try:
+            server = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                                 retention=10, store=root)
+            now = time.time()
+            for t in xrange(4):
+                interfaces = {'0': InterfaceStats(0, byte_count=t*1000)}
+                server._update_statistics('', interfaces, now - 100 + t)
+            server.quit()
+            server.server_close()
+
+            server = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                                 retention=200, store=root)
+            rows = server.history(['0'], -200)['interfaces']['0']
+            server.quit()
+            server.server_close()
+
+            # History beyond what is kept in memory comes from the store.
+            server = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                                 retention=10, store=root)
+            old = server.history(['0'], now - 200, now, 1)['interfaces']['0']
+            server.quit()
+            server.server_close()
+        finally:
+            shutil.rmtree(root)
+
+        self.assertEqual([r[0] for r in rows],
+                         [now - 99, now - 98, now - 97])
+        self.assertEqual(rows[0][4][0], 1000)
+        self.assertEqual(len(old), 1)
+        self.assertEqual(old[0][1], 3)
+
+    def test_history_samples_capped(self):
+        server = StatsServer(0.1, ('localhost', 0), ('localhost', 0),
+                             retention=3600)
+        try:
+            self.assertEqual(server._history.capacity, HISTORY_SAMPLES)
+        finally:
+            server.quit()
+            server.server_close()
+
+    def test_long_history_from_rollups(self):
+        server = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                             retention=60)
+        try:
+            now = time.time()
+            for t in xrange(0, 7200, 10):
+                interfaces = {'0': InterfaceStats(0, byte_count=t*1000)}
+                server._update_statistics('', interfaces, now - 7200 + t)
+            rows = server.history(['0'], now - 7200, now, 120)
+            rows = rows['interfaces']['0']
+        finally:
+            server.quit()
+            server.server_close()
+
+        # Far more samples than the history keeps, in 1 min buckets.
+        self.assertTrue(100 <= len(rows) <= 120)
+        # Every sample but the first, which has no rate.
+        self.assertEqual(sum(r[1] for r in rows), 719)
+        self.assertTrue(all(r[2][0] <= r[4][0] <= r[3][0] == r[5][0]
+                            for r in rows))
+        self.assertEqual(rows[-1][5][0], 7190*1000)
+
+    def test_restores_rollups_from_store(self):
+        root = tempfile.mkdtemp()
+        try:
+            server = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                                 retention=60, store=root)
+            now = time.time()
+            for t in xrange(0, 7200, 10):
+                interfaces = {'0': InterfaceStats(0, byte_count=t*1000)}
+                server._update_statistics('', interfaces, now - 7200 + t)
+            before = server.history(['0'], now - 7200, now, 120)
+            server.quit()
+            server.server_close()
+
+            server = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                                 retention=60, store=root)
+            after = server.history(['0'], now - 7200, now, 120)
+            server.quit()
+            server.server_close()
+        finally:
+            shutil.rmtree(root)
+
+        # The day's rollups are rebuilt, not only the retained samples.
+        self.assertEqual(after['interfaces']['0'], before['interfaces']['0'])
+
+    def test_alerts(self):
+        server = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                             retention=10)
+        try:
+            for t in range(3):
+                server._update_statistics('', {'0': InterfaceStats(0,
+                    byte_count=t*10*1000000000/8)}, 1358000000.0 + t)
+            alerts = server.alerts()
+
+            # A removed interface's alerts are cleared.
+            server._update_statistics('', {}, 1358000003.0)
+            cleared = server.alerts()
+        finally:
+            server.quit()
+            server.server_close()
+
+        self.assertEqual([(a['rule'], a['subject'])
+                          for a in alerts['active']],
+                         [('ethernet_high', '0')])
+        self.assertEqual(cleared['active'], [])
+        self.assertEqual(cleared['recent'][-1]['state'], 'cleared')
+
+        metrics = dict(((m['name'], tuple(sorted(m['labels'].items()))), m)
+                       for m in server.metrics_struct())
+        raised = metrics[('statsserver_alerts_raised_total',
+                          (('rule', 'ethernet_high'),))]
+        self.assertEqual(raised['value'], 1)
+
+    def test_publishes_to_shared_memory(self):
+        root = tempfile.mkdtemp()
+        path = os.path.join(root, 'shared')
+        try:
+            server = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                                 retention=10, shared=path)
+            interfaces = {'0': InterfaceStats(0, byte_count=1000)}
+            server._update_statistics('', interfaces, 1358000000.0)
+            with open(path, 'rb') as f:
+                data = f.read()
+            server.quit()
+            server.server_close()
+        finally:
+            shutil.rmtree(root)
+
+        sequence, length, published = struct.unpack_from('<QQd', data, 8)
+        self.assertEqual(sequence, 2)
+        self.assertEqual(published, 1358000000.0)
+        value = unpack(data[HEADER_SIZE:HEADER_SIZE + length])
+        self.assertEqual(value['ids'], ['0'])
+        self.assertEqual(value['interfaces'], (0, 1000, 0, 0, 0, 0))
+
+    def test_wait_for_new_snapshot(self):
+        server = ThreadedStatsServer(1, ('localhost', 0), ('localhost', 0),
+                                     retention=10)
+        server._running = True
+        publisher = Thread(target=lambda: (time.sleep(0.1),
+                                           server._publish(time.time())))
+        try:
+            start = time.time()
+            publisher.start()
+            snapshot = server.wait(0, 5)
+            self.assertEqual(snapshot['version'], 1)
+            self.assertTrue(time.time() - start < 2)
+
+            # A version other than the current one is answered at once.
+            self.assertEqual(server.wait(0, 5)['version'], 1)
+
+            start = time.time()
+            self.assertEqual(server.wait(1, 0.1)['version'], 1)
+            self.assertTrue(time.time() - start >= 0.1)
+        finally:
+            publisher.join()
+            server.quit()
+            server.server_close()
+
+        # A single-threaded server never blocks.
+        server = StatsServer(1, ('localhost', 0), ('localhost', 0))
+        server._running = True
+        start = time.time()
+        self.assertEqual(server.wait(0, 5)['version'], 0)
+        self.assertTrue(time.time() - start < 1)
+        server.quit()
+        server.server_close()
+
+    def test_threaded_server_serves_snapshot(self):
+        das = start_das(4)
+        server = ThreadedStatsServer(1, ('localhost', 0),
+                                     [Target('', das.address, 0.01)],
+                                     retention=10)
+        server.logRequests = False
+        server.start()
+        serve_thread = Thread(target=server.serve_forever)
+        serve_thread.start()
+
+        results = []
+        def client():
+            proxy = xmlrpclib.ServerProxy('http://%s:%d/' %
+                                          server.server_address)
+            for i in xrange(20):
+                results.append((proxy.interface('3'), proxy.capture()))
+
+        try:
+            while not server._snapshot.counters.has_key('3'):
+                time.sleep(0.01)
+
+            clients = [Thread(target=client) for i in xrange(8)]
+            for t in clients:
+                t.start()
+            for t in clients:
+                t.join()
+        finally:
+            server.quit()
+            server.shutdown()
+            serve_thread.join()
+            server.join()
+            server.server_close()
+            das.close()
+
+        self.assertEqual(len(results), 160)
+        for counters, capture in results:
+            self.assertEqual(counters[0], '3')
+        self.assertTrue(isinstance(server._snapshot.counters['3'], tuple))
+
+    def test_sub_second_interval(self):
+        for interval, expected in [(0.25, 0.25), (0.01, MIN_INTERVAL)]:
+            server = StatsServer(interval, ('localhost', 0), ('localhost', 0),
+                                 retention=10)
+            server.server_close()
+            self.assertEqual(server.snapshot()['interval'], 0)
+            self.assertEqual(server._update_interval(), expected)
+            self.assertEqual(server._history.capacity, int(10/expected))
+
+    def test_list_interfaces(self):
+        server = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                             retention=10)
+        try:
+            now = time.time()
+            server._update_statistics('', dict((str(i), InterfaceStats(i))
+                                               for i in range(12)), now)
+            listed = server.list_interfaces()
+            self.assertEqual(listed['interfaces'],
+                             [str(i) for i in range(12)])
+            snapshot = server.snapshot()
+            self.assertEqual(snapshot['ids'], listed['interfaces'])
+            self.assertEqual(snapshot['ids_version'], listed['version'])
+
+            # Interfaces no longer reported are dropped.
+            server._update_statistics('', {'3': InterfaceStats(3)}, now + 1)
+            listed = server.list_interfaces()
+            self.assertEqual(listed['interfaces'], ['3'])
+            self.assertEqual(listed['version'], snapshot['ids_version'] + 1)
+            self.assertEqual(server.snapshot()['interfaces'].keys(), ['3'])
+            xmlrpclib.dumps((listed,), methodresponse=True)
+        finally:
+            server.quit()
+            server.server_close()
+
+    def test_binary_transport(self):
+        das = start_das(4)
+        server = ThreadedStatsServer(1, ('localhost', 0),
+                                     [Target('das', das.address, 0.01)],
+                                     retention=10)
+        server.logRequests = False
+        server.start()
+        serve_thread = Thread(target=server.serve_forever, args=(0.05,))
+        serve_thread.start()
+        url = 'http://%s:%d/' % server.server_address
+
+        def call(method, *params):
+            conn.request('POST', BINARY_PATH, pack([method, list(params)]))
+            return unpack(conn.getresponse().read())
+
+        conn = httplib.HTTPConnection(*server.server_address)
+        try:
+            while not server._snapshot.counter_rates.has_key('das:3'):
+                time.sleep(0.01)
+
+            transports = xmlrpclib.ServerProxy(url).transports()
+            self.assertEqual(transports, {'binary': BINARY_PATH})
+
+            snapshot = server._snapshot
+            struct = snapshot.as_struct()
+            binary = call('wait', snapshot.version - 1, 1)['result']
+            self.assertEqual(binary['version'], snapshot.version)
+            self.assertEqual(binary['ids'], ['das:0', 'das:1', 'das:2',
+                                             'das:3'])
+            self.assertEqual(binary['width'], 6)
+            counters = binary['interfaces']
+            self.assertEqual([str(x) for x in counters[18:24]],
+                             struct['interfaces']['das:3'])
+            self.assertEqual(list(binary['ethernet']),
+                             [struct['ethernet'].get(id_, 0)
+                              for id_ in binary['ids']])
+            self.assertEqual(list(binary['rates'][15:20]),
+                             struct['rates']['das:3'])
+            self.assertEqual(binary['sampled'], struct['sampled'])
+
+            self.assertEqual(call('interface', 'das:1')['result'],
+                             snapshot.counters['das:1'])
+            self.assertTrue(call('capture')['result'] >= 0)
+            fault = call('interface', 'missing')['fault']
+            self.assertEqual(fault[0], 1)
+            self.assertTrue('missing' in fault[1])
+            self.assertTrue('fault' in call('missing'))
+        finally:
+            conn.close()
+            server.quit()
+            server.shutdown()
+            server.server_close()
+            serve_thread.join()
+            das.close()
+
+    def test_metrics(self):
+        das = start_das(4)
+        server = StatsServer(1, ('localhost', 0),
+                             [Target('das', das.address, 0.01)],
+                             retention=10)
+        server.logRequests = False
+        server.start()
+        serve_thread = Thread(target=server.serve_forever)
+        serve_thread.start()
+        url = 'http://%s:%d/' % server.server_address
+
+        try:
+            while not server._snapshot.counters.has_key('das:3'):
+                time.sleep(0.01)
+
+            proxy = xmlrpclib.ServerProxy(url)
+            proxy.interface('das:3')
+            self.assertRaises(xmlrpclib.Fault, proxy.interface, 'missing')
+            metrics = dict(((m['name'], tuple(m['labels'].items())), m)
+                           for m in proxy.metrics())
+            text = urllib2.urlopen(url + 'metrics').read()
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                              url + 'other')
+        finally:
+            server.quit()
+            server.shutdown()
+            serve_thread.join()
+            server.join()
+            server.server_close()
+            das.close()
+
+        rpc = metrics[('statsserver_rpc_seconds',
+                       (('method', 'interface'),))]
+        self.assertEqual(rpc['count'], 2)
+        self.assertEqual(metrics[('statsserver_rpc_errors_total',
+                                  (('method', 'interface'),))]['value'], 1)
+        self.assertTrue(metrics[('statsserver_polls_total',
+                                 (('target', 'das'),))]['value'] >= 1)
+        self.assertTrue(metrics[('statsserver_parse_seconds', ())]['count']
+                        >= 1)
+
+        self.assertTrue('# TYPE statsserver_rpc_seconds histogram' in text)
+        self.assertTrue('statsserver_rpc_seconds_count{method="metrics"} 1'
+                        in text)
+        self.assertTrue('statsserver_das_round_trip_seconds_bucket'
+                        '{target="das",le="+Inf"}' in text)
+
+
+class StatsRestServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeData(num_interfaces=4)
+        self.stats = StatsServer(1, ('localhost', 0), ('localhost', 0),
+                                 retention=10)
+        self.update(100)
+        self.update(101)
+
+        self.server = StatsRestServer(('localhost', 0), self.stats)
+        self.server.logRequests = False
+        self.thread = Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.conn = httplib.HTTPConnection(*self.server.server_address)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.stats.server_close()
+
+    def update(self, now):
+        self.stats._update_statistics('', parse_stats(str(self.fake)), now)
+
+    def get(self, path, etag=None):
+        headers = dict()
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        self.conn.request('GET', path, headers=headers)
+        response = self.conn.getresponse()
+        return response, response.read()
+
+    def test_resources(self):
+        response, body = self.get('/interface/3')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Type'),
+                         'application/json')
+        self.assertEqual(json.loads(body), self.stats.interface('3'))
+
+        response, body = self.get('/ethernet/3')
+        self.assertEqual(json.loads(body), self.stats.ethernet('3'))
+
+        response, body = self.get('/capture')
+        self.assertEqual(json.loads(body), self.stats.capture())
+        response, body = self.get('/capture?target=')
+        self.assertEqual(json.loads(body), self.stats.capture(''))
+
+        response, body = self.get('/snapshot')
+        self.assertEqual(json.loads(body)['interfaces'],
+                         self.stats.snapshot()['interfaces'])
+
+    def test_not_found(self):
+        for path in ('/interface/9', '/ethernet/9', '/capture?target=x',
+                     '/other'):
+            for etag in (None, '*'):
+                response, body = self.get(path, etag)
+                self.assertEqual(response.status, 404)
+                self.assertTrue(json.loads(body).has_key('error'))
+
+    def test_not_modified_until_next_update(self):
+        response, body = self.get('/snapshot')
+        etag = response.getheader('ETag')
+
+        response, body = self.get('/snapshot', etag)
+        self.assertEqual(response.status, 304)
+        self.assertEqual(body, '')
+        self.assertEqual(response.getheader('ETag'), etag)
+
+        self.update(102)
+        response, body = self.get('/snapshot', etag)
+        self.assertEqual(response.status, 200)
+        self.assertNotEqual(response.getheader('ETag'), etag)
+        self.assertEqual(json.loads(body)['version'], 3)
+
+    def test_not_modified_without_rendering(self):
+        response, body = self.get('/snapshot')
+        etag = response.getheader('ETag')
+
+        rendered = []
+        def render(*args):
+            rendered.append(args)
+        self.server.render = render
+        response, body = self.get('/snapshot', etag)
+        self.assertEqual(response.status, 304)
+        self.assertEqual(rendered, [])
+
+    def test_bodies_shared_by_equivalent_queries(self):
+        self.get('/capture?target=&_=1&target=b')
+        response, body = self.get('/capture?_=2&target=&target=b')
+        self.assertEqual(json.loads(body), self.stats.capture(''))
+        self.assertEqual(self.server._bodies.keys(),
+                         [('capture', None, (('target', ('', 'b')),))])
+
+
+if __name__ == '__main__':
+    unittest.main()